@@ -0,0 +1,117 @@
+# Copyright 2019 by Kirill Kanin.
+# All rights reserved.
+
+"""Benchmark of file copy methods used by file loaders.
+
+Usage: python -m benchmarks.bench_copy [-d DIR] [-s SIZE [SIZE ...]] [-r REPEAT]
+Sizes are set in megabytes, default: 1 10 100 1024 10240.
+"""
+
+import os
+import time
+import errno
+import argparse
+import tempfile
+from server.file_loader import reflink, copy_file
+
+MB = 1024 * 1024
+CHUNK_SIZE = 8 * MB
+
+
+def copy_python(src: str, dst: str) -> int:
+    """Copy file via Python level buffers (baseline)."""
+    copied = 0
+
+    with open(src, 'rb') as fr, open(dst, 'wb') as fw:
+        while True:
+            data = fr.read(CHUNK_SIZE)
+
+            if not data:
+                return copied
+            fw.write(data)
+            copied += len(data)
+
+
+def copy_syscall(name: str):
+    """Make copy function, which uses only one system call for copying chunks."""
+    def copy(src: str, dst: str) -> int:
+        src_fd = os.open(src, os.O_RDONLY)
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        offset = 0
+
+        try:
+            if name == 'reflink':
+                if not reflink(src_fd, dst_fd):
+                    raise OSError(errno.EOPNOTSUPP, 'reflink is not supported')
+                return os.fstat(src_fd).st_size
+
+            while True:
+                if name == 'copy_file_range':
+                    copied = os.copy_file_range(src_fd, dst_fd, CHUNK_SIZE, offset)
+                else:
+                    copied = os.sendfile(dst_fd, src_fd, offset, CHUNK_SIZE)
+
+                if not copied:
+                    return offset
+                offset += copied
+        finally:
+            os.close(src_fd)
+            os.close(dst_fd)
+
+    return copy
+
+
+METHODS = {
+    'python': copy_python,
+    'reflink': copy_syscall('reflink'),
+    'copy_file_range': copy_syscall('copy_file_range'),
+    'sendfile': copy_syscall('sendfile'),
+    'copy_file': lambda src, dst: copy_file(src, dst, CHUNK_SIZE),
+}
+
+
+def make_file(path: str, size: int):
+    """Create file with random content."""
+    block = os.urandom(MB)
+
+    with open(path, 'wb') as fw:
+        for _ in range(size // MB):
+            fw.write(block)
+        fw.write(block[:size % MB])
+
+
+def main():
+    p = argparse.ArgumentParser(description='File copy benchmark')
+    p.add_argument('-d', '--directory', default=None, help='directory for test files (default: temp directory)')
+    p.add_argument('-s', '--sizes', type=int, nargs='+', default=[1, 10, 100, 1024, 10240], help='sizes in MB')
+    p.add_argument('-r', '--repeat', type=int, default=3, help='repeats per method')
+    args = p.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        src, dst = os.path.join(directory, 'src.bin'), os.path.join(directory, 'dst.bin')
+        print(f'{"size, MB":>10} {"method":>16} {"best, s":>10} {"MB/s":>10}')
+
+        for size in args.sizes:
+            make_file(src, size * MB)
+
+            for name, method in METHODS.items():
+                timings = []
+
+                try:
+                    for _ in range(args.repeat):
+                        started = time.perf_counter()
+                        method(src, dst)
+                        timings.append(time.perf_counter() - started)
+                        os.remove(dst)
+                except (OSError, AttributeError) as err:
+                    print(f'{size:>10} {name:>16} {"n/a":>10} ({err})')
+                    continue
+
+                best = min(timings)
+                print(f'{size:>10} {name:>16} {best:>10.4f} {size / best:>10.1f}')
+
+            os.remove(src)
+
+
+if __name__ == '__main__':
+    main()
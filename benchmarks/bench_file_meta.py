@@ -0,0 +1,52 @@
+# Copyright 2019 by Kirill Kanin.
+# All rights reserved.
+
+"""Benchmark of memory used by file meta info: dicts vs FileMeta records.
+
+Usage: python -m benchmarks.bench_file_meta [-n COUNT]
+"""
+
+import json
+import time
+import argparse
+import tracemalloc
+import server.utils as utils
+from server.file_service import FileMeta
+
+
+def make_dicts(count: int) -> list:
+    return [{'name': f'{i:026d}.txt', 'size': i, 'create_date': utils.convert_date(i),
+             'edit_date': utils.convert_date(i)} for i in range(count)]
+
+
+def make_records(count: int) -> list:
+    return [FileMeta(f'{i:026d}.txt', i, utils.convert_date(i), utils.convert_date(i)) for i in range(count)]
+
+
+def make_lazy_records(count: int) -> list:
+    return [FileMeta(f'{i:026d}.txt', i, utils.Timestamp(i), utils.Timestamp(i)) for i in range(count)]
+
+
+def measure(factory, count: int):
+    tracemalloc.start()
+    items = factory(count)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    started = time.perf_counter()
+    json.dumps(items, default=utils.json_default)
+    return size, time.perf_counter() - started
+
+
+def main():
+    p = argparse.ArgumentParser(description='File meta info memory benchmark')
+    p.add_argument('-n', '--count', type=int, default=1000000, help='quantity of records')
+    args = p.parse_args()
+    print(f'{"type":>14} {"memory, MB":>12} {"bytes/file":>12} {"dumps, s":>10}')
+
+    for name, factory in (('dict', make_dicts), ('FileMeta', make_records), ('FileMeta lazy', make_lazy_records)):
+        size, duration = measure(factory, args.count)
+        print(f'{name:>14} {size / 2 ** 20:>12.1f} {size / args.count:>12.0f} {duration:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
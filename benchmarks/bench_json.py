@@ -0,0 +1,58 @@
+# Copyright 2019 by Kirill Kanin.
+# All rights reserved.
+
+"""Benchmark of JSON serialization of file listings: stdlib json vs orjson.
+
+Usage: python -m benchmarks.bench_json [-n COUNT ...] [-r REPEAT]
+"""
+
+import json
+import time
+import argparse
+import server.utils as utils
+from server.file_service import FileMeta
+
+
+def make_listing(count: int, lazy_dates: bool) -> dict:
+    date = utils.Timestamp if lazy_dates else utils.convert_date
+    return {'status': 'success',
+            'data': [FileMeta(f'{i:026d}.txt', i, date(i), date(i)) for i in range(count)]}
+
+
+def measure(dumps, listing: dict, repeat: int) -> float:
+    best = float('inf')
+
+    for _ in range(repeat):
+        started = time.perf_counter()
+        dumps(listing)
+        best = min(best, time.perf_counter() - started)
+
+    return best
+
+
+def main():
+    p = argparse.ArgumentParser(description='JSON serialization benchmark')
+    p.add_argument('-n', '--count', type=int, nargs='+', default=[1000, 100000], help='quantities of files')
+    p.add_argument('-r', '--repeat', type=int, default=5, help='quantity of runs, the best one is reported')
+    args = p.parse_args()
+    serializers = [('json', lambda obj: json.dumps(obj, default=utils.json_default))]
+
+    if utils.orjson:
+        serializers.append(('orjson', utils.json_dumps))
+    else:
+        print('orjson is not installed')
+
+    print(f'{"files":>8} {"dates":>6} {"serializer":>10} {"time, ms":>10} {"us/file":>8}')
+
+    for count in args.count:
+        for lazy_dates in (False, True):
+            listing = make_listing(count, lazy_dates)
+
+            for name, dumps in serializers:
+                duration = measure(dumps, listing, args.repeat)
+                print(f'{count:>8} {"lazy" if lazy_dates else "str":>6} {name:>10} {duration * 1000:>10.2f} '
+                      f'{duration * 1e6 / count:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
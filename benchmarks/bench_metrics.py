@@ -0,0 +1,42 @@
+# Copyright 2019 by Kirill Kanin.
+# All rights reserved.
+
+"""Benchmark of metrics recording overhead per event.
+
+Usage: python -m benchmarks.bench_metrics [-n COUNT]
+"""
+
+import timeit
+import argparse
+import server.metrics as metrics
+
+
+def measure(record, count: int) -> float:
+    return min(timeit.repeat(record, number=count, repeat=5)) / count
+
+
+def main():
+    p = argparse.ArgumentParser(description='Metrics recording overhead benchmark')
+    p.add_argument('-n', '--count', type=int, default=200000, help='quantity of events per run, best of 5 runs is '
+                                                                   'reported')
+    args = p.parse_args()
+    registry = metrics.Registry()
+    counter = registry.counter('bench_total', 'Benchmark counter.', ('route',))
+    histogram = registry.histogram('bench_seconds', 'Benchmark histogram.', ('route',))
+    labels = ('/files/{filename}',)
+
+    @metrics.timed(histogram)
+    def noop():
+        pass
+
+    baseline = measure(lambda: None, args.count)
+    print(f'{"event":>20} {"ns/event":>10}')
+
+    for name, record in (('counter inc', lambda: counter.inc(1, labels)),
+                         ('histogram observe', lambda: histogram.observe(0.003, labels)),
+                         ('timed call', noop)):
+        print(f'{name:>20} {(measure(record, args.count) - baseline) * 1e9:>10.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Copyright 2019 by Kirill Kanin.
+# All rights reserved.
+
+"""Benchmark of disk space vs CPU time of plain and compressed file storage.
+
+Corpus is copied from directory with .txt files or generated from random words.
+
+Usage: python -m benchmarks.bench_storage [-n COUNT] [-s SIZE] [-c CORPUS]
+"""
+
+import os
+import time
+import random
+import argparse
+import tempfile
+from server.file_service import FileService
+
+
+def load_corpus(path: str, count: int, size: int) -> list:
+    if path:
+        with os.scandir(path) as entries:
+            names = [entry.path for entry in entries if entry.name.endswith('.txt')][:count]
+
+        contents = []
+
+        for name in names:
+            with open(name) as f:
+                contents.append(f.read())
+
+        return contents
+
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod',
+             'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua']
+    rnd = random.Random(0)
+    return [' '.join(rnd.choice(words) for _ in range(size // 6)) for _ in range(count)]
+
+
+def disk_usage(path: str) -> int:
+    usage = 0
+
+    for root, _, files in os.walk(path):
+        for name in files:
+            usage += os.stat(os.path.join(root, name)).st_blocks * 512
+
+    return usage
+
+
+def measure(service: FileService, contents: list, compress_storage: bool):
+    service.compress_storage = compress_storage
+    service.content_cache.clear()
+    started = time.perf_counter()
+    names = [os.path.splitext(service.create_file(content)['name'])[0] for content in contents]
+    write_duration = time.perf_counter() - started
+    service.content_cache.clear()
+    started = time.perf_counter()
+
+    for name in names:
+        str(service.get_file_data(name)['content'])
+
+    return disk_usage(service.path), write_duration, time.perf_counter() - started
+
+
+def main():
+    p = argparse.ArgumentParser(description='File storage compression benchmark')
+    p.add_argument('-n', '--count', type=int, default=1000, help='quantity of files')
+    p.add_argument('-s', '--size', type=int, default=16384, help='size of generated file in bytes')
+    p.add_argument('-c', '--corpus', type=str, help='directory with .txt files used as corpus')
+    args = p.parse_args()
+    contents = load_corpus(args.corpus, args.count, args.size)
+    logical = sum(len(content.encode()) for content in contents)
+    service = FileService()
+    service.mmap_threshold = 1 << 62
+    print(f'{len(contents)} files, {logical / 2 ** 20:.1f} MB of content')
+    print(f'{"storage":>10} {"disk, MB":>10} {"ratio":>7} {"write, s":>10} {"read, s":>10}')
+
+    for name, compress_storage in (('plain', False), ('gzip', True)):
+        with tempfile.TemporaryDirectory() as path:
+            service.path = path
+            usage, write_duration, read_duration = measure(service, contents, compress_storage)
+            print(f'{name:>10} {usage / 2 ** 20:>10.1f} {logical / usage:>7.2f} {write_duration:>10.3f} '
+                  f'{read_duration:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
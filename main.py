@@ -5,6 +5,7 @@ __date__ = '2020-09-28'
 
 import argparse
 import os
+import functools
 # import sys
 # import logging
 # import json
@@ -14,6 +15,11 @@ import os
 # from server.file_service import FileService, FileServiceSigned
 import server.file_service
 # import server.file_service_no_class as file_service
+import server.prefork
+from server.app import create_app
+from server.database import DataBase
+from server.handler import VISITOR_METHODS
+from server.role_model import RoleModel
 
 
 def commandline_parser() -> argparse.ArgumentParser:
@@ -25,6 +31,11 @@ def commandline_parser() -> argparse.ArgumentParser:
     -d --directory - working directory (absolute or relative path,
                      default: current app folder FileServer).
     -i --init      - initialize database.
+    -s --shards    - depth of hashed directory layout (default: 0, flat).
+    -m --migrate   - move files from flat to hashed directory layout.
+    -w --workers   - run web server with N worker processes sharing
+                     the port instead of CLI (default: 0, CLI).
+    -H --host      - host for web server (default: 0.0.0.0).
     -h --help      - help.
     """
     # noinspection PyTypeChecker
@@ -42,6 +53,14 @@ def commandline_parser() -> argparse.ArgumentParser:
                    help='working directory')
     p.add_argument('-i', '--init', action='store_true', default=False,
                    help='initialize database')
+    p.add_argument('-s', '--shards', type=int, metavar='DEPTH', default=0,
+                   help='depth of hashed directory layout')
+    p.add_argument('-m', '--migrate', action='store_true', default=False,
+                   help='move files from flat to hashed directory layout')
+    p.add_argument('-w', '--workers', type=int, metavar='N', default=0,
+                   help='run web server with N worker processes')
+    p.add_argument('-H', '--host', type=str, metavar='HOST',
+                   default='0.0.0.0', help='host for web server')
     # either verbose or quiet, can be default
     g1 = p.add_mutually_exclusive_group(required=False)
     g1.add_argument('-v', '--verbose', action='store_true', default=False,
@@ -78,8 +97,8 @@ def get_file_data(_file=None):
 def create_file(_content=None):
     """Create new .txt file.
 
-    Method generates name of file from random string with digits
-    and latin letters.
+    Method generates name of file from unique time-ordered string
+    with digits and latin letters.
 
     Args:
         _content (str): String with file content,
@@ -139,6 +158,37 @@ def change_dir(_path=None):
         print(file_service.path)
 
 
+def init_worker(_args):
+    """Re-initialize singletons in forked worker process.
+
+    Args:
+        _args (Namespace): Parsed command line options.
+    """
+    # signed service first: FileService instance would be inherited
+    for _cls in (server.file_service.FileServiceSigned,
+                 server.file_service.FileService, DataBase):
+        _cls.reset()
+    for _service in (server.file_service.FileServiceSigned(),
+                     server.file_service.FileService()):
+        if _args.directory:
+            _service.path = _args.directory
+        _service.shard_depth = _args.shards
+
+
+def serve(_args):
+    """Run web server with pre-forked worker processes.
+
+    SIGHUP reloads workers gracefully, SIGTERM and SIGINT stop server.
+
+    Args:
+        _args (Namespace): Parsed command line options.
+    """
+    _server = server.prefork.PreforkServer(
+        lambda: create_app(file_service.path), _args.host, _args.port,
+        _args.workers, functools.partial(init_worker, _args))
+    _server.run()
+
+
 def main():
     """Entry point of app."""
     args, _ = commandline_parser().parse_known_args()
@@ -158,6 +208,18 @@ def main():
         _pwd = change_dir(args.directory)
         server.file_service.log.info(f"Directory set to {_pwd}.")
 
+    if args.init:
+        # methods are registered by role model decorators of Handler
+        DataBase().init_system(RoleModel.methods, VISITOR_METHODS)
+
+    file_service.shard_depth = args.shards
+    if args.migrate:
+        file_service.migrate_layout()
+
+    if args.workers:
+        serve(args)
+        return
+
     # run CLI
     cli()
 
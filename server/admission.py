@@ -0,0 +1,267 @@
+# Copyright 2019 by Kirill Kanin.
+# All rights reserved.
+
+import os
+import math
+import time
+import asyncio
+import typing
+from collections import OrderedDict
+from aiohttp import web
+import server.tracing as tracing
+
+
+class TokenBucket:
+    """Token bucket, which is refilled continuously with rate tokens per second up to burst tokens.
+
+    """
+
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate: float, burst: float, now: float) -> float:
+        """Take one token.
+
+        Args:
+            rate (float): Refill rate in tokens per second,
+            burst (float): Bucket capacity,
+            now (float): Current monotonic time.
+
+        Returns:
+            Float, which is 0 if token is taken, otherwise time in seconds until token is available.
+
+        """
+
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+
+        return (1 - self.tokens) / rate if rate > 0 else math.inf
+
+
+class RateLimiter:
+    """Token bucket rate limiter for many keys. Buckets of least recently seen keys are dropped over max_keys, so
+    memory is bounded and each check is O(1).
+
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+
+    def acquire(self, key: typing.Hashable, now: float = None, rate: float = None, burst: float = None) -> float:
+        """Take token from bucket of key.
+
+        Args:
+            key (Hashable): Bucket key,
+            now (float): Current monotonic time. Optional,
+            rate (float): Refill rate of bucket. Optional. Default: rate of limiter,
+            burst (float): Capacity of bucket. Optional. Default: burst of limiter.
+
+        Returns:
+            Float, which is 0 if request is allowed, otherwise time in seconds until it is allowed.
+
+        """
+
+        now = time.monotonic() if now is None else now
+        rate = self.rate if rate is None else rate
+        burst = self.burst if burst is None else burst
+        bucket = self.buckets.get(key)
+
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(burst, now)
+
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+
+        return bucket.take(rate, burst, now)
+
+
+class AdmissionControl:
+    """Aiohttp middleware with per client and endpoint rate limits and global concurrency limit.
+
+    Client is identified by user of session in Authorization header, if session was verified by authorization
+    decorator of earlier request, otherwise by remote address, so forged headers do not get own buckets. Endpoint is
+    identified by method and canonical path of matched route, e.g. GET /files/{filename}. Requests over concurrency
+    limit wait in queue until their queueing deadline.
+
+    """
+
+    def __init__(self, rate: float = None, burst: float = None, concurrency: int = None, max_queue: int = None,
+                 queue_timeout: float = None, endpoint_limits: typing.Dict[str, typing.Tuple[float, float]] = None,
+                 exempt: typing.Iterable[str] = ()):
+        self.limiter = RateLimiter(float(os.environ['RATE_LIMIT_PER_SECOND']) if rate is None else rate,
+                                   float(os.environ['RATE_LIMIT_BURST']) if burst is None else burst,
+                                   int(os.environ['RATE_LIMIT_MAX_CLIENTS']))
+        self.concurrency = int(os.environ['ADMISSION_CONCURRENCY']) if concurrency is None else concurrency
+        self.max_queue = int(os.environ['ADMISSION_MAX_QUEUE']) if max_queue is None else max_queue
+        self.queue_timeout = float(os.environ['ADMISSION_QUEUE_TIMEOUT_SECONDS']) if queue_timeout is None \
+            else queue_timeout
+        self.endpoint_limits = dict(endpoint_limits or {})
+        self.exempt = set(exempt)
+        self.in_flight = 0
+        self.waiting = 0
+        self.rate_limited = 0
+        self.shed = 0
+        # verified session UUID -> user Id, least recently used first
+        self.sessions = OrderedDict()
+        self.max_sessions = int(os.environ['RATE_LIMIT_MAX_CLIENTS'])
+        self._semaphore = None
+
+    def client_key(self, request: web.Request) -> str:
+        """Get client identity of request.
+
+        Args:
+            request (Request): aiohttp request.
+
+        Returns:
+            Str with user Id of verified session or remote address.
+
+        """
+
+        user_id = self.sessions.get(request.headers.get('Authorization'))
+
+        if user_id is not None:
+            return 'user:{}'.format(user_id)
+
+        return request.remote or ''
+
+    def verify_session(self, request: web.Request, status: int):
+        """Remember user of session verified by authorization decorator, forget session rejected with 401.
+
+        Args:
+            request (Request): aiohttp request, contains user_id key, if session is verified,
+            status (int): Response status.
+
+        """
+
+        session_id = request.headers.get('Authorization')
+
+        if not session_id:
+            return
+
+        if status == 401:
+            self.sessions.pop(session_id, None)
+        elif request.get('user_id') is not None:
+            self.sessions[session_id] = request['user_id']
+            self.sessions.move_to_end(session_id)
+
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def check_rate(self, request: web.Request, endpoint: str):
+        """Take token from bucket of client and endpoint.
+
+        Args:
+            request (Request): aiohttp request,
+            endpoint (str): Method and canonical path of route.
+
+        Raises:
+            HTTPTooManyRequests: 429 HTTP error, if client exceeded rate limit of endpoint.
+
+        """
+
+        rate, burst = self.endpoint_limits.get(endpoint, (None, None))
+        retry_after = self.limiter.acquire((self.client_key(request), endpoint), rate=rate, burst=burst)
+
+        if retry_after:
+            self.rate_limited += 1
+            raise web.HTTPTooManyRequests(text='Rate limit exceeded',
+                                          headers={'Retry-After': str(math.ceil(min(retry_after, 3600)))})
+
+    async def admit(self):
+        """Wait for free concurrency slot.
+
+        Raises:
+            HTTPServiceUnavailable: 503 HTTP error, if queue is full or slot is not free until queueing deadline.
+
+        """
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        if self._semaphore.locked():
+            if self.waiting >= self.max_queue:
+                self.shed += 1
+                raise web.HTTPServiceUnavailable(text='Server is busy', headers={'Retry-After': '1'})
+
+            self.waiting += 1
+
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.shed += 1
+                raise web.HTTPServiceUnavailable(text='Server is busy', headers={'Retry-After': '1'})
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        """Apply rate limit and concurrency limit to request.
+
+        Args:
+            request (Request): aiohttp request,
+            handler (function): Request handler.
+
+        Returns:
+            StreamResponse: response of handler.
+
+        Raises:
+            HTTPTooManyRequests: 429 HTTP error, if client exceeded rate limit,
+            HTTPServiceUnavailable: 503 HTTP error, if server is busy.
+
+        """
+
+        resource = request.match_info.route.resource
+        endpoint = '{} {}'.format(request.method, resource.canonical if resource is not None else request.path)
+
+        if endpoint in self.exempt:
+            return await handler(request)
+
+        self.check_rate(request, endpoint)
+
+        with tracing.span('AdmissionControl.admit'):
+            await self.admit()
+
+        self.in_flight += 1
+        status = 500
+
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as err:
+            status = err.status
+            raise
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+            self.verify_session(request, status)
+
+    def stats(self) -> typing.Dict:
+        """Get admission metrics.
+
+        Returns:
+            Dict with metrics. Keys:
+                in_flight (int): quantity of admitted requests in progress,
+                waiting (int): quantity of requests waiting for concurrency slot,
+                rate_limited (int): quantity of requests rejected by rate limits,
+                shed (int): quantity of requests rejected by concurrency limit,
+                clients (int): quantity of tracked rate limit buckets.
+
+        """
+
+        return {'in_flight': self.in_flight, 'waiting': self.waiting, 'rate_limited': self.rate_limited,
+                'shed': self.shed, 'clients': len(self.limiter.buckets)}
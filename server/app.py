@@ -0,0 +1,116 @@
+# Copyright 2019 by Kirill Kanin.
+# All rights reserved.
+
+import os
+import typing
+from aiohttp import web
+import server.metrics as metrics
+from server.tracing import Tracer
+from server.handler import Handler
+from server.admission import AdmissionControl
+from server.database import DataBase
+from server.file_service import FileService, FileServiceSigned
+
+
+def create_app(path: str) -> web.Application:
+    """Create aiohttp application with handler routes and background tasks.
+
+    Application is created in each worker process, so handler pools, caches and rate limits are not shared between
+    processes. Download job queue is the exception: it is a SQLite database in LOADER_QUEUE_PATH shared by all
+    workers. Any worker puts jobs, reports their status and cancels them, queued loaders of all workers take jobs
+    atomically and hold them by lease, so job of dead worker is taken again only after its lease is expired. File
+    reads have own rate limit per client. Metrics of worker are exposed on /metrics, slowest recent traces of
+    sampled requests are exposed on /debug/traces if TRACE_DEBUG_ENABLED is set.
+
+    Args:
+        path (str): Working directory path.
+
+    Returns:
+        Application: aiohttp application.
+
+    """
+
+    handler = Handler(path)
+    file_reads_limit = (float(os.environ['RATE_LIMIT_FILE_READS_PER_SECOND']),
+                        float(os.environ['RATE_LIMIT_FILE_READS_BURST']))
+    admission = AdmissionControl(endpoint_limits={
+        'GET /files': file_reads_limit,
+        'GET /files/{filename}': file_reads_limit,
+        'GET /files/{filename}/content': file_reads_limit,
+    }, exempt=['GET /metrics', 'GET /debug/traces'])
+    tracer = Tracer(exempt=['GET /metrics', 'GET /debug/traces'])
+    app = web.Application(middlewares=[tracer.middleware, metrics.middleware, admission.middleware])
+    app['handler'] = handler
+    app['admission'] = admission
+    app['tracer'] = tracer
+    app.add_routes([
+        web.get('/', handler.handle),
+        web.get('/metrics', metrics.handle_metrics),
+        web.get('/debug/traces', tracer.handle_traces),
+        web.get('/files/list', handler.get_files),
+        web.get('/files/download', handler.download_file),
+        web.get('/files/download/async', handler.download_file_async),
+        web.post('/files/download/batch', handler.download_files),
+        web.get('/files/download/queued', handler.download_file_queued),
+        web.get('/files/download/jobs/{job_id}', handler.get_download_job),
+        web.delete('/files/download/jobs/{job_id}', handler.cancel_download_job),
+        web.get('/files', handler.get_file_info),
+        web.get('/files/{filename}', handler.get_file_info),
+        web.get('/files/{filename}/content', handler.get_file_content),
+        web.post('/files', handler.create_file),
+        web.delete('/files/{filename}', handler.delete_file),
+        web.post('/change_file_dir', handler.change_file_dir),
+        web.post('/signup', handler.signup),
+        web.post('/signup/bulk', handler.signup_bulk),
+        web.post('/signin', handler.signin),
+        web.get('/logout', handler.logout),
+        web.put('/method/{method_name}', handler.add_method),
+        web.delete('/method/{method_name}', handler.delete_method),
+        web.put('/role/{role_name}', handler.add_role),
+        web.delete('/role/{role_name}', handler.delete_role),
+        web.post('/add_method_to_role', handler.add_method_to_role),
+        web.post('/delete_method_from_role', handler.delete_method_from_role),
+        web.post('/change_shared_prop', handler.change_shared_prop),
+        web.post('/change_user_role', handler.change_user_role),
+        web.post('/role_model/batch', handler.role_model_batch),
+    ])
+    register_metrics(app)
+    app.cleanup_ctx.append(handler.offload.context)
+    app.cleanup_ctx.append(DataBase().session_reaper)
+    return app
+
+
+def register_metrics(app: web.Application):
+    """Register metrics of application components and observe duration of SQL statements.
+
+    Args:
+        app (Application): aiohttp application with handler and admission control.
+
+    """
+
+    handler, admission = app['handler'], app['admission']
+    # services are separate singletons only if signed one is created first, shared cache is reported once
+    caches = {('plain',): FileService().content_cache, ('signed',): FileServiceSigned().content_cache}
+
+    if caches[('plain',)] is caches[('signed',)]:
+        del caches[('signed',)]
+
+    def cache_stats(key: str) -> typing.Callable[[], typing.Dict[tuple, float]]:
+        return lambda: {labels: cache.stats()[key] for labels, cache in caches.items()}
+
+    registry = metrics.REGISTRY
+
+    for name, documentation, key, kind in (
+            ('content_cache_hits_total', 'Content cache hits.', 'hits', 'counter'),
+            ('content_cache_misses_total', 'Content cache misses.', 'misses', 'counter'),
+            ('content_cache_evictions_total', 'Content cache evictions.', 'evictions', 'counter'),
+            ('content_cache_hit_ratio', 'Content cache hit ratio.', 'hit_ratio', 'gauge'),
+            ('content_cache_bytes', 'Size of cached content.', 'bytes', 'gauge')):
+        registry.gauge(name, documentation, cache_stats(key), kind, ('service',))
+
+    registry.gauge('loader_queue_depth', 'Queued download jobs.', handler.queue.qsize)
+    registry.gauge('admission_waiting_requests', 'Requests waiting for concurrency slot.',
+                   lambda: admission.stats()['waiting'])
+    registry.gauge('admission_rejected_total', 'Requests rejected by rate and concurrency limits.',
+                   lambda: admission.stats()['rate_limited'] + admission.stats()['shed'], 'counter')
+    metrics.instrument_database()
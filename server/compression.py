@@ -0,0 +1,162 @@
+# Copyright 2019 by Kirill Kanin.
+# All rights reserved.
+
+import os
+import gzip
+import zlib
+import asyncio
+import typing
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# supported content encodings in order of preference
+ENCODINGS = (('zstd',) if zstandard else ()) + ('gzip', 'deflate')
+
+
+def parse_accept_encoding(accept_encoding: str) -> typing.Dict[str, float]:
+    """Parse Accept-Encoding header.
+
+    Args:
+        accept_encoding (str): Value of Accept-Encoding header.
+
+    Returns:
+        Dict with quality values by lowercase encoding names.
+
+    """
+
+    qualities = {}
+
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        if name.strip():
+            qualities[name.strip().lower()] = quality
+
+    return qualities
+
+
+def accepts(accept_encoding: str, encoding: str) -> bool:
+    """Check if client accepts encoding.
+
+    Args:
+        accept_encoding (str): Value of Accept-Encoding header,
+        encoding (str): Content encoding.
+
+    Returns:
+        Bool, which is True if encoding has non-zero quality.
+
+    """
+
+    qualities = parse_accept_encoding(accept_encoding)
+    return qualities.get(encoding, qualities.get('*', 0.0)) > 0
+
+
+def negotiate(accept_encoding: str) -> typing.Optional[str]:
+    """Choose content encoding by Accept-Encoding header.
+
+    Args:
+        accept_encoding (str): Value of Accept-Encoding header.
+
+    Returns:
+        Str with the most preferred supported encoding or None for identity.
+
+    """
+
+    qualities = parse_accept_encoding(accept_encoding)
+    wildcard = qualities.get('*', 0.0)
+    candidates = [(qualities.get(encoding, wildcard), -index, encoding) for index, encoding in enumerate(ENCODINGS)]
+    quality, _, encoding = max(candidates)
+    return encoding if quality > 0 else None
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compress data.
+
+    Args:
+        data (bytes): Data for compressing,
+        encoding (str): Content encoding: zstd, gzip or deflate.
+
+    Returns:
+        Bytes with compressed data.
+
+    Raises:
+        AssertionError: if encoding is not supported.
+
+    """
+
+    assert encoding in ENCODINGS, 'Encoding {} is not supported'.format(encoding)
+
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+
+    return zlib.compress(data, 6)
+
+
+async def compress_async(data: bytes, encoding: str, executor=None) -> bytes:
+    """Compress data, large data is compressed in executor, so event loop is not blocked.
+
+    Args:
+        data (bytes): Data for compressing,
+        encoding (str): Content encoding: zstd, gzip or deflate,
+        executor (Executor): Executor for large data. Optional. Default: loop default executor.
+
+    Returns:
+        Bytes with compressed data.
+
+    """
+
+    if len(data) < int(os.environ['COMPRESSION_EXECUTOR_BYTES']):
+        return compress(data, encoding)
+
+    return await asyncio.get_event_loop().run_in_executor(executor, compress, data, encoding)
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    """Get entity tag of encoded representation of resource.
+
+    Args:
+        etag (str): Quoted entity tag of resource,
+        encoding (str): Content encoding.
+
+    Returns:
+        Str with quoted entity tag.
+
+    """
+
+    return '{}-{}"'.format(etag[:-1], encoding)
+
+
+def decoded_etag(etag: str) -> str:
+    """Get entity tag of resource from entity tag of its encoded representation.
+
+    Args:
+        etag (str): Quoted entity tag.
+
+    Returns:
+        Str with quoted entity tag without encoding suffix.
+
+    """
+
+    for encoding in ENCODINGS:
+        suffix = '-{}"'.format(encoding)
+
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+
+    return etag
@@ -8,7 +8,52 @@ os.environ['DB_HOST'] = 'localhost'
 os.environ['DB_USER'] = 'lucid'
 os.environ['DB_PASSWORD'] = 'lynx'
 os.environ['SESSION_DURATION_HOURS'] = '1'
+os.environ['SESSION_REAPER_INTERVAL_SECONDS'] = '60'
+os.environ['SESSION_REAPER_BATCH_SIZE'] = '1000'
+os.environ['ROLE_MODEL_CACHE_SECONDS'] = '5'
+os.environ['ADMIN_EMAIL'] = 'admin@fileserver.su'
 os.environ['ADMIN_PASSWORD'] = 'admin1234'
 os.environ['KEY_DIR'] = '../keys'
 os.environ['DATE_FORMAT'] = '%Y-%m-%d %H:%M:%S'
 os.environ['CRYPTO_CODE'] = '0101d08d-5c8e-4265-b2c3-b884d02b0cb4'
+os.environ['LOADER_HOME_DIR'] = '/home'
+os.environ['LOADER_QUEUE_PATH'] = '../loader_queue.db'
+os.environ['LOADER_QUEUE_SIZE'] = '10000'
+os.environ['LOADER_JOB_LEASE_SECONDS'] = '60'
+os.environ['LOADER_QUEUE_POLL_SECONDS'] = '0.5'
+os.environ['LOADER_WORKERS'] = '4'
+os.environ['LOADER_POOL_SIZE'] = '8'
+os.environ['LOADER_POOL_QUEUE_SIZE'] = '256'
+os.environ['LOADER_USER_CONCURRENCY'] = '4'
+os.environ['ASYNC_LOADER_WORKERS'] = '4'
+os.environ['LOADER_CHUNK_SIZE'] = '8388608'
+os.environ['LOADER_INTERACTIVE_WORKERS'] = '1'
+os.environ['CONTENT_CACHE_BYTES'] = '67108864'
+os.environ['MMAP_THRESHOLD_BYTES'] = '1048576'
+os.environ['COMPRESSION_MIN_BYTES'] = '1024'
+os.environ['COMPRESSION_EXECUTOR_BYTES'] = '65536'
+os.environ['PRECOMPRESS_FILES'] = '0'
+os.environ['STORAGE_COMPRESSION'] = '0'
+os.environ['PREFORK_HEARTBEAT_SECONDS'] = '2'
+os.environ['PREFORK_WORKER_TIMEOUT_SECONDS'] = '30'
+os.environ['PREFORK_SHUTDOWN_TIMEOUT_SECONDS'] = '30'
+os.environ['OFFLOAD_PROCESS_WORKERS'] = '0'
+os.environ['OFFLOAD_THREAD_WORKERS'] = '0'
+os.environ['OFFLOAD_HASH_LIMIT'] = '256'
+os.environ['OFFLOAD_HASH_TIMEOUT_SECONDS'] = '30'
+os.environ['OFFLOAD_COMPRESS_LIMIT'] = '64'
+os.environ['OFFLOAD_COMPRESS_TIMEOUT_SECONDS'] = '30'
+os.environ['OFFLOAD_PASSWORD_LIMIT'] = '64'
+os.environ['OFFLOAD_PASSWORD_TIMEOUT_SECONDS'] = '60'
+os.environ['RATE_LIMIT_PER_SECOND'] = '50'
+os.environ['RATE_LIMIT_BURST'] = '100'
+os.environ['RATE_LIMIT_FILE_READS_PER_SECOND'] = '10'
+os.environ['RATE_LIMIT_FILE_READS_BURST'] = '20'
+os.environ['RATE_LIMIT_MAX_CLIENTS'] = '100000'
+os.environ['ADMISSION_CONCURRENCY'] = '256'
+os.environ['ADMISSION_MAX_QUEUE'] = '1024'
+os.environ['ADMISSION_QUEUE_TIMEOUT_SECONDS'] = '5'
+os.environ['TRACE_SAMPLE_RATE'] = '0.01'
+os.environ['TRACE_BUFFER_SIZE'] = '256'
+os.environ['TRACE_MAX_SPANS'] = '256'
+os.environ['TRACE_DEBUG_ENABLED'] = '0'
@@ -0,0 +1,121 @@
+# Copyright 2019 by Kirill Kanin.
+# All rights reserved.
+
+import os
+import typing
+from threading import Lock
+from collections import OrderedDict
+
+
+class ContentCache:
+    """LRU cache of file contents with size budget in bytes.
+
+    Entries are validated by file identity (st_ino, st_mtime_ns, st_size),
+    so files changed on disk are never served from cache.
+    """
+
+    def __init__(self, max_bytes: int, max_item_bytes: int = None):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes if max_item_bytes is not None \
+            else max_bytes // 8
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+
+    @staticmethod
+    def identity(file_stat: os.stat_result) -> typing.Tuple[int, int, int]:
+        """Get file identity for cache validation.
+
+        Args:
+            file_stat (stat_result): Result of os.stat.
+        Returns:
+            Tuple with inode, modification time in ns and size.
+        """
+        return file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size
+
+    def get(self, path: str, file_stat: os.stat_result):
+        """Get cached content of file.
+
+        Args:
+            path (str): Full path of file,
+            file_stat (stat_result): Current result of os.stat for file.
+        Returns:
+            Cached content or None if file is not cached or changed.
+        """
+        _identity = self.identity(file_stat)
+        with self.__lock:
+            _entry = self.__entries.get(path)
+            if _entry is not None and _entry[0] == _identity:
+                self.__entries.move_to_end(path)
+                self.hits += 1
+                return _entry[1]
+            self.misses += 1
+            if _entry is not None:
+                self.__remove(path)
+            return None
+
+    def put(self, path: str, file_stat: os.stat_result, content,
+            size: int = None):
+        """Put content of file into cache, evicting least recently used
+        entries to fit size budget.
+
+        Args:
+            path (str): Full path of file,
+            file_stat (stat_result): Result of os.stat made before read,
+            content: File content,
+            size (int): Size of content charged to budget, e.g. logical
+                size of compressed file. Default: size of file.
+        """
+        _size = file_stat.st_size if size is None else size
+        if _size > self.max_item_bytes:
+            return
+        with self.__lock:
+            if path in self.__entries:
+                self.__remove(path)
+            while self.__entries and self.bytes + _size > self.max_bytes:
+                self.__remove(next(iter(self.__entries)))
+                self.evictions += 1
+            self.__entries[path] = (self.identity(file_stat), content, _size)
+            self.bytes += _size
+
+    def invalidate(self, path: str):
+        """Remove file from cache.
+
+        Args:
+            path (str): Full path of file.
+        """
+        with self.__lock:
+            if path in self.__entries:
+                self.__remove(path)
+
+    def clear(self):
+        """Remove all files from cache."""
+        with self.__lock:
+            self.__entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> typing.Dict:
+        """Get cache metrics.
+
+        Returns:
+            Dict with entries, bytes, max_bytes, hits, misses, evictions
+            and hit_ratio.
+        """
+        with self.__lock:
+            _requests = self.hits + self.misses
+            return {
+                'entries': len(self.__entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / _requests if _requests else 0.0,
+            }
+
+    def __remove(self, path: str):
+        _, _, _size = self.__entries.pop(path)
+        self.bytes -= _size
@@ -7,7 +7,9 @@ import hashlib
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import AES, PKCS1_OAEP
 from Crypto.Random import get_random_bytes
-from typing import Tuple, BinaryIO
+from typing import Tuple, BinaryIO, Iterable
+import server.metrics as metrics
+import server.tracing as tracing
 
 # key_folder = os.environ['KEY_DIR']
 
@@ -16,6 +18,8 @@ class HashAPI:
     """Class with static methods for generating hashes."""
 
     @staticmethod
+    @metrics.timed(metrics.CRYPTO_SECONDS)
+    @tracing.traced
     def hash_sha512(input_str: str) -> str:
         """Generate hash SHA-512.
 
@@ -30,6 +34,8 @@ class HashAPI:
         return output_str.hexdigest()
 
     @staticmethod
+    @metrics.timed(metrics.CRYPTO_SECONDS)
+    @tracing.traced
     def hash_md5(input_str: str) -> str:
         """Generate hash MD5.
 
@@ -43,6 +49,32 @@ class HashAPI:
         output_str = hashlib.md5(input_str.encode())
         return output_str.hexdigest()
 
+    @staticmethod
+    @metrics.timed(metrics.CRYPTO_SECONDS)
+    @tracing.traced
+    def hash_md5_parts(parts: Iterable, separator: str = '__') -> str:
+        """Generate hash MD5 of string representations of parts joined
+        with separator, without joining them in memory.
+
+        Parts with update_hash() method (e.g. mapped file content)
+        update hash by themselves.
+
+        Args:
+            parts (Iterable): Parts to hash,
+            separator (str): Separator of parts.
+        Returns:
+            Str with hash in hex format.
+        """
+        output_str = hashlib.md5()
+        for i, part in enumerate(parts):
+            if i:
+                output_str.update(separator.encode())
+            if hasattr(part, 'update_hash'):
+                part.update_hash(output_str)
+            else:
+                output_str.update(str(part).encode())
+        return output_str.hexdigest()
+
 
 class BaseCipher:
     """Base cipher class.
@@ -95,6 +127,7 @@ class AESCipher(BaseCipher):
     def __init__(self, user_id: int):
         pass
 
+    @tracing.traced
     def encrypt(self, data: bytes) -> Tuple[bytes, bytes, bytes, bytes]:
         """Encrypt data.
 
@@ -108,6 +141,7 @@ class AESCipher(BaseCipher):
 
         pass
 
+    @tracing.traced
     def decrypt(self, input_file: BinaryIO) -> bytes:
         """Decrypt data.
 
@@ -122,6 +156,7 @@ class AESCipher(BaseCipher):
         pass
 
     @staticmethod
+    @tracing.traced
     def decrypt_aes_data(cipher_text: bytes, tag: bytes, nonce: bytes, session_key: bytes) -> bytes:
         """Decrypt AES data.
 
@@ -158,6 +193,7 @@ class RSACipher(AESCipher):
     def __init__(self, user_id: int):
         pass
 
+    @tracing.traced
     def encrypt(self, data: bytes) -> Tuple[bytes, bytes, bytes, bytes]:
         """Encrypt data.
 
@@ -171,6 +207,7 @@ class RSACipher(AESCipher):
 
         pass
 
+    @tracing.traced
     def decrypt(self, input_file: BinaryIO) -> bytes:
         """Decrypt data.
 
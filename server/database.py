@@ -2,10 +2,16 @@
 # All rights reserved.
 
 import os
-from sqlalchemy import create_engine
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterable, Iterator, Tuple
+from sqlalchemy import create_engine, event
 from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, sessionmaker, joinedload, selectinload
 from sqlalchemy.orm.session import Session as DBSession
 from sqlalchemy.engine.base import Engine
 from datetime import datetime, timedelta
@@ -13,6 +19,48 @@ from uuid import uuid4
 from server.crypto import HashAPI
 from server.utils import SingletonMeta
 
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter:
+    """Counter of SQL statements executed in context of counter.
+
+    """
+
+    def __init__(self, engine: Engine = None, parent: 'QueryCounter' = None):
+        self.engine = engine
+        self.parent = parent
+        self.statements = []
+
+    @property
+    def count(self) -> int:
+        """Number of executed statements getter.
+
+        Returns:
+            Int with number of executed statements.
+
+        """
+
+        return len(self.statements)
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if self.engine is None or conn.engine is self.engine:
+            self.statements.append(statement)
+
+        if self.parent is not None:
+            self.parent(conn, cursor, statement, parameters, context, executemany)
+
+
+# counter of current context, so statements of concurrent requests are counted separately
+_query_counter = ContextVar('query_counter', default=None)
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    counter = _query_counter.get()
+
+    if counter is not None:
+        counter(conn, cursor, statement, parameters, context, executemany)
+
 
 class DataBase(metaclass=SingletonMeta):
     """Singleton class for ORM.
@@ -21,8 +69,14 @@ class DataBase(metaclass=SingletonMeta):
 
     Base = declarative_base()
 
-    def __init__(self):
-        pass
+    def __init__(self, url: str = None):
+        self.url = url or 'postgresql://{}:{}@{}/{}'.format(os.environ['DB_USER'], os.environ['DB_PASSWORD'],
+                                                            os.environ['DB_HOST'], os.environ['DB_NAME'])
+        # SQLite connections are used by executor threads, not only by thread, which created them
+        connect_args = {'check_same_thread': False} if self.url.startswith('sqlite') else {}
+        self._engine = create_engine(self.url, connect_args=connect_args)
+        self._session_factory = sessionmaker(bind=self._engine)
+        self.reaper_stats = {}
 
     class BaseModel:
         """Base database model.
@@ -31,7 +85,10 @@ class DataBase(metaclass=SingletonMeta):
 
         @declared_attr
         def __tablename__(self):
-            pass
+            return self.__name__
+
+        id = Column(Integer, primary_key=True)
+        create_date = Column(DateTime, default=datetime.now)
 
         def __init__(self):
             pass
@@ -39,34 +96,73 @@ class DataBase(metaclass=SingletonMeta):
     class User(BaseModel, Base):
         """User model.
 
+        Role is loaded with the user in the same statement, because authorization always needs it.
+
         """
 
+        email = Column(String, unique=True, nullable=False)
+        password = Column(String, nullable=False)
+        name = Column(String, nullable=False)
+        surname = Column(String)
+        last_login_date = Column(DateTime)
+        role_id = Column(Integer, ForeignKey('Role.id'))
+        role = relationship('Role', back_populates='users', lazy='joined')
+        sessions = relationship('Session', back_populates='user', cascade='all, delete-orphan')
+
         def __init__(self, email: str, password: str, name: str, surname: str = None, role=None, sessions: list = None):
-            pass
+            self.email = email
+            self.password = password
+            self.name = name
+            self.surname = surname
+            self.role = role
+            self.sessions = sessions or []
 
     class Role(BaseModel, Base):
         """Role model.
 
+        Methods are loaded with one additional IN-query for all loaded roles.
+
         """
 
+        name = Column(String, unique=True, nullable=False)
+        users = relationship('User', back_populates='role')
+        methods = relationship('Method', secondary='MethodRole', back_populates='roles', lazy='selectin')
+
         def __init__(self, name: str, users: list = None, methods: list = None):
-            pass
+            self.name = name
+            self.users = users or []
+            self.methods = methods or []
 
     class Method(BaseModel, Base):
         """Method model.
 
         """
 
+        name = Column(String, unique=True, nullable=False)
+        shared = Column(Boolean, default=False, nullable=False)
+        roles = relationship('Role', secondary='MethodRole', back_populates='methods')
+
         def __init__(self, name: str, shared: bool = False, roles: list = None):
-            pass
+            self.name = name
+            self.shared = shared
+            self.roles = roles or []
 
     class Session(BaseModel, Base):
         """Session model.
 
+        User (and user's role) is loaded with the session in the same statement.
+
         """
 
+        uuid = Column(String, unique=True, nullable=False, index=True)
+        expires_at = Column(DateTime, nullable=False, index=True, default=lambda: datetime.now() + timedelta(
+            hours=int(os.environ['SESSION_DURATION_HOURS'])))
+        user_id = Column(Integer, ForeignKey('User.id'), nullable=False)
+        user = relationship('User', back_populates='sessions', lazy='joined')
+
         def __init__(self, user=None):
-            pass
+            self.uuid = str(uuid4())
+            self.user = user
 
     class MethodRole(Base):
         """Many to many model for method and role models.
@@ -75,8 +171,13 @@ class DataBase(metaclass=SingletonMeta):
 
         __tablename__ = 'MethodRole'
 
+        id = Column(Integer, primary_key=True)
+        method_id = Column(Integer, ForeignKey('Method.id', ondelete='CASCADE'), nullable=False)
+        role_id = Column(Integer, ForeignKey('Role.id', ondelete='CASCADE'), nullable=False)
+
         def __init__(self, method=None, role=None):
-            pass
+            self.method_id = method.id if method is not None else None
+            self.role_id = role.id if role is not None else None
 
     @property
     def engine(self) -> Engine:
@@ -87,7 +188,7 @@ class DataBase(metaclass=SingletonMeta):
 
         """
 
-        pass
+        return self._engine
 
     def create_session(self) -> DBSession:
         """Create and get database connection session.
@@ -97,11 +198,189 @@ class DataBase(metaclass=SingletonMeta):
 
         """
 
-        pass
+        return self._session_factory()
+
+    @staticmethod
+    def load_options(profile: str) -> tuple:
+        """Get query loader options for named loading profile.
+
+        Profiles:
+            session - session with user and user's role. Used by authorization decorator, permissions of role are
+            taken from RoleModel permissions cache,
+            authorization - session with user, user's role and role's methods. Used for checks of role methods
+            without permissions cache,
+            role - role with users and methods. Used by role administration operations,
+            method - method with roles. Used by method administration operations,
+            user - user with role and sessions. Used by user role change and logout.
+
+        Args:
+            profile (str): Profile name.
+
+        Returns:
+            Tuple with loader options for Query.options().
+
+        Raises:
+            AssertionError: if profile is unknown.
+
+        """
+
+        profiles = {
+            'session': (joinedload(DataBase.Session.user).joinedload(DataBase.User.role),),
+            'authorization': (
+                joinedload(DataBase.Session.user).joinedload(DataBase.User.role).selectinload(DataBase.Role.methods),),
+            'role': (selectinload(DataBase.Role.users), selectinload(DataBase.Role.methods)),
+            'method': (selectinload(DataBase.Method.roles),),
+            'user': (joinedload(DataBase.User.role), selectinload(DataBase.User.sessions)),
+        }
+        assert profile in profiles, 'Loading profile {} is unknown'.format(profile)
+        return profiles[profile]
+
+    @staticmethod
+    @contextmanager
+    def count_queries(engine: Engine = None) -> Iterator[QueryCounter]:
+        """Count SQL statements executed inside context. Statements of other requests and threads are not counted,
+        unless context is copied into them.
+
+        Args:
+            engine (Engine): Database engine. Optional. Default: all engines.
+
+        Returns:
+            Iterator with SQL statements counter.
+
+        """
+
+        if not event.contains(Engine, 'before_cursor_execute', _count_query):
+            event.listen(Engine, 'before_cursor_execute', _count_query)
+
+        counter = QueryCounter(engine, _query_counter.get())
+        token = _query_counter.set(counter)
+
+        try:
+            yield counter
+        finally:
+            _query_counter.reset(token)
+
+    @staticmethod
+    def purge_expired_sessions(db_session: DBSession, batch_size: int = None) -> Tuple[int, float]:
+        """Delete expired sessions in bounded batches.
+
+        Every batch is deleted and committed in a separate transaction, so table locks are held only for one batch.
+
+        Args:
+            db_session (DBSession): Database connection session,
+            batch_size (int): Max quantity of sessions deleted in one transaction. Optional. Default:
+            SESSION_REAPER_BATCH_SIZE.
+
+        Returns:
+            Tuple with quantity of deleted sessions and duration of purge in seconds.
+
+        """
+
+        batch_size = batch_size or int(os.environ['SESSION_REAPER_BATCH_SIZE'])
+        started = time.monotonic()
+        now = datetime.now()
+        purged = 0
+
+        while True:
+            ids = [row.id for row in db_session.query(DataBase.Session.id).filter(
+                DataBase.Session.expires_at < now).order_by(DataBase.Session.expires_at).limit(batch_size)]
+
+            if not ids:
+                break
+
+            purged += db_session.query(DataBase.Session).filter(
+                DataBase.Session.id.in_(ids)).delete(synchronize_session=False)
+            db_session.commit()
+
+            if len(ids) < batch_size:
+                break
+
+        return purged, time.monotonic() - started
+
+    def reap_sessions(self) -> Tuple[int, float]:
+        """Delete expired sessions in own database connection session.
+
+        Returns:
+            Tuple with quantity of deleted sessions and duration of purge in seconds.
+
+        """
+
+        db_session = self.create_session()
+
+        try:
+            return self.purge_expired_sessions(db_session)
+        finally:
+            db_session.close()
+
+    async def session_reaper(self, app):
+        """Background task for deleting expired sessions. Used as aiohttp application cleanup context.
+
+        Failed purge is logged and retried on next iteration. Result of last purge is kept in reaper_stats.
+
+        Args:
+            app (Application): aiohttp application.
+
+        """
+
+        interval = int(os.environ['SESSION_REAPER_INTERVAL_SECONDS'])
+
+        async def reap():
+            loop = asyncio.get_event_loop()
+
+            while True:
+                await asyncio.sleep(interval)
+
+                try:
+                    purged, duration = await loop.run_in_executor(None, self.reap_sessions)
+                except Exception:
+                    logger.exception('Expired sessions purge failed')
+                else:
+                    self.reaper_stats = {'purged': purged, 'duration': duration}
+                    logger.info('Purged {} expired sessions in {:.3f} s'.format(purged, duration))
+
+        task = asyncio.ensure_future(reap())
+        yield
+        task.cancel()
+
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    def init_system(self, methods: Iterable[str] = (), visitor_methods: Iterable[str] = ()):
+        """Initialize database. Tables, methods, admin and visitor roles and admin user are created, existing rows are
+        kept.
 
-    def init_system(self):
-        """Initialize database.
+        Args:
+            methods (Iterable): Names of all methods, admin role has all of them,
+            visitor_methods (Iterable): Names of methods of visitor role, which is role of signed up users.
 
         """
 
-        pass
+        self.Base.metadata.create_all(self.engine)
+        session = self.create_session()
+
+        try:
+            existing = {method.name: method for method in session.query(DataBase.Method)}
+
+            for name in set(methods) | set(visitor_methods):
+                if name not in existing:
+                    existing[name] = DataBase.Method(name)
+                    session.add(existing[name])
+
+            roles = {role.name: role for role in session.query(DataBase.Role).filter(
+                DataBase.Role.name.in_(['admin', 'visitor']))}
+            admin = roles.get('admin') or DataBase.Role('admin')
+            visitor = roles.get('visitor') or DataBase.Role('visitor')
+            admin.methods = list(existing.values())
+            visitor.methods = list(set(visitor.methods) | {existing[name] for name in visitor_methods})
+            session.add_all([admin, visitor])
+
+            if not session.query(DataBase.User.id).filter_by(email=os.environ['ADMIN_EMAIL']).first():
+                session.add(DataBase.User(os.environ['ADMIN_EMAIL'], HashAPI.hash_sha512(os.environ['ADMIN_PASSWORD']),
+                                          'Admin', role=admin))
+
+            session.commit()
+            logger.info('Database is initialized')
+        finally:
+            session.close()
@@ -2,16 +2,171 @@
 # All rights reserved.
 
 import os
+import gzip
+import errno
+import fcntl
+import asyncio
 import logging
-import time
-from uuid import uuid4
-from threading import Thread
-from queue import Queue
+import typing
+import tarfile
+import shutil
+import zipfile
+from functools import partial
+from threading import Thread, Lock
+from queue import Queue, Full
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from server.file_service import FileService, FileServiceSigned
+from server.file_service import FileService, FileServiceSigned, GZIP_MAGIC, is_compressed, logical_size, open_content
+from server.database import DataBase
+from server.job_queue import JobQueue, JobCancelled, BULK
 
 logger = logging.getLogger(__name__)
 
+# Linux ioctl request for cloning file extents (btrfs, xfs with reflink, ocfs2)
+FICLONE = 0x40049409
+
+
+def reflink(src_fd: int, dst_fd: int) -> bool:
+    """Clone file extents of source file into destination file (copy-on-write copy).
+
+    Args:
+        src_fd (int): Source file descriptor,
+        dst_fd (int): Destination file descriptor.
+
+    Returns:
+        Bool, which is True if file is cloned, False if file system does not support cloning.
+
+    """
+
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError as err:
+        if err.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS, errno.EBADF):
+            raise
+        return False
+
+    return True
+
+
+def copy_chunk(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    """Copy chunk of file at current position of destination file.
+
+    Data is copied in kernel space via copy_file_range or sendfile if possible, otherwise via pread and write.
+
+    Args:
+        src_fd (int): Source file descriptor,
+        dst_fd (int): Destination file descriptor,
+        offset (int): Offset in source file,
+        count (int): Max quantity of bytes to copy.
+
+    Returns:
+        Int with quantity of copied bytes, 0 if end of source file is reached.
+
+    """
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            return os.copy_file_range(src_fd, dst_fd, count, offset)
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+
+    if hasattr(os, 'sendfile'):
+        try:
+            return os.sendfile(dst_fd, src_fd, offset, count)
+        except OSError as err:
+            if err.errno not in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+
+    data = os.pread(src_fd, count, offset)
+    view = memoryview(data)
+
+    while view:
+        view = view[os.write(dst_fd, view):]
+
+    return len(data)
+
+
+def inflate_chunk(reader: typing.BinaryIO, dst_fd: int, count: int) -> int:
+    """Decompress chunk of compressed file at current position of destination file.
+
+    Args:
+        reader (BinaryIO): Decompressing reader of source file,
+        dst_fd (int): Destination file descriptor,
+        count (int): Max quantity of decompressed bytes to copy.
+
+    Returns:
+        Int with quantity of copied bytes, 0 if end of source file is reached.
+
+    """
+
+    data = reader.read(count)
+    view = memoryview(data)
+
+    while view:
+        view = view[os.write(dst_fd, view):]
+
+    return len(data)
+
+
+def copy_file(src: str, dst: str, chunk_size: int = None,
+              progress: typing.Callable[[int, int], None] = None) -> int:
+    """Copy file via reflink if file system supports it, otherwise chunk by chunk via copy_chunk. File stored in
+    compressed form is decompressed chunk by chunk.
+
+    Args:
+        src (str): Source file path,
+        dst (str): Destination file path,
+        chunk_size (int): Max quantity of bytes copied by one system call. Optional. Default: LOADER_CHUNK_SIZE,
+        progress (function): Callback called with quantity of copied bytes and file size after every chunk. Exception
+        raised by callback stops copying. Optional.
+
+    Returns:
+        Int with quantity of copied bytes.
+
+    """
+
+    chunk_size = chunk_size or int(os.environ['LOADER_CHUNK_SIZE'])
+    src_fd = os.open(src, os.O_RDONLY)
+
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        reader = None
+
+        try:
+            total = logical_size(src, os.fstat(src_fd))
+
+            if os.pread(src_fd, 2, 0) == GZIP_MAGIC:
+                # compressed file is neither cloned nor copied in kernel space
+                reader = gzip.open(src, 'rb')
+
+            if reader is None and reflink(src_fd, dst_fd):
+                if progress:
+                    progress(total, total)
+                return total
+
+            offset = 0
+
+            while True:
+                if reader is not None:
+                    copied = inflate_chunk(reader, dst_fd, chunk_size)
+                else:
+                    copied = copy_chunk(src_fd, dst_fd, offset, chunk_size)
+
+                if not copied:
+                    return offset
+                offset += copied
+
+                if progress:
+                    progress(offset, total)
+        finally:
+            if reader is not None:
+                reader.close()
+
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
 
 class BaseLoader(Thread):
     """Base file loader class.
@@ -19,15 +174,17 @@ class BaseLoader(Thread):
     """
 
     def __init__(self, daemon: bool = False):
-        pass
+        super(BaseLoader, self).__init__(daemon=daemon)
 
-    def download_file(self, filename: str, is_signed: bool, user_id: int) -> str:
-        """Download file into /home/{user_name}.
+    def download_file(self, filename: str, is_signed: bool, user_id: int,
+                      progress: typing.Callable[[int, int], None] = None) -> str:
+        """Download file into LOADER_HOME_DIR/{user_id}.
 
         Args:
             filename (str): file name,
             is_signed (bool): check or not file signature,
-            user_id (int): user Id.
+            user_id (int): user Id,
+            progress (function): callback for copy progress, see copy_file. Optional.
 
         Returns:
             Str with success message.
@@ -39,36 +196,422 @@ class BaseLoader(Thread):
 
         """
 
-        pass
+        src, dst = self.get_paths(filename, is_signed, user_id)
+
+        try:
+            copied = copy_file(src, dst, progress=progress)
+        except Exception:
+            if os.path.exists(dst):
+                os.remove(dst)
+            raise
+
+        logger.info('File {} ({} bytes) is downloaded into {}'.format(src, copied, dst))
+        return 'File {} is downloaded'.format(os.path.basename(dst))
+
+    @staticmethod
+    def get_source_path(filename: str, is_signed: bool, user_id: int) -> str:
+        """Get path of file in working directory and check its signature.
 
+        Args:
+            filename (str): file name,
+            is_signed (bool): check or not file signature,
+            user_id (int): user Id.
+
+        Returns:
+            Str with source path.
+
+        Raises:
+            AssertionError: if file does not exist, signatures are not match, signature file does not exist.
+
+        """
+
+        file_service = FileServiceSigned() if is_signed else FileService()
+        src = file_service.get_file_path(filename)
+        assert os.path.exists(src), 'File {} does not exist'.format(filename)
+
+        if is_signed:
+            assert file_service.get_file_data(filename, user_id), 'Signatures of file {} are not match'.format(filename)
+
+        return src
+
+    @staticmethod
+    def get_paths(filename: str, is_signed: bool, user_id: int) -> typing.Tuple[str, str]:
+        """Get source path of file in working directory and destination path in LOADER_HOME_DIR/{user_id}.
+
+        Args:
+            filename (str): file name,
+            is_signed (bool): check or not file signature,
+            user_id (int): user Id.
+
+        Returns:
+            Tuple with source and destination paths.
+
+        Raises:
+            AssertionError: if file does not exist, signatures are not match, signature file does not exist, user is
+            not found, destination path is out of home directory.
+
+        """
+
+        src = BaseLoader.get_source_path(filename, is_signed, user_id)
+        session = DataBase().create_session()
 
-class FileLoader(BaseLoader):
-    """Not daemon thread file loader class.
+        try:
+            user = session.query(DataBase.User).get(user_id)
+            assert user, 'User {} is not found'.format(user_id)
+            # user name is neither unique nor safe for path, so directory is named by user Id
+            home_dir = Path(os.environ['LOADER_HOME_DIR']).resolve()
+            user_dir = home_dir / str(user.id)
+        finally:
+            session.close()
+
+        dst = (user_dir / os.path.basename(src)).resolve()
+        assert dst.parent == user_dir and home_dir in user_dir.parents, \
+            'Destination of file {} is out of home directory'.format(filename)
+        user_dir.mkdir(parents=True, exist_ok=True)
+        return src, str(dst)
+
+
+class QueuedLoader(BaseLoader):
+    """Daemon thread file loader class.
+
+    Jobs are taken from durable job queue and acknowledged only after download, so unfinished jobs survive restart.
+    Loader with INTERACTIVE max priority takes only interactive jobs, so they never wait behind bulk transfers.
 
     """
 
-    def __init__(self, filename: str, user_id: int = None, is_signed: bool = False):
-        pass
+    def __init__(self, queue: JobQueue, max_priority: int = BULK):
+        super(QueuedLoader, self).__init__(daemon=True)
+        self.queue = queue
+        self.max_priority = max_priority
 
     def run(self):
         """Run thread.
 
         """
 
-        pass
+        while True:
+            job_id, job = self.queue.get(max_priority=self.max_priority)
 
+            try:
+                self.download_file(job['filename'], job.get('is_signed', False), job.get('user_id'),
+                                   partial(self.queue.progress, job_id))
+            except JobCancelled:
+                logger.info('Download job {} is cancelled'.format(job_id))
+                self.queue.done(job_id)
+            except (AssertionError, ValueError, OSError) as err:
+                logger.error('Download job {} failed: {}'.format(job_id, err))
+                self.queue.failed(job_id, '{}'.format(err))
+            except Exception as err:
+                # unexpected error fails only the job, loader keeps taking jobs
+                logger.exception('Download job {} failed'.format(job_id))
+                self.queue.failed(job_id, '{}: {}'.format(type(err).__name__, err))
+            else:
+                self.queue.done(job_id)
 
-class QueuedLoader(BaseLoader):
-    """Daemon thread file loader class.
+
+class PooledLoader(BaseLoader):
+    """Daemon thread file loader class, which is a worker of loader pool.
 
     """
 
-    def __init__(self, queue: Queue):
-        pass
+    def __init__(self, pool):
+        super(PooledLoader, self).__init__(daemon=True)
+        self.pool = pool
 
     def run(self):
         """Run thread.
 
         """
 
+        while True:
+            future, (filename, is_signed, user_id) = self.pool.tasks.get()
+
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                try:
+                    result = self.download_file(filename, is_signed, user_id)
+                except Exception as err:
+                    future.set_exception(err)
+                else:
+                    future.set_result(result)
+            finally:
+                self.pool.release(user_id)
+                self.pool.tasks.task_done()
+
+
+class LoaderPool:
+    """Fixed-size pool of file loader threads with bounded submission queue and per-user concurrency cap.
+
+    """
+
+    def __init__(self, workers: int, queue_size: int, user_limit: int = 0):
+        self.tasks = Queue(maxsize=queue_size)
+        self.user_limit = user_limit
+        self._lock = Lock()
+        self._user_tasks = {}
+        self.workers = [PooledLoader(self) for _ in range(workers)]
+
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, filename: str, is_signed: bool, user_id: int) -> Future:
+        """Submit file download into pool.
+
+        Args:
+            filename (str): file name,
+            is_signed (bool): check or not file signature,
+            user_id (int): user Id.
+
+        Returns:
+            Future with result of BaseLoader.download_file.
+
+        Raises:
+            Full: if user has too many unfinished downloads or submission queue is full.
+
+        """
+
+        future = Future()
+
+        with self._lock:
+            user_tasks = self._user_tasks.get(user_id, 0)
+
+            if self.user_limit and user_tasks >= self.user_limit:
+                raise Full('Too many downloads for user {}'.format(user_id))
+
+            try:
+                self.tasks.put_nowait((future, (filename, is_signed, user_id)))
+            except Full:
+                raise Full('Loader pool is saturated')
+
+            self._user_tasks[user_id] = user_tasks + 1
+
+        return future
+
+    def release(self, user_id: int):
+        """Release user's download slot.
+
+        Args:
+            user_id (int): user Id.
+
+        """
+
+        with self._lock:
+            user_tasks = self._user_tasks.pop(user_id, 0) - 1
+
+            if user_tasks > 0:
+                self._user_tasks[user_id] = user_tasks
+
+
+class CopyHandle:
+    """Awaitable handle of asynchronous file copy.
+
+    """
+
+    def __init__(self, src: str, dst: str, total: int):
+        self.src = src
+        self.dst = dst
+        self.total = total
+        self.copied = 0
+        self.task = None
+
+    @property
+    def progress(self) -> float:
+        """Copy progress getter.
+
+        Returns:
+            Float with part of copied bytes from 0 to 1.
+
+        """
+
+        return self.copied / self.total if self.total else 1.0
+
+    def done(self) -> bool:
+        """Check if copy is finished, failed or cancelled.
+
+        Returns:
+            Bool, which is True if copy is done.
+
+        """
+
+        return self.task.done()
+
+    def cancel(self) -> bool:
+        """Cancel copy. Partially copied destination file is removed.
+
+        Returns:
+            Bool, which is True if copy is cancelled.
+
+        """
+
+        return self.task.cancel()
+
+    def __await__(self):
+        return self.task.__await__()
+
+
+class AsyncLoader:
+    """Asyncio file loader.
+
+    Every copy runs as asyncio task, which copies file chunk by chunk in shared thread pool, so many concurrent copies
+    are multiplexed onto a few threads and can be cancelled between chunks.
+
+    """
+
+    def __init__(self, workers: int = None, chunk_size: int = None):
+        self.chunk_size = chunk_size or int(os.environ['LOADER_CHUNK_SIZE'])
+        self.executor = ThreadPoolExecutor(max_workers=workers or int(os.environ['ASYNC_LOADER_WORKERS']))
+
+    def copy(self, src: str, dst: str) -> CopyHandle:
+        """Start asynchronous file copy.
+
+        Args:
+            src (str): Source file path,
+            dst (str): Destination file path.
+
+        Returns:
+            CopyHandle, which can be awaited for destination path.
+
+        """
+
+        handle = CopyHandle(src, dst, logical_size(src, os.stat(src)))
+        handle.task = asyncio.ensure_future(self._copy(handle))
+        return handle
+
+    async def download_file(self, filename: str, is_signed: bool, user_id: int) -> CopyHandle:
+        """Start asynchronous download of file into LOADER_HOME_DIR/{user_id}.
+
+        Args:
+            filename (str): file name,
+            is_signed (bool): check or not file signature,
+            user_id (int): user Id.
+
+        Returns:
+            CopyHandle, which can be awaited for destination path.
+
+        Raises:
+            AssertionError: if file does not exist, signatures are not match, signature file does not exist, user is
+            not found, destination path is out of home directory.
+
+        """
+
+        src, dst = await asyncio.get_event_loop().run_in_executor(
+            self.executor, BaseLoader.get_paths, filename, is_signed, user_id)
+        return self.copy(src, dst)
+
+    async def _copy(self, handle: CopyHandle) -> str:
+        src_fd = os.open(handle.src, os.O_RDONLY)
+
+        try:
+            dst_fd = os.open(handle.dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        except BaseException:
+            os.close(src_fd)
+            raise
+
+        chunk = None
+        reader = None
+
+        try:
+            if os.pread(src_fd, 2, 0) == GZIP_MAGIC:
+                reader = gzip.open(handle.src, 'rb')
+            else:
+                chunk = self.executor.submit(reflink, src_fd, dst_fd)
+
+                if await asyncio.wrap_future(chunk):
+                    handle.copied = handle.total
+                    return handle.dst
+
+            while True:
+                if reader is not None:
+                    chunk = self.executor.submit(inflate_chunk, reader, dst_fd, self.chunk_size)
+                else:
+                    chunk = self.executor.submit(copy_chunk, src_fd, dst_fd, handle.copied, self.chunk_size)
+
+                copied = await asyncio.wrap_future(chunk)
+
+                if not copied:
+                    break
+                handle.copied += copied
+        except BaseException:
+            # partial file is removed on cancellation and on any copy error
+            os.remove(handle.dst)
+            raise
+        finally:
+            # descriptors can be closed only after chunk running in executor is finished
+            if chunk is not None and not chunk.done():
+                await asyncio.wait([asyncio.wrap_future(chunk)])
+
+            if reader is not None:
+                reader.close()
+
+            os.close(src_fd)
+            os.close(dst_fd)
+
+        return handle.dst
+
+
+ARCHIVE_FORMATS = {'zip': 'application/zip', 'tar': 'application/x-tar'}
+
+
+def write_archive(paths: typing.List[str], out_file: typing.BinaryIO, archive_format: str = 'zip'):
+    """Write files into archive in streaming mode. Output file is written sequentially and is never sought. Files
+    stored in compressed form are decompressed.
+
+    Args:
+        paths (list): List of file paths,
+        out_file (BinaryIO): Output file-like object, only write method is required,
+        archive_format (str): Archive format, zip or tar. Optional. Default: zip.
+
+    Raises:
+        AssertionError: if archive format is invalid.
+
+    """
+
+    assert archive_format in ARCHIVE_FORMATS, 'Archive format {} is invalid'.format(archive_format)
+
+    if archive_format == 'zip':
+        with zipfile.ZipFile(out_file, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for path in paths:
+                if not is_compressed(path):
+                    archive.write(path, os.path.basename(path))
+                    continue
+
+                info = zipfile.ZipInfo.from_file(path, os.path.basename(path))
+                info.compress_type = zipfile.ZIP_DEFLATED
+                large = logical_size(path, os.stat(path)) >= zipfile.ZIP64_LIMIT
+
+                with open_content(path) as src, archive.open(info, 'w', force_zip64=large) as dst:
+                    shutil.copyfileobj(src, dst)
+    else:
+        with tarfile.open(fileobj=out_file, mode='w|') as archive:
+            for path in paths:
+                if not is_compressed(path):
+                    archive.add(path, os.path.basename(path))
+                    continue
+
+                info = archive.gettarinfo(path, os.path.basename(path))
+                info.size = logical_size(path, os.stat(path))
+
+                with open_content(path) as src:
+                    archive.addfile(info, src)
+
+
+class StreamWriter:
+    """Synchronous file-like adapter for coroutine writer, used for writing from executor threads.
+
+    Every write waits until data is written by coroutine, so slow readers slow down the writer thread.
+
+    """
+
+    def __init__(self, write: typing.Callable[[bytes], typing.Awaitable], loop: asyncio.AbstractEventLoop):
+        self._write = write
+        self._loop = loop
+
+    def write(self, data: bytes) -> int:
+        if data:
+            asyncio.run_coroutine_threadsafe(self._write(bytes(data)), self._loop).result()
+        return len(data)
+
+    def flush(self):
         pass
@@ -3,12 +3,31 @@ __author__ = 'idementyev@luxoft.com'
 __date__ = '2020-09-28'
 
 
+import io
 import os
+import contextlib
+import gzip
+import struct
+import mmap
+import shutil
+import hashlib
 import logging as log
 import typing
+from collections.abc import Mapping
 import server.utils as utils
+import server.metrics as metrics
+import server.tracing as tracing
+from server.content_cache import ContentCache
 from server.crypto import BaseCipher, AESCipher, RSACipher, HashAPI
 
+GZIP_MAGIC = b'\x1f\x8b'
+# gzip trailer keeps size of content modulo 2 ** 32, so larger content
+# is never stored compressed
+GZIP_MAX_SIZE = 1 << 32
+# written to working directory when first compressed file is stored,
+# files are sniffed for compression only if it exists
+COMPRESSED_MARKER = '.compressed'
+
 
 class SingletonType(type):
     def __call__(cls, *args, **kwargs):
@@ -19,16 +38,267 @@ class SingletonType(type):
                 SingletonType, cls).__call__(*args, **kwargs)
             return cls.__instance
 
+    def reset(cls):
+        """Forget instance, so next call creates new one.
+
+        Used in forked worker processes, which must not share
+        state of parent process.
+        """
+        try:
+            del cls.__instance
+        except AttributeError:
+            pass
+
+
+class FileMeta(Mapping):
+    """Compact record with meta info about file.
+
+    Record has no per-instance dict and supports read-only dict-style
+    access, so it can be used in place of meta info dict.
+    """
+    __slots__ = ('name', 'size', 'create_date', 'edit_date')
+
+    def __init__(self, name: str, size: int, create_date, edit_date):
+        self.name = name
+        self.size = size
+        self.create_date = create_date
+        self.edit_date = edit_date
+
+    def __getitem__(self, key: str):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self) -> typing.Iterator[str]:
+        return iter(self.__slots__)
+
+    def __len__(self) -> int:
+        return len(self.__slots__)
+
+    def __repr__(self) -> str:
+        return f'FileMeta({self.to_dict()})'
+
+    def to_dict(self) -> typing.Dict:
+        """Convert record to dict.
+
+        Returns:
+            Dict with meta info about file.
+        """
+        return {_key: getattr(self, _key) for _key in self.__slots__}
+
+
+class FileContent:
+    """Read-only content of file, which is memory-mapped on access.
+
+    File is mapped only while content is read, hashed or streamed, so
+    truncation of file by another writer can not hit idle mapping.
+    Size of file is checked before mapping. Text is decoded only when
+    str() is called.
+    """
+    __slots__ = ('__path', '__size', '__text')
+
+    def __init__(self, path: str, size: int):
+        self.__path = path
+        self.__size = size
+        self.__text = None
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def __getitem__(self, key) -> bytes:
+        with self.mapped() as _view:
+            return bytes(_view[key])
+
+    def __str__(self) -> str:
+        if self.__text is None:
+            self.__text = self.decode()
+        return self.__text
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, str):
+            return str(self) == other
+        return NotImplemented
+
+    @contextlib.contextmanager
+    def mapped(self) -> typing.Iterator[memoryview]:
+        """Map file for the time of with block.
+
+        Returns:
+            Context manager with memoryview of mapping.
+        Raises:
+            AssertionError: if size of file is changed.
+        """
+        with open(self.__path, 'rb') as _fr:
+            assert os.fstat(_fr.fileno()).st_size == self.__size, \
+                f'File {os.path.basename(self.__path)} is changed'
+            _mmap = mmap.mmap(_fr.fileno(), 0, access=mmap.ACCESS_READ)
+        _view = memoryview(_mmap)
+        try:
+            yield _view
+        finally:
+            _view.release()
+            _mmap.close()
+
+    def decode(self) -> str:
+        """Decode content like text-mode read does.
+
+        Returns:
+            Str with content with universal newlines.
+        """
+        with self.mapped() as _view:
+            _text = bytes(_view).decode()
+        if '\r' in _text:
+            _text = _text.replace('\r\n', '\n').replace('\r', '\n')
+        return _text
+
+    def update_hash(self, hash_obj):
+        """Update hash with encoded text content.
+
+        Mapping is hashed without copying if text needs no newline
+        translation, otherwise encoded text is hashed.
+
+        Args:
+            hash_obj: Hash object of hashlib.
+        """
+        with self.mapped() as _view:
+            if _view.obj.find(b'\r') == -1:
+                hash_obj.update(_view)
+                return
+        hash_obj.update(str(self).encode())
+
+    def iter_chunks(self, chunk_size: int = 65536, start: int = 0,
+                    stop: int = None) -> typing.Iterator[bytes]:
+        """Iterate over raw content chunks. File is mapped until
+        iteration is finished.
+
+        Args:
+            chunk_size (int): Max size of chunk in bytes,
+            start (int): Start offset,
+            stop (int): Stop offset. Default: end of content.
+        Returns:
+            Iterator with chunks.
+        Raises:
+            AssertionError: if size of file is changed.
+        """
+        _stop = len(self) if stop is None else min(stop, len(self))
+        with self.mapped() as _view:
+            for _offset in range(start, _stop, chunk_size):
+                yield bytes(_view[_offset:min(_offset + chunk_size, _stop)])
+
+
+def is_compressed(path: str) -> bool:
+    """Check if file is stored in compressed form.
+
+    Args:
+        path (str): Full path of file.
+    Returns:
+        Bool, which is True if file starts with gzip magic number.
+        UTF-8 text never starts with it.
+    """
+    with open(path, 'rb') as _fr:
+        return _fr.read(2) == GZIP_MAGIC
+
+
+def logical_size(path: str, _file_stat: os.stat_result,
+                 compressed: bool = None) -> int:
+    """Get size of file content before compression.
+
+    Args:
+        path (str): Full path of file,
+        _file_stat (stat_result): Result of os.stat of file,
+        compressed (bool): Whether file is compressed. Optional.
+            Default: file is sniffed.
+    Returns:
+        Int with size from gzip trailer for compressed file, size of
+        file otherwise. Trailer size is exact, because content of
+        GZIP_MAX_SIZE or more is not stored compressed.
+    """
+    if compressed is False:
+        return _file_stat.st_size
+    with open(path, 'rb') as _fr:
+        if compressed is None and _fr.read(2) != GZIP_MAGIC:
+            return _file_stat.st_size
+        _fr.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', _fr.read(4))[0]
+
+
+def open_content(path: str, compressed: bool = None) -> typing.BinaryIO:
+    """Open file for reading of its raw content.
+
+    Args:
+        path (str): Full path of file,
+        compressed (bool): Whether file is compressed. Optional.
+            Default: file is sniffed.
+    Returns:
+        Binary file object, which decompresses compressed file in
+        streaming fashion.
+    """
+    if is_compressed(path) if compressed is None else compressed:
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_text(path: str, compressed: bool = None) -> str:
+    """Read text content of file like text-mode read does.
+
+    Compressed file is decompressed in streaming fashion.
+
+    Args:
+        path (str): Full path of file,
+        compressed (bool): Whether file is compressed. Optional.
+            Default: file is sniffed.
+    Returns:
+        Str with file content.
+    """
+    _fr = open(path, 'rb')
+    if compressed is None:
+        compressed = _fr.peek(2)[:2] == GZIP_MAGIC
+    _stream = gzip.GzipFile(fileobj=_fr) if compressed else _fr
+    with _fr, io.TextIOWrapper(_stream) as _ft:
+        return _ft.read()
+
+
+def read_bytes(path: str, compressed: bool = None) -> bytes:
+    """Read raw content of file without newline translation.
+
+    Compressed file is decompressed.
+
+    Args:
+        path (str): Full path of file,
+        compressed (bool): Whether file is compressed. Optional.
+            Default: file is sniffed.
+    Returns:
+        Bytes with file content.
+    """
+    with open_content(path, compressed) as _fr:
+        return _fr.read()
+
 
 class FileService(metaclass=SingletonType):
     """Singleton class with methods for working with file system."""
     __extension = None
     __directory = None
+    __shard_depth = None
 
     # def __init__(self, *args, **kwargs):
     def __init__(self):
         self.__extension = 'txt'
         self.__directory = '.'
+        self.__shard_depth = 0
+        # return raw epoch timestamps formatted lazily in get_files()
+        self.lazy_dates = False
+        self.content_cache = ContentCache(
+            int(os.environ['CONTENT_CACHE_BYTES']))
+        # files of this size and larger are memory-mapped on read
+        self.mmap_threshold = int(os.environ['MMAP_THRESHOLD_BYTES'])
+        # write gzip copy of file on create for compressed responses
+        self.precompress = bool(int(os.environ['PRECOMPRESS_FILES']))
+        # store new files gzip-compressed, compressed files are detected
+        # by magic number, so logical sizes are reported and content is
+        # decompressed even when this mode is off
+        self.compress_storage = bool(int(os.environ['STORAGE_COMPRESSION']))
+        # working directory has marker of compressed files
+        self.__has_compressed = False
 
     @property
     def path(self) -> str:
@@ -56,13 +326,255 @@ class FileService(metaclass=SingletonType):
             raise FileNotFoundError
         else:
             self.__directory = _path
+            self.__has_compressed = os.path.exists(
+                os.path.join(_path, COMPRESSED_MARKER))
+
+    @property
+    def sniff_compressed(self) -> bool:
+        """Check if files have to be sniffed for compression.
+
+        Returns:
+            Bool, which is True if compressed storage is on or working
+            directory has compressed files stored earlier. Otherwise
+            files are known to be plain and are not opened for sniffing.
+        """
+        return self.compress_storage or self.__has_compressed
+
+    def compressed_hint(self) -> typing.Optional[bool]:
+        """Get compression argument for file helpers.
+
+        Returns:
+            None if files have to be sniffed, False if they are plain.
+        """
+        return None if self.sniff_compressed else False
+
+    @property
+    def shard_depth(self) -> int:
+        """Directory fan-out depth getter.
+
+        Returns:
+            Int with quantity of hashed directory levels, 0 for flat layout.
+        """
+        return self.__shard_depth
+
+    @shard_depth.setter
+    def shard_depth(self, value: int):
+        """Directory fan-out depth setter.
+
+        Files are placed into directories named after pairs of hex
+        digits of filename hash, e.g. ab/cd/<name>.txt for depth 2.
+        Files left in flat layout are still found, see migrate_layout().
+
+        Args:
+            value (int): Quantity of hashed directory levels, 0..4.
+        Raises:
+            ValueError: if depth is invalid.
+        """
+        if not 0 <= int(value) <= 4:
+            raise ValueError(f'Shard depth {value} is invalid')
+        self.__shard_depth = int(value)
+
+    def _shard_dir(self, _file: str) -> str:
+        """Get directory of file in sharded layout.
+
+        Args:
+            _file (str): Filename with file extension(s).
+        Returns:
+            Str with full path of directory.
+        """
+        _name = _file.split('.', 1)[0]
+        _hash = hashlib.md5(_name.encode()).hexdigest()
+        return os.path.join(self.path, *(_hash[2 * _i:2 * _i + 2]
+                                         for _i in range(self.__shard_depth)))
+
+    def _locate(self, _file: str) -> str:
+        """Get full path of existing file in sharded or flat layout.
+
+        Args:
+            _file (str): Filename with file extension(s).
+        Returns:
+            Str with full path of file, path in current layout if file
+            does not exist.
+        """
+        _path = os.path.join(self._shard_dir(_file), _file)
+        if self.__shard_depth and not os.path.exists(_path):
+            _flat_path = os.path.join(self.path, _file)
+            if os.path.exists(_flat_path):
+                return _flat_path
+        return _path
+
+    def get_file_path(self, filename: str) -> str:
+        """Get full path of file in working directory.
+
+        Args:
+            filename (str): Filename without .txt file extension.
+        Returns:
+            Str with full path of file.
+        """
+        return self._locate(f'{filename}.{self.__extension}')
+
+    def get_signature_path(self, filename: str) -> str:
+        """Get full path of .md5 signature file.
+
+        Args:
+            filename (str): Filename without .txt file extension.
+        Returns:
+            Str with full path of signature file.
+        """
+        return self._locate(f'{filename}.{self.__extension}.md5')
+
+    def get_compressed_path(self, filename: str) -> str:
+        """Get full path of precompressed .gz copy of file.
+
+        Args:
+            filename (str): Filename without .txt file extension.
+        Returns:
+            Str with full path of compressed file.
+        """
+        return self._locate(f'{filename}.{self.__extension}.gz')
+
+    def write_compressed(self, filename: str) -> str:
+        """Write precompressed .gz copy of file.
+
+        Copy is written to temporary file and renamed, so readers never
+        see partial copy.
+
+        Args:
+            filename (str): Filename without .txt file extension.
+        Returns:
+            Str with full path of compressed file.
+        Raises:
+            FileNotFoundError: if file does not exist.
+        """
+        _gz_path = self.get_compressed_path(filename)
+        _tmp_path = f'{_gz_path}.tmp'
+        with open(self.get_file_path(filename), 'rb') as _fr, \
+                gzip.open(_tmp_path, 'wb', compresslevel=9) as _fw:
+            shutil.copyfileobj(_fr, _fw)
+        os.replace(_tmp_path, _gz_path)
+        return _gz_path
+
+    def get_compressed_file(self, filename: str) -> typing.Optional[str]:
+        """Get path of precompressed copy of file if it is up to date.
+
+        Args:
+            filename (str): Filename without .txt file extension.
+        Returns:
+            Str with full path of compressed file or None if there is
+            no copy or file was modified after copy was written. File
+            itself is returned if it is stored in compressed form.
+        """
+        _file_path = self.get_file_path(filename)
+        _gz_path = self.get_compressed_path(filename)
+        try:
+            _file_stat = os.stat(_file_path)
+            if not os.path.exists(_gz_path):
+                # only files without copy are sniffed, copy is never
+                # written for file stored in compressed form
+                return _file_path if self.sniff_compressed and \
+                    is_compressed(_file_path) else None
+            _gz_stat = os.stat(_gz_path)
+        except FileNotFoundError:
+            return None
+        if _gz_stat.st_mtime_ns < _file_stat.st_mtime_ns:
+            return None
+        return _gz_path
+
+    @tracing.traced
+    def get_file_etag(self, filename: str) -> typing.Tuple[str, float]:
+        """Get strong entity tag and modification time of file.
+
+        Tag is derived from file identity (inode, modification time and
+        size), file content is not read.
+
+        Args:
+            filename (str): Filename without .txt file extension.
+        Returns:
+            Tuple with quoted entity tag and modification timestamp.
+        Raises:
+            FileNotFoundError: if file does not exist.
+        """
+        _file_stat = os.stat(self.get_file_path(filename))
+        _identity = ContentCache.identity(_file_stat)
+        return '"{:x}-{:x}-{:x}"'.format(*_identity), _file_stat.st_mtime
+
+    def iter_files(self) -> typing.Iterator[str]:
+        """Iterate over full paths of all files in working directory.
+
+        Both flat and sharded layouts are scanned.
+
+        Returns:
+            Iterator with full paths of files with .txt extension.
+        """
+        _stack = [(self.__directory, 0)]
+        while _stack:
+            _dir, _level = _stack.pop()
+            with os.scandir(_dir) as _entries:
+                for _entry in _entries:
+                    if _entry.is_file():
+                        if _entry.name.endswith(f'.{self.__extension}'):
+                            yield _entry.path
+                    elif (_level < self.__shard_depth and len(_entry.name) == 2
+                          and _entry.is_dir()):
+                        _stack.append((_entry.path, _level + 1))
+
+    def migrate_file(self, filename: str) -> bool:
+        """Move file, its signature and compressed copy from flat to sharded layout.
+
+        Files are moved with atomic rename, so readers find file in
+        either layout during migration.
+
+        Args:
+            filename (str): Filename without .txt file extension.
+        Returns:
+            Bool, which is True if file is moved.
+        """
+        _moved = False
+        _file = f'{filename}.{self.__extension}'
+        _dir = self._shard_dir(_file)
+        for _f in (_file, f'{_file}.md5', f'{_file}.gz'):
+            _flat_path = os.path.join(self.path, _f)
+            if _dir != self.path and os.path.exists(_flat_path):
+                self.content_cache.invalidate(_flat_path)
+                os.makedirs(_dir, exist_ok=True)
+                os.rename(_flat_path, os.path.join(_dir, _f))
+                _moved = True
+        return _moved
+
+    @metrics.timed(metrics.FILE_SERVICE_SECONDS)
+    @tracing.traced
+    def migrate_layout(self) -> int:
+        """Move all files from flat to sharded layout online.
+
+        Returns:
+            Int with quantity of moved files.
+        """
+        _moved = 0
+        with os.scandir(self.__directory) as _entries:
+            _names = [_e.name for _e in _entries if _e.is_file()
+                      and _e.name.endswith(f'.{self.__extension}')]
+        for _f in _names:
+            _filename, _ = os.path.splitext(_f)
+            if self.migrate_file(_filename):
+                _moved += 1
+        log.info(f'{_moved} files moved to sharded layout.')
+        return _moved
 
     @staticmethod
-    def get_file_meta(_file):
+    def get_file_meta(_file, lazy_dates: bool = False,
+                      _file_stat: os.stat_result = None,
+                      compressed: bool = None):
         """Get meta info about file.
 
         Args:
-            _file (str): Filename with file extension.
+            _file (str): Filename with file extension,
+            lazy_dates (bool): Return dates as utils.Timestamp, which
+                is raw epoch number formatted only when converted to
+                string,
+            _file_stat (stat_result): Result of os.stat if file is
+                already stat'ed,
+            compressed (bool): Whether file is compressed. Optional.
+                Default: file is sniffed.
         Returns:
             _file_data (dict): Meta info about file.
             Keys:
@@ -77,16 +589,51 @@ class FileService(metaclass=SingletonType):
         _file_data = {}
 
         try:
-            _file_stat = os.stat(_file)
+            _file_stat = _file_stat or os.stat(_file)
             _file_data['name'] = os.path.basename(_file)
-            _file_data['size'] = _file_stat.st_size
-            _file_data['create_date'] = utils.convert_date(_file_stat.st_ctime)
-            _file_data['edit_date'] = utils.convert_date(_file_stat.st_mtime)
+            _file_data['size'] = logical_size(_file, _file_stat, compressed)
+            if lazy_dates:
+                _file_data['create_date'] = utils.Timestamp(_file_stat.st_ctime)
+                _file_data['edit_date'] = utils.Timestamp(_file_stat.st_mtime)
+            else:
+                _file_data['create_date'] = utils.convert_date(_file_stat.st_ctime)
+                _file_data['edit_date'] = utils.convert_date(_file_stat.st_mtime)
         except FileNotFoundError as _e:
             log.error(f'File {_file} does not exist')
 
         return _file_data
 
+    @staticmethod
+    def get_file_record(_file, lazy_dates: bool = False,
+                        compressed: bool = None):
+        """Get meta info about file as compact record.
+
+        Args:
+            _file (str): Filename with file extension,
+            lazy_dates (bool): Return dates as utils.Timestamp,
+            compressed (bool): Whether file is compressed. Optional.
+                Default: file is sniffed.
+        Returns:
+            FileMeta record or None if file does not exist.
+        """
+        try:
+            _file_stat = os.stat(_file)
+            _size = logical_size(_file, _file_stat, compressed)
+        except FileNotFoundError as _e:
+            log.error(f'File {_file} does not exist')
+            return None
+
+        if lazy_dates:
+            _create_date = utils.Timestamp(_file_stat.st_ctime)
+            _edit_date = utils.Timestamp(_file_stat.st_mtime)
+        else:
+            _create_date = utils.convert_date(_file_stat.st_ctime)
+            _edit_date = utils.convert_date(_file_stat.st_mtime)
+        return FileMeta(os.path.basename(_file), _size,
+                        _create_date, _edit_date)
+
+    @metrics.timed(metrics.FILE_SERVICE_SECONDS)
+    @tracing.traced
     def get_file_data(self, filename: str, user_id: int = None) -> typing.Dict:
         """Get full info about file with content.
 
@@ -107,14 +654,34 @@ class FileService(metaclass=SingletonType):
         """
         log.debug('unhashed get_file_data')
         _file = f'{filename}.{self.__extension}'
-        _file_full_path = os.path.join(self.path, _file)
-        _file_content = None
-        _file_data_dict = self.get_file_meta(_file_full_path)
+        _file_full_path = self.get_file_path(filename)
+        try:
+            _file_stat = os.stat(_file_full_path)
+        except FileNotFoundError:
+            log.error(f'File {_file} does not exist')
+            raise
+        # file is sniffed once, result is reused for size and content
+        _compressed = self.sniff_compressed and is_compressed(
+            _file_full_path)
+        _file_data_dict = self.get_file_meta(_file_full_path,
+                                             _file_stat=_file_stat,
+                                             compressed=_compressed)
 
-        # no checks here because get_file_meta() already has them.
-        with open(_file_full_path, 'r') as _fr:
-            _file_content = _fr.read()
+        _file_content = self.content_cache.get(_file_full_path, _file_stat)
+        if _file_content is None and _file_stat.st_size >= max(
+                self.mmap_threshold, 1) and not _compressed:
+            with tracing.span('FileService.map_content'):
+                _file_content = FileContent(_file_full_path,
+                                            _file_stat.st_size)
+            metrics.FILE_READ_BYTES.inc(_file_stat.st_size)
+            log.debug(f'Data mapped from {_file} successfully.')
+        elif _file_content is None:
+            with tracing.span('FileService.read_content'):
+                _file_content = read_text(_file_full_path, _compressed)
+            metrics.FILE_READ_BYTES.inc(_file_stat.st_size)
             log.debug(f'Data read from {_file} successfully.')
+            self.content_cache.put(_file_full_path, _file_stat, _file_content,
+                                   _file_data_dict['size'])
         _file_data_dict['content'] = _file_content
         log.debug(f'unhashed _file_data_dict: {_file_data_dict}')
         log.debug('unhashed get_file_data leave')
@@ -141,38 +708,40 @@ class FileService(metaclass=SingletonType):
         """
         pass
 
-    def get_files(self) -> typing.List[typing.Dict[str, str]]:
+    @metrics.timed(metrics.FILE_SERVICE_SECONDS)
+    @tracing.traced
+    def get_files(self) -> typing.List[FileMeta]:
         """Get info about all files in working directory.
 
         Returns:
-            List of dicts, which contains info about each file. Keys:
+            List of FileMeta records, which contains info about each
+            file. Keys:
                 name (str): name of file with .txt extension.
                 create_date (str): date of file creation.
                 edit_date (str): date of last file modification.
                 size (str): size of file in bytes.
         """
         _files_list = []
+        _compressed = self.compressed_hint()
 
-        for _r, _d, _files in os.walk(self.__directory):
-            for _f in _files:
-                _, _f_ext = os.path.splitext(_f)
-                if _f_ext == f'.{self.__extension}':
-                    _meta_file = os.path.join(self.__directory, _f)
-                    _meta_dict = self.get_file_meta(_meta_file)
-                    _files_list.append(_meta_dict)
-            # only 1st level
-            break
+        for _meta_file in self.iter_files():
+            _meta = self.get_file_record(_meta_file, self.lazy_dates,
+                                         _compressed)
+            if _meta is not None:
+                _files_list.append(_meta)
 
         return _files_list
 
     # async def create_file(self, content: str = None,
+    @metrics.timed(metrics.FILE_SERVICE_SECONDS)
+    @tracing.traced
     def create_file(self, content: str = None,
                     security_level: str = None,
                     user_id: int = None) -> typing.Dict:
         """Create new .txt file.
 
-        Method generates name of file from random string with digits
-        and latin letters.
+        Method generates name of file from unique time-ordered string
+        with digits and latin letters.
 
         Args:
             content (str): String with file content,
@@ -190,24 +759,46 @@ class FileService(metaclass=SingletonType):
             ValueError: if security level is invalid.
         """
         log.debug('unhashed create_file')
-        _file_name = utils.generate_string()
-        _file = f'{_file_name}.{self.__extension}'
-        _file_full_path = os.path.join(self.path, _file)
-
-        # check for existing files with recursion
-        while os.path.exists(_file_full_path):
-            log.info(f'File with name {_file} exists, regenerating name.')
-            _file_data = self.create_file(content, security_level)
-            return _file_data
+
+        # exclusive creation: name is regenerated only on real collision
+        while True:
+            _file_name = utils.generate_id()
+            _file = f'{_file_name}.{self.__extension}'
+            _file_dir = self._shard_dir(_file)
+            _file_full_path = os.path.join(_file_dir, _file)
+            os.makedirs(_file_dir, exist_ok=True)
+            self.content_cache.invalidate(_file_full_path)
+            try:
+                _fd = os.open(_file_full_path,
+                              os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                log.info(f'File {_file_full_path} exists, regenerating name.')
+            else:
+                break
+
+        _content = (content if content else '').encode()
+        if self.compress_storage and len(_content) < GZIP_MAX_SIZE:
+            if not self.__has_compressed:
+                open(os.path.join(self.path, COMPRESSED_MARKER), 'a').close()
+                self.__has_compressed = True
+            with open(_fd, 'wb') as _of, \
+                    gzip.GzipFile(fileobj=_of, mode='wb', mtime=0) as _gz:
+                _gz.write(_content)
+                log.info(f'Compressed data written to file {_file_full_path}')
         else:
-            with open(_file_full_path, 'w') as _of:
+            with open(_fd, 'w') as _of:
                 _of.write(content if content else '')
-                log.info(f'Data written to file {_file}')
-            _file_data = FileService.get_file_data(self, _file_name)
-            log.debug(f'unhashed _file_data: {_file_data}')
-            log.debug('unhashed create_file leave')
-            return _file_data
+                log.info(f'Data written to file {_file_full_path}')
+        metrics.FILE_WRITTEN_BYTES.inc(os.path.getsize(_file_full_path))
+        if self.precompress and not self.compress_storage:
+            self.write_compressed(_file_name)
+        _file_data = FileService.get_file_data(self, _file_name)
+        log.debug(f'unhashed _file_data: {_file_data}')
+        log.debug('unhashed create_file leave')
+        return _file_data
 
+    @metrics.timed(metrics.FILE_SERVICE_SECONDS)
+    @tracing.traced
     def delete_file(self, filename: str):
         """Delete file.
 
@@ -219,7 +810,9 @@ class FileService(metaclass=SingletonType):
             AssertionError: if file does not exist.
         """
         _file = f'{filename}.{self.__extension}'
-        _file_full_path = os.path.join(self.path, _file)
+        _file_full_path = self.get_file_path(filename)
+        _gz_full_path = self.get_compressed_path(filename)
+        self.content_cache.invalidate(_file_full_path)
 
         try:
             os.remove(_file_full_path)
@@ -228,6 +821,8 @@ class FileService(metaclass=SingletonType):
             return None
         else:
             log.info(f'File {_file} removed successfully.')
+        if os.path.exists(_gz_full_path):
+            os.remove(_gz_full_path)
         return _file_full_path
 
     @staticmethod
@@ -254,6 +849,8 @@ class FileServiceSigned(FileService):
     def __init__(self):
         super(FileServiceSigned, self).__init__()
 
+    @metrics.timed(metrics.FILE_SERVICE_SECONDS)
+    @tracing.traced
     def get_file_data(
             self, filename: str, user_id: int = None) -> typing.Dict:
         """Get full info about file.
@@ -277,10 +874,10 @@ class FileServiceSigned(FileService):
         log.debug('..hashed get_file_data')
         _file_data = super(FileServiceSigned, self).get_file_data(filename, user_id)
         log.debug(f'..hashed _file_data: {_file_data}')
-        md5_file_name = f"{_file_data['name']}.md5"
+        md5_file_name = self.get_signature_path(filename)
 
         if os.path.exists(md5_file_name):
-            hashed_data = HashAPI.hash_md5('__'.join(map(str, _file_data.values())))
+            hashed_data = HashAPI.hash_md5_parts(_file_data.values())
             with open(md5_file_name) as md5file:
                 if hashed_data == md5file.read():
                     return _file_data
@@ -313,14 +910,34 @@ class FileServiceSigned(FileService):
         """
         pass
 
+    @tracing.traced
+    def get_file_etag(self, filename: str) -> typing.Tuple[str, float]:
+        """Get strong entity tag and modification time of file.
+
+        Tag is derived from signature and file identity, file content
+        is not read.
+
+        Args:
+            filename (str): Filename without .txt file extension.
+        Returns:
+            Tuple with quoted entity tag and modification timestamp.
+        Raises:
+            FileNotFoundError: if file or signature file does not exist.
+        """
+        _etag, _mtime = super(FileServiceSigned, self).get_file_etag(filename)
+        with open(self.get_signature_path(filename)) as md5file:
+            return f'"{md5file.read().strip()}-{_etag[1:]}', _mtime
+
     # async def create_file(self, content: str = None,
+    @metrics.timed(metrics.FILE_SERVICE_SECONDS)
+    @tracing.traced
     def create_file(self, content: str = None,
                     security_level: str = None,
                     user_id: int = None) -> typing.Dict:
         """Create new .txt file with signature file.
 
-        Method generates name of file from random string with digits
-        and latin letters.
+        Method generates name of file from unique time-ordered string
+        with digits and latin letters.
 
         Args:
             content (str): String with file content,
@@ -340,14 +957,37 @@ class FileServiceSigned(FileService):
         log.debug('..hashed create_file')
         created_dict = super(FileServiceSigned, self).create_file(content, security_level, user_id)
         log.debug(f'created_dict: {created_dict}')
-        hashed_data = HashAPI.hash_md5('__'.join(map(str, created_dict.values())))
+        hashed_data = HashAPI.hash_md5_parts(created_dict.values())
 
-        md5_file_name = f"{created_dict['name']}.md5"
+        created_file, _ = os.path.splitext(created_dict['name'])
+        md5_file_name = self.get_signature_path(created_file)
 
         with open(md5_file_name, 'w') as md5_file:
             md5_file.write(hashed_data)
         return created_dict
 
+    def migrate_file(self, filename: str) -> bool:
+        """Move file and its signature from flat to sharded layout.
+
+        Rename changes ctime of file, which is a part of signed data,
+        so files with valid signatures are signed again after move.
+
+        Args:
+            filename (str): Filename without .txt file extension.
+        Returns:
+            Bool, which is True if file is moved.
+        """
+        _is_valid = bool(self.get_file_data(filename))
+        _moved = super(FileServiceSigned, self).migrate_file(filename)
+        if _moved and _is_valid:
+            _file_data = FileService.get_file_data(self, filename)
+            hashed_data = HashAPI.hash_md5_parts(_file_data.values())
+            with open(self.get_signature_path(filename), 'w') as md5_file:
+                md5_file.write(hashed_data)
+        return _moved
+
+    @metrics.timed(metrics.FILE_SERVICE_SECONDS)
+    @tracing.traced
     def delete_file(self, filename: str):
         """Delete file.
 
@@ -358,10 +998,10 @@ class FileServiceSigned(FileService):
         Raises:
             AssertionError: if file does not exist.
         """
+        md5_file_name = self.get_signature_path(filename)
         returned_string = super(FileServiceSigned, self).delete_file(filename)
 
         if returned_string:
-            md5_file_name = f"{returned_string}.md5"
             try:
                 os.remove(md5_file_name)
             except FileNotFoundError as _e:
@@ -120,8 +120,8 @@ def get_files(_directory=None):
 def create_file(content=None, security_level=None):
     """Create new .txt file.
 
-    Method generates name of file from random string with digits
-    and latin letters.
+    Method generates name of file from unique time-ordered string
+    with digits and latin letters.
 
     Args:
         content (str): String with file content,
@@ -138,20 +138,22 @@ def create_file(content=None, security_level=None):
         AssertionError: if user_id is not set.
         ValueError: if security level is invalid.
     """
-    _file_name = utils.generate_string()
-    _file = f'{_file_name}.{extension}'
-
-    # check for existing files with recursion
-    while os.path.exists(_file):
-        log.info(f'File with name {_file} exists, regenerating name.')
-        _file_data = create_file(content, security_level)
-        return _file_data
-    else:
-        with open(_file, 'w') as _of:
-            _of.write(content if content else '')
-            log.info(f'Data written to file {_file}')
-        _file_data = get_file_data(_file_name)
-        return _file_data
+    # exclusive creation: name is regenerated only on real collision
+    while True:
+        _file_name = utils.generate_id()
+        _file = f'{_file_name}.{extension}'
+        try:
+            _fd = os.open(_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            log.info(f'File with name {_file} exists, regenerating name.')
+        else:
+            break
+
+    with open(_fd, 'w') as _of:
+        _of.write(content if content else '')
+        log.info(f'Data written to file {_file}')
+    _file_data = get_file_data(_file_name)
+    return _file_data
 
 
 def delete_file(filename):
@@ -1,25 +1,188 @@
 # Copyright 2019 by Kirill Kanin.
 # All rights reserved.
 
-import json
+import os
+import asyncio
+import contextlib
+import concurrent.futures
+from functools import partial
+from email.utils import formatdate
 from aiohttp import web
-from queue import Queue
+from queue import Full
 from distutils.util import strtobool
-from server.file_service import FileService, FileServiceSigned
-from server.file_loader import FileLoader, QueuedLoader
+import server.utils as utils
+import server.compression as compression
+import server.tracing as tracing
+from server.file_service import FileService, FileServiceSigned, FileContent, read_bytes
+from server.file_loader import QueuedLoader, LoaderPool, AsyncLoader, BaseLoader, StreamWriter, \
+    write_archive, ARCHIVE_FORMATS
+from server.job_queue import JobQueue, PRIORITIES, INTERACTIVE
+from server.offload import OffloadService, OffloadFull
 from server.users import UsersAPI
 from server.role_model import RoleModel
 from server.users_sql import UsersSQLAPI
 from server.role_model_sql import RoleModelSQL
 
+STREAM_CHUNK_SIZE = 65536
+# methods of visitor role, which is role of signed up users
+VISITOR_METHODS = ('get_files', 'get_file_info', 'get_file_content', 'create_file', 'delete_file', 'download_file',
+                   'download_file_async', 'download_files', 'download_file_queued', 'get_download_job',
+                   'cancel_download_job')
+
 
 class Handler:
     """Aiohttp handler with coroutines.
 
+    JSON responses are serialized with dumps function, which can be replaced, e.g. with json.dumps.
+
     """
 
+    dumps = staticmethod(utils.json_dumps)
+
+    @staticmethod
+    def not_modified(request: web.Request, etag: str, last_modified: float) -> bool:
+        """Check conditional request headers. If-None-Match has precedence over If-Modified-Since.
+
+        Args:
+            request (Request): aiohttp request,
+            etag (str): Quoted entity tag of resource,
+            last_modified (float): Modification timestamp of resource.
+
+        Returns:
+            Bool, which is True if client has actual version of resource.
+
+        """
+
+        if_none_match = request.headers.get('If-None-Match')
+
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            tags = [compression.decoded_etag(tag[2:] if tag.startswith('W/') else tag) for tag in tags]
+            return '*' in tags or etag in tags
+
+        if_modified_since = request.if_modified_since
+        return if_modified_since is not None and int(last_modified) <= if_modified_since.timestamp()
+
+    async def check_not_modified(self, request: web.Request, file_service: FileService, filename: str):
+        """Get validators of file and raise 304 if client has actual version of file. File content is not read.
+
+        Args:
+            request (Request): aiohttp request,
+            file_service (FileService): File service,
+            filename (str): Filename without .txt file extension.
+
+        Returns:
+            Dict with ETag and Last-Modified headers.
+
+        Raises:
+            HTTPNotModified: 304 HTTP status, if file is not modified,
+            HTTPBadRequest: 400 HTTP error, if file does not exist.
+
+        """
+
+        try:
+            etag, last_modified = await asyncio.get_event_loop().run_in_executor(
+                None, tracing.bind(file_service.get_file_etag), filename)
+        except FileNotFoundError:
+            raise web.HTTPBadRequest(text='File {} does not exist'.format(filename))
+
+        headers = {'ETag': etag, 'Last-Modified': formatdate(last_modified, usegmt=True)}
+
+        if self.not_modified(request, etag, last_modified):
+            raise web.HTTPNotModified(headers=headers)
+
+        return headers
+
+    @classmethod
+    @tracing.traced
+    async def json_response(cls, request: web.Request, data, headers: dict = None,
+                            offload: OffloadService = None) -> web.Response:
+        """Make JSON response compressed with encoding negotiated by Accept-Encoding header.
+
+        Small bodies are sent as is, large bodies are compressed in executor, so event loop is not blocked.
+
+        Args:
+            request (Request): aiohttp request,
+            data: Data for JSON serialization,
+            headers (dict): Response headers. Optional,
+            offload (OffloadService): Offload service for compression of large bodies. Optional. Default: loop
+                default executor.
+
+        Returns:
+            Response: JSON response.
+
+        """
+
+        body = cls.dumps(data).encode()
+        headers = dict(headers or {})
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = None
+
+        if len(body) >= int(os.environ['COMPRESSION_MIN_BYTES']):
+            encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+
+        if encoding and offload and len(body) >= int(os.environ['COMPRESSION_EXECUTOR_BYTES']):
+            body = await offload.run('compress', compression.compress, body, encoding)
+        elif encoding:
+            body = await compression.compress_async(body, encoding)
+
+        if encoding:
+            headers['Content-Encoding'] = encoding
+
+            if 'ETag' in headers:
+                headers['ETag'] = compression.encoded_etag(headers['ETag'], encoding)
+
+        return web.Response(body=body, content_type='application/json', headers=headers)
+
     def __init__(self, path: str):
-        pass
+        self.queue = JobQueue(os.environ['LOADER_QUEUE_PATH'], int(os.environ['LOADER_QUEUE_SIZE']))
+        self.loaders = [QueuedLoader(self.queue) for _ in range(int(os.environ['LOADER_WORKERS']))]
+        self.loaders += [QueuedLoader(self.queue, INTERACTIVE)
+                         for _ in range(int(os.environ['LOADER_INTERACTIVE_WORKERS']))]
+
+        for loader in self.loaders:
+            loader.start()
+
+        self.loader_pool = LoaderPool(int(os.environ['LOADER_POOL_SIZE']), int(os.environ['LOADER_POOL_QUEUE_SIZE']),
+                                      int(os.environ['LOADER_USER_CONCURRENCY']))
+        self.async_loader = AsyncLoader()
+        self.offload = OffloadService()
+
+    async def read_file_data(self, file_service: FileService, filename: str, user_id: int = None) -> dict:
+        """Read file data out of event loop. Signed files are read in hash category of offload service, because
+        signatures are checked.
+
+        Args:
+            file_service (FileService): File service,
+            filename (str): Filename without .txt file extension,
+            user_id (int): User Id. Optional.
+
+        Returns:
+            Dict with full info about file.
+
+        Raises:
+            HTTPBadRequest: 400 HTTP error, if file does not exist or signatures are not match,
+            HTTPTooManyRequests: 429 HTTP error, if too many files are being checked,
+            HTTPGatewayTimeout: 504 HTTP error, if file is not checked in time.
+
+        """
+
+        try:
+            if isinstance(file_service, FileServiceSigned):
+                file_data = await self.offload.run('hash', file_service.get_file_data, filename, user_id)
+            else:
+                file_data = await asyncio.get_event_loop().run_in_executor(
+                    None, tracing.bind(file_service.get_file_data), filename, user_id)
+
+            assert file_data, 'Signatures of file {} are not match'.format(filename)
+        except (AssertionError, FileNotFoundError) as err:
+            raise web.HTTPBadRequest(text='{}'.format(err))
+        except OffloadFull as err:
+            raise web.HTTPTooManyRequests(text='{}'.format(err))
+        except asyncio.TimeoutError:
+            raise web.HTTPGatewayTimeout(text='File {} is not checked in time'.format(filename))
+
+        return file_data
 
     async def handle(self, request: web.Request, *args, **kwargs) -> web.Response:
         """Basic coroutine for connection testing.
@@ -32,14 +195,16 @@ class Handler:
 
         """
 
-        pass
+        return web.json_response({'status': 'success'}, dumps=self.dumps)
 
     @UsersAPI.authorized
     @RoleModel.role_model
     # @UsersSQLAPI.authorized
     # @RoleModelSQL.role_model
+    @tracing.traced
     async def get_files(self, request: web.Request, *args, **kwargs) -> web.Response:
-        """Coroutine for getting info about all files in working directory.
+        """Coroutine for getting info about all files in working directory. Response is compressed if client
+        accepts it.
 
         Args:
             request (Request): aiohttp request.
@@ -49,15 +214,20 @@ class Handler:
 
         """
 
-        pass
+        data = await asyncio.get_event_loop().run_in_executor(None, tracing.bind(FileService().get_files))
+        return await self.json_response(request, {'status': 'success', 'data': data}, offload=self.offload)
 
     @UsersAPI.authorized
     @RoleModel.role_model
     # @UsersSQLAPI.authorized
     # @RoleModelSQL.role_model
+    @tracing.traced
     async def get_file_info(self, request: web.Request, *args, **kwargs) -> web.Response:
         """Coroutine for getting full info about file in working directory.
 
+        Conditional requests with If-None-Match or If-Modified-Since headers are answered with 304 without reading
+        the file. Response is compressed if client accepts it.
+
         Args:
             request (Request): aiohttp request, contains filename and is_signed parameters.
 
@@ -65,11 +235,123 @@ class Handler:
             Response: JSON response with success status and data or error status and error message.
 
         Raises:
-            HTTPBadRequest: 400 HTTP error, if error.
+            HTTPBadRequest: 400 HTTP error, if error,
+            HTTPNotModified: 304 HTTP status, if file is not modified,
+            HTTPTooManyRequests: 429 HTTP error, if too many signed files are being checked,
+            HTTPGatewayTimeout: 504 HTTP error, if signed file is not checked in time.
 
         """
 
-        pass
+        filename = request.match_info.get('filename', request.rel_url.query.get('filename'))
+        is_signed = request.rel_url.query.get('is_signed', 'false')
+
+        try:
+            assert filename, 'Filename is not set'
+            file_service = FileServiceSigned() if strtobool(is_signed) else FileService()
+        except (AssertionError, ValueError) as err:
+            raise web.HTTPBadRequest(text='{}'.format(err))
+
+        headers = await self.check_not_modified(request, file_service, filename)
+
+        file_data = await self.read_file_data(file_service, filename, kwargs.get('user_id'))
+
+        return await self.json_response(request, {'status': 'success', 'data': file_data}, headers, self.offload)
+
+    @UsersAPI.authorized
+    @RoleModel.role_model
+    # @UsersSQLAPI.authorized
+    # @RoleModelSQL.role_model
+    @tracing.traced
+    async def get_file_content(self, request: web.Request, *args, **kwargs) -> web.StreamResponse:
+        """Coroutine for streaming content of file in working directory. Supports single range in Range header.
+
+        Raw bytes of file are sent without newline translation. Large files are memory-mapped only while they are
+        streamed, so whole file is never read into memory. Precompressed copy of file is sent instead if it is up to
+        date and client accepts gzip.
+
+        Args:
+            request (Request): aiohttp request, contains filename and is_signed parameters.
+
+        Returns:
+            StreamResponse: file content, partial content for range request.
+
+        Raises:
+            HTTPBadRequest: 400 HTTP error, if error or file is changed while it is read,
+            HTTPNotModified: 304 HTTP status, if file is not modified,
+            HTTPRequestRangeNotSatisfiable: 416 HTTP error, if range is invalid,
+            HTTPTooManyRequests: 429 HTTP error, if too many signed files are being checked,
+            HTTPGatewayTimeout: 504 HTTP error, if signed file is not checked in time.
+
+        """
+
+        filename = request.match_info.get('filename', request.rel_url.query.get('filename'))
+        is_signed = request.rel_url.query.get('is_signed', 'false')
+
+        try:
+            assert filename, 'Filename is not set'
+            file_service = FileServiceSigned() if strtobool(is_signed) else FileService()
+        except (AssertionError, ValueError) as err:
+            raise web.HTTPBadRequest(text='{}'.format(err))
+
+        headers = await self.check_not_modified(request, file_service, filename)
+
+        file_data = await self.read_file_data(file_service, filename, kwargs.get('user_id'))
+
+        if 'Range' not in request.headers and compression.accepts(request.headers.get('Accept-Encoding'), 'gzip'):
+            gz_path = file_service.get_compressed_file(filename)
+
+            if gz_path:
+                with open(gz_path, 'rb') as gz_file:
+                    body = await asyncio.get_event_loop().run_in_executor(None, gz_file.read)
+
+                headers['ETag'] = compression.encoded_etag(headers['ETag'], 'gzip')
+                headers.update({'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+                return web.Response(body=body, content_type='text/plain', charset='utf-8', headers=headers)
+
+        content = file_data['content']
+
+        if not isinstance(content, FileContent):
+            # text content has translated newlines, so raw bytes are sent like for mapped content
+            content = await asyncio.get_event_loop().run_in_executor(
+                None, read_bytes, file_service.get_file_path(filename), file_service.compressed_hint())
+
+        size = len(content)
+
+        try:
+            http_range = request.http_range
+        except ValueError:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': 'bytes */{}'.format(size)})
+
+        start, stop, _ = http_range.indices(size)
+        is_partial = http_range.start is not None or http_range.stop is not None
+
+        if is_partial and start >= stop:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': 'bytes */{}'.format(size)})
+
+        response = web.StreamResponse(status=206 if is_partial else 200, headers=headers)
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.content_type = 'text/plain'
+        response.charset = 'utf-8'
+        response.content_length = stop - start
+
+        if is_partial:
+            response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+
+        with contextlib.ExitStack() as stack:
+            try:
+                view = stack.enter_context(content.mapped()) if isinstance(content, FileContent) else content
+            except AssertionError as err:
+                raise web.HTTPBadRequest(text='{}'.format(err))
+
+            await response.prepare(request)
+
+            for offset in range(start, stop, STREAM_CHUNK_SIZE):
+                # chunk is copied, because transport can keep it after mapping is closed
+                await response.write(bytes(view[offset:min(offset + STREAM_CHUNK_SIZE, stop)]))
+
+        await response.write_eof()
+        return response
 
     @UsersAPI.authorized
     @RoleModel.role_model
@@ -121,7 +403,40 @@ class Handler:
     # @UsersSQLAPI.authorized
     # @RoleModelSQL.role_model
     async def download_file(self, request: web.Request, *args, **kwargs) -> web.Response:
-        """Coroutine for downloading files from working directory via threads.
+        """Coroutine for downloading files from working directory via loader pool.
+
+        Args:
+            request (Request): aiohttp request, contains filename and is_signed parameters.
+
+        Returns:
+            Response: JSON response with success status and success message or error status and error message.
+
+        Raises:
+            HTTPBadRequest: 400 HTTP error, if error,
+            HTTPTooManyRequests: 429 HTTP error, if loader pool is saturated or user has too many downloads.
+
+        """
+
+        filename = request.rel_url.query.get('filename')
+        is_signed = request.rel_url.query.get('is_signed', 'false')
+
+        try:
+            assert filename, 'Filename is not set'
+            future = self.loader_pool.submit(filename, bool(strtobool(is_signed)), kwargs.get('user_id'))
+            message = await asyncio.wrap_future(future)
+        except (AssertionError, ValueError) as err:
+            raise web.HTTPBadRequest(text='{}'.format(err))
+        except Full as err:
+            raise web.HTTPTooManyRequests(text='{}'.format(err))
+
+        return web.json_response({'status': 'success', 'message': message}, dumps=self.dumps)
+
+    @UsersAPI.authorized
+    @RoleModel.role_model
+    # @UsersSQLAPI.authorized
+    # @RoleModelSQL.role_model
+    async def download_file_async(self, request: web.Request, *args, **kwargs) -> web.Response:
+        """Coroutine for downloading files from working directory via asyncio tasks.
 
         Args:
             request (Request): aiohttp request, contains filename and is_signed parameters.
@@ -134,7 +449,95 @@ class Handler:
 
         """
 
-        pass
+        filename = request.rel_url.query.get('filename')
+        is_signed = request.rel_url.query.get('is_signed', 'false')
+
+        try:
+            assert filename, 'Filename is not set'
+            handle = await self.async_loader.download_file(filename, bool(strtobool(is_signed)), kwargs.get('user_id'))
+            path = await handle
+        except (AssertionError, ValueError) as err:
+            raise web.HTTPBadRequest(text='{}'.format(err))
+
+        return web.json_response({'status': 'success', 'message': 'File {} is downloaded'.format(path)},
+                                 dumps=self.dumps)
+
+    @UsersAPI.authorized
+    @RoleModel.role_model
+    # @UsersSQLAPI.authorized
+    # @RoleModelSQL.role_model
+    async def download_files(self, request: web.Request, *args, **kwargs) -> web.StreamResponse:
+        """Coroutine for downloading batch of files from working directory.
+
+        Signatures of all files are checked in parallel. Files are either copied concurrently into
+        LOADER_HOME_DIR/{user_id} or streamed in response as single archive, which is generated on the fly. Batch is
+        copied entirely or not at all: if any file is not copied, copies of other files are removed.
+
+        Args:
+            request (Request): aiohttp request, contains JSON in body. JSON format:
+            {
+                "filenames": "list. List of file names. Required",
+                "is_signed": "boolean. Check or not file signatures. Optional. Default: false",
+                "archive": "string. Archive format: zip or tar. Optional. If not set, files are copied"
+            }.
+
+        Returns:
+            StreamResponse: archive or JSON response with success status and success message or error status and error
+            message.
+
+        Raises:
+            HTTPBadRequest: 400 HTTP error, if error,
+            HTTPInternalServerError: 500 HTTP error, if file is not copied.
+
+        """
+
+        loop = asyncio.get_event_loop()
+
+        try:
+            data = await request.json()
+            assert isinstance(data, dict), 'JSON object is expected'
+            filenames, archive = data.get('filenames'), data.get('archive')
+            is_signed = bool(strtobool('{}'.format(data.get('is_signed', False))))
+            assert isinstance(filenames, list) and filenames, 'Filenames are not set'
+            assert archive is None or archive in ARCHIVE_FORMATS, 'Archive format {} is invalid'.format(archive)
+
+            if archive:
+                paths = await asyncio.gather(*[loop.run_in_executor(
+                    self.async_loader.executor, BaseLoader.get_source_path, filename, is_signed, kwargs.get('user_id'))
+                    for filename in filenames])
+            else:
+                # all copies are awaited, so copies of failed batch are removed only after they are finished
+                handles = await asyncio.gather(*[self.async_loader.download_file(
+                    filename, is_signed, kwargs.get('user_id')) for filename in filenames], return_exceptions=True)
+                results = await asyncio.gather(*[handle for handle in handles
+                                                 if not isinstance(handle, BaseException)], return_exceptions=True)
+                paths = [path for path in results if not isinstance(path, BaseException)]
+                errors = [error for error in handles + results if isinstance(error, BaseException)]
+
+                if errors:
+                    for path in paths:
+                        with contextlib.suppress(FileNotFoundError):
+                            await loop.run_in_executor(None, os.remove, path)
+
+                    raise errors[0]
+        except (AssertionError, ValueError) as err:
+            raise web.HTTPBadRequest(text='{}'.format(err))
+        except OSError as err:
+            raise web.HTTPInternalServerError(text='Files are not downloaded: {}'.format(err.strerror or err))
+
+        if not archive:
+            return web.json_response({'status': 'success', 'message': '{} files are downloaded'.format(len(paths))},
+                                     dumps=self.dumps)
+
+        response = web.StreamResponse(headers={
+            'Content-Type': ARCHIVE_FORMATS[archive],
+            'Content-Disposition': 'attachment; filename="files.{}"'.format(archive)})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        await loop.run_in_executor(self.async_loader.executor, write_archive, paths,
+                                   StreamWriter(response.write, loop), archive)
+        await response.write_eof()
+        return response
 
     @UsersAPI.authorized
     @RoleModel.role_model
@@ -144,17 +547,95 @@ class Handler:
         """Coroutine for downloading files from working directory via queue.
 
         Args:
-            request (Request): aiohttp request, contains filename and is_signed parameters.
+            request (Request): aiohttp request, contains filename, is_signed and priority (interactive or bulk,
+            default: interactive) parameters.
+
+        Returns:
+            Response: JSON response with success status and job Id or error status and error message.
+
+        Raises:
+            HTTPBadRequest: 400 HTTP error, if error,
+            HTTPServiceUnavailable: 503 HTTP error, if download queue is full.
+
+        """
+
+        filename = request.rel_url.query.get('filename')
+        is_signed = request.rel_url.query.get('is_signed', 'false')
+        priority = request.rel_url.query.get('priority', 'interactive')
+
+        try:
+            assert filename, 'Filename is not set'
+            assert priority in PRIORITIES, 'Priority {} is invalid'.format(priority)
+            job = {'filename': filename, 'is_signed': bool(strtobool(is_signed)), 'user_id': kwargs.get('user_id')}
+            job_id = await asyncio.get_event_loop().run_in_executor(None, self.queue.put, job, PRIORITIES[priority])
+        except (AssertionError, ValueError) as err:
+            raise web.HTTPBadRequest(text='{}'.format(err))
+        except Full:
+            raise web.HTTPServiceUnavailable(text='Download queue is full')
+
+        return web.json_response({'status': 'success', 'data': {'job_id': job_id}}, dumps=self.dumps)
+
+    @UsersAPI.authorized
+    @RoleModel.role_model
+    # @UsersSQLAPI.authorized
+    # @RoleModelSQL.role_model
+    async def get_download_job(self, request: web.Request, *args, **kwargs) -> web.Response:
+        """Coroutine for getting status of queued download job.
+
+        Args:
+            request (Request): aiohttp request, contains job_id.
+
+        Returns:
+            Response: JSON response with success status and job status (with bytes copied, rate and ETA for running
+            job) or error status and error message.
+
+        Raises:
+            HTTPBadRequest: 400 HTTP error, if job Id is invalid,
+            HTTPNotFound: 404 HTTP error, if job is not found or belongs to other user.
+
+        """
+
+        try:
+            job_id = int(request.match_info.get('job_id', request.rel_url.query.get('job_id')))
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest(text='Job Id is invalid')
+
+        job = await asyncio.get_event_loop().run_in_executor(None, self.queue.status, job_id, kwargs.get('user_id'))
+
+        if not job:
+            raise web.HTTPNotFound(text='Job {} is not found'.format(job_id))
+
+        return web.json_response({'status': 'success', 'data': job}, dumps=self.dumps)
+
+    @UsersAPI.authorized
+    @RoleModel.role_model
+    # @UsersSQLAPI.authorized
+    # @RoleModelSQL.role_model
+    async def cancel_download_job(self, request: web.Request, *args, **kwargs) -> web.Response:
+        """Coroutine for cancelling queued or running download job.
+
+        Args:
+            request (Request): aiohttp request, contains job_id.
 
         Returns:
             Response: JSON response with success status and success message or error status and error message.
 
         Raises:
-            HTTPBadRequest: 400 HTTP error, if error.
+            HTTPBadRequest: 400 HTTP error, if job Id is invalid,
+            HTTPNotFound: 404 HTTP error, if job is not found, belongs to other user or already finished.
 
         """
 
-        pass
+        try:
+            job_id = int(request.match_info.get('job_id', request.rel_url.query.get('job_id')))
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest(text='Job Id is invalid')
+
+        if not await asyncio.get_event_loop().run_in_executor(None, self.queue.cancel, job_id, kwargs.get('user_id')):
+            raise web.HTTPNotFound(text='Job {} is not found or already finished'.format(job_id))
+
+        return web.json_response({'status': 'success', 'message': 'Job {} is cancelled'.format(job_id)},
+                                 dumps=self.dumps)
 
     async def signup(self, request: web.Request, *args, **kwargs) -> web.Response:
         """Coroutine for signing up user.
@@ -177,7 +658,52 @@ class Handler:
 
         """
 
-        pass
+        try:
+            data = await request.json()
+            assert isinstance(data, dict), 'Invalid request data'
+            await asyncio.get_event_loop().run_in_executor(None, partial(UsersAPI.signup, **data))
+        except (AssertionError, ValueError) as err:
+            raise web.HTTPBadRequest(text='{}'.format(err))
+
+        return web.json_response({'status': 'success', 'message': 'User with email {} is created'.format(
+            data['email'])}, dumps=self.dumps)
+
+    @UsersAPI.authorized
+    @RoleModel.role_model
+    # @UsersSQLAPI.authorized
+    # @RoleModelSQL.role_model
+    async def signup_bulk(self, request: web.Request, *args, **kwargs) -> web.Response:
+        """Coroutine for signing up batch of users.
+
+        Args:
+            request (Request): aiohttp request, contains JSON in body. JSON format:
+            {
+                "users": "list. List of users with the same format as in signup. Required"
+            }.
+
+        Returns:
+            Response: JSON response with success status, quantity of created users and per-row errors.
+
+        Raises:
+            HTTPBadRequest: 400 HTTP error, if error,
+            HTTPTooManyRequests: 429 HTTP error, if too many passwords are being hashed,
+            HTTPGatewayTimeout: 504 HTTP error, if passwords are not hashed in time.
+
+        """
+
+        try:
+            data = await request.json()
+            assert isinstance(data, dict), 'JSON object is expected'
+            result = await asyncio.get_event_loop().run_in_executor(
+                None, partial(UsersAPI.signup_bulk, data.get('users'), executor=self.offload['password']))
+        except (AssertionError, ValueError) as err:
+            raise web.HTTPBadRequest(text='{}'.format(err))
+        except OffloadFull as err:
+            raise web.HTTPTooManyRequests(text='{}'.format(err))
+        except concurrent.futures.TimeoutError:
+            raise web.HTTPGatewayTimeout(text='Passwords are not hashed in time')
+
+        return web.json_response({'status': 'success', 'data': result}, dumps=self.dumps)
 
     async def signin(self, request: web.Request, *args, **kwargs) -> web.Response:
         """Coroutine for signing in user.
@@ -198,7 +724,15 @@ class Handler:
 
         """
 
-        pass
+        try:
+            data = await request.json()
+            assert isinstance(data, dict), 'Invalid request data'
+            session_id = await asyncio.get_event_loop().run_in_executor(None, partial(UsersAPI.signin, **data))
+        except (AssertionError, ValueError) as err:
+            raise web.HTTPBadRequest(text='{}'.format(err))
+
+        return web.json_response({'status': 'success', 'message': 'You have successfully signed in',
+                                  'session_id': session_id}, dumps=self.dumps)
 
     async def logout(self, request: web.Request, *args, **kwargs) -> web.Response:
         """Coroutine for logout.
@@ -214,7 +748,13 @@ class Handler:
 
         """
 
-        pass
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, UsersAPI.logout, request.headers.get('Authorization'))
+        except AssertionError:
+            raise web.HTTPUnauthorized(text='Session is expired or not found')
+
+        return web.json_response({'status': 'success', 'message': 'You have successfully logged out'},
+                                 dumps=self.dumps)
 
     @UsersAPI.authorized
     @RoleModel.role_model
@@ -392,6 +932,51 @@ class Handler:
 
         pass
 
+    @UsersAPI.authorized
+    @RoleModel.role_model
+    # @UsersSQLAPI.authorized
+    # @RoleModelSQL.role_model
+    async def role_model_batch(self, request: web.Request, *args, **kwargs) -> web.Response:
+        """Coroutine for applying batch of role model operations in a single transaction.
+
+        Args:
+            request (Request): aiohttp request, contains JSON in body. JSON format:
+            {
+                "operations": [
+                    {
+                        "operation": "string. One of add_method, delete_method, add_role, delete_role,
+                        add_method_to_role, delete_method_from_role, change_shared_prop, change_user_role. Required",
+                        "method": "string. Method name. Optional",
+                        "role": "string. Role name. Optional",
+                        "email": "string. User's email. Optional",
+                        "value": "boolean. Value of shared property. Optional"
+                    }
+                ]
+            }.
+
+        Returns:
+            Response: JSON response with success status and quantity of applied operations or error status and error
+            message.
+
+        Raises:
+            HTTPBadRequest: 400 HTTP error, if error. No operations are applied in this case.
+
+        """
+
+        keys = {'method': 'method_name', 'role': 'role_name'}
+
+        try:
+            data = await request.json()
+            operations = data.get('operations')
+            assert isinstance(operations, list), 'Operations must be a list'
+            operations = [{keys.get(key, key): value for key, value in operation.items()} for operation in operations]
+            applied = await asyncio.get_event_loop().run_in_executor(None, RoleModel.apply_batch, operations)
+        except (AssertionError, AttributeError, ValueError) as err:
+            raise web.HTTPBadRequest(text='{}'.format(err))
+
+        return web.json_response({'status': 'success', 'message': '{} operations applied'.format(applied)},
+                                 dumps=self.dumps)
+
     @UsersAPI.authorized
     @RoleModel.role_model
     # @UsersSQLAPI.authorized
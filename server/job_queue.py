@@ -0,0 +1,312 @@
+# Copyright 2019 by Kirill Kanin.
+# All rights reserved.
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import typing
+import contextlib
+from queue import Full, Empty
+from threading import Condition
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+INTERACTIVE = 0
+BULK = 1
+PRIORITIES = {'interactive': INTERACTIVE, 'bulk': BULK}
+
+
+class JobCancelled(Exception):
+    """Raised inside worker when running job is cancelled.
+
+    """
+
+
+class JobQueue:
+    """Durable bounded job queue backed by SQLite, which can be shared by threads of several processes.
+
+    Jobs are processed at least once: job taken by worker stays in running state until it is acknowledged. Running
+    job is leased to its worker, worker renews lease on every progress update. Job, which lease is expired (worker
+    died or hung), is taken again by another worker. Jobs are taken atomically in order of priority (interactive
+    before bulk), then in order of creation. Progress of running jobs is kept in jobs table, so it is visible in all
+    processes.
+
+    """
+
+    def __init__(self, path: str, maxsize: int = 0, max_attempts: int = 3, lease: float = None,
+                 poll_interval: float = None):
+        self.path = path
+        self.maxsize = maxsize
+        self.max_attempts = max_attempts
+        self.lease = float(os.environ['LOADER_JOB_LEASE_SECONDS']) if lease is None else lease
+        self.poll_interval = float(os.environ['LOADER_QUEUE_POLL_SECONDS']) if poll_interval is None \
+            else poll_interval
+        # owner of jobs taken by this queue instance
+        self.owner = uuid4().hex
+        self._condition = Condition()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, status TEXT NOT NULL, '
+            'priority INTEGER NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0, error TEXT, '
+            'created REAL NOT NULL, updated REAL NOT NULL)')
+        columns = [row['name'] for row in self._connection.execute('PRAGMA table_info(jobs)')]
+
+        for column, definition in (('priority', 'INTEGER NOT NULL DEFAULT 0'), ('owner', 'TEXT'),
+                                   ('lease_until', 'REAL'), ('copied', 'INTEGER'), ('total', 'INTEGER'),
+                                   ('started', 'REAL')):
+            if column not in columns:
+                self._connection.execute('ALTER TABLE jobs ADD COLUMN {} {}'.format(column, definition))
+
+        self._connection.execute('CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, id)')
+
+    @contextlib.contextmanager
+    def _transaction(self) -> typing.Iterator[sqlite3.Connection]:
+        # write lock is taken at start, so statements of transaction are atomic for all processes
+        self._connection.execute('BEGIN IMMEDIATE')
+
+        try:
+            yield self._connection
+        except BaseException:
+            self._connection.execute('ROLLBACK')
+            raise
+
+        self._connection.execute('COMMIT')
+
+    def qsize(self) -> int:
+        """Get quantity of unfinished (queued and running) jobs.
+
+        Returns:
+            Int with quantity of unfinished jobs.
+
+        """
+
+        with self._condition:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)', (QUEUED, RUNNING)).fetchone()[0]
+
+    def put(self, payload: dict, priority: int = INTERACTIVE) -> int:
+        """Put job into queue.
+
+        Args:
+            payload (dict): JSON serializable job arguments,
+            priority (int): Job priority, INTERACTIVE or BULK. Optional. Default: INTERACTIVE.
+
+        Returns:
+            Int with job Id.
+
+        Raises:
+            Full: if queue is full.
+
+        """
+
+        with self._condition:
+            # size is checked in the same transaction, so workers of other processes can't exceed it
+            with self._transaction() as connection:
+                if self.maxsize and connection.execute(
+                        'SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)',
+                        (QUEUED, RUNNING)).fetchone()[0] >= self.maxsize:
+                    raise Full('Job queue is full')
+
+                now = time.time()
+                job_id = connection.execute(
+                    'INSERT INTO jobs (payload, status, priority, created, updated) VALUES (?, ?, ?, ?, ?)',
+                    (json.dumps(payload), QUEUED, priority, now, now)).lastrowid
+
+            self._condition.notify_all()
+            return job_id
+
+    def _take(self, max_priority: int) -> typing.Optional[sqlite3.Row]:
+        now = time.time()
+
+        # job is selected and claimed in one transaction, UPDATE ... RETURNING is not used to support SQLite < 3.35
+        with self._transaction() as connection:
+            # jobs of dead workers, which are out of attempts, are not taken again
+            expired = connection.execute(
+                'UPDATE jobs SET status = ?, error = ?, owner = NULL, updated = ? '
+                'WHERE status = ? AND lease_until < ? AND attempts >= ?',
+                (FAILED, 'Worker lease expired', now, RUNNING, now, self.max_attempts)).rowcount
+            row = connection.execute(
+                'SELECT id, payload FROM jobs WHERE (status = ? OR status = ? AND lease_until < ?) AND priority <= ? '
+                'ORDER BY priority, id LIMIT 1', (QUEUED, RUNNING, now, max_priority)).fetchone()
+
+            if row:
+                connection.execute(
+                    'UPDATE jobs SET status = ?, owner = ?, lease_until = ?, attempts = attempts + 1, copied = 0, '
+                    'total = NULL, started = ?, updated = ? WHERE id = ?',
+                    (RUNNING, self.owner, now + self.lease, now, now, row['id']))
+
+        if expired:
+            logger.warning('Failed {} jobs of dead workers in {}'.format(expired, self.path))
+
+        return row
+
+    def get(self, timeout: float = None, max_priority: int = BULK) -> typing.Tuple[int, dict]:
+        """Take next job from queue and mark it as running. Queue is polled, so jobs put by other processes are
+        taken too.
+
+        Args:
+            timeout (float): Max time to wait for job in seconds. Optional. Default: wait forever,
+            max_priority (int): Take only jobs with this or higher priority. Optional. Default: BULK (any job).
+
+        Returns:
+            Tuple with job Id and job arguments.
+
+        Raises:
+            Empty: if there is no job after timeout.
+
+        """
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        with self._condition:
+            while True:
+                row = self._take(max_priority)
+
+                if row:
+                    return row['id'], json.loads(row['payload'])
+
+                remaining = deadline - time.monotonic() if deadline is not None else None
+
+                if remaining is not None and remaining <= 0:
+                    raise Empty
+                self._condition.wait(min(remaining, self.poll_interval) if remaining is not None
+                                     else self.poll_interval)
+
+    def done(self, job_id: int):
+        """Mark job as successfully processed. Job, which is not owned by this queue anymore, is not changed.
+
+        Args:
+            job_id (int): Job Id.
+
+        """
+
+        with self._condition:
+            self._connection.execute(
+                'UPDATE jobs SET status = ?, error = NULL, owner = NULL, updated = ? '
+                'WHERE id = ? AND status = ? AND owner = ?', (DONE, time.time(), job_id, RUNNING, self.owner))
+
+    def failed(self, job_id: int, error: str):
+        """Mark job as failed. Job is queued again until max attempts is reached.
+
+        Args:
+            job_id (int): Job Id,
+            error (str): Error message.
+
+        """
+
+        with self._condition:
+            self._connection.execute(
+                'UPDATE jobs SET status = CASE WHEN attempts < ? THEN ? ELSE ? END, error = ?, owner = NULL, '
+                'updated = ? WHERE id = ? AND status = ? AND owner = ?',
+                (self.max_attempts, QUEUED, FAILED, error, time.time(), job_id, RUNNING, self.owner))
+            self._condition.notify_all()
+
+    def progress(self, job_id: int, copied: int, total: int = None):
+        """Update progress of running job and renew its lease. Called by worker.
+
+        Args:
+            job_id (int): Job Id,
+            copied (int): Quantity of processed bytes,
+            total (int): Total quantity of bytes. Optional.
+
+        Raises:
+            JobCancelled: if job is cancelled or is not owned by this queue anymore.
+
+        """
+
+        with self._condition:
+            now = time.time()
+            updated = self._connection.execute(
+                'UPDATE jobs SET copied = ?, total = COALESCE(?, total), lease_until = ?, updated = ? '
+                'WHERE id = ? AND status = ? AND owner = ?',
+                (copied, total, now + self.lease, now, job_id, RUNNING, self.owner)).rowcount
+
+        if not updated:
+            raise JobCancelled('Job {} is cancelled'.format(job_id))
+
+    def _owned(self, job_id: int, user_id: typing.Optional[int]) -> typing.Optional[sqlite3.Row]:
+        row = self._connection.execute(
+            'SELECT id, payload, status, priority, attempts, error, created, updated, copied, total, started FROM jobs '
+            'WHERE id = ?', (job_id,)).fetchone()
+
+        # job of other user is reported as not found, so job Ids of other users are not revealed
+        if row and user_id is not None and json.loads(row['payload']).get('user_id') != user_id:
+            return None
+
+        return row
+
+    def cancel(self, job_id: int, user_id: int = None) -> bool:
+        """Cancel queued or running job. Running job is stopped by worker on next progress update.
+
+        Args:
+            job_id (int): Job Id,
+            user_id (int): Id of user, who put job. Optional. If set, jobs of other users are not cancelled.
+
+        Returns:
+            Bool, which is True if job is cancelled, False if job is not found, belongs to other user or already
+            finished.
+
+        """
+
+        with self._condition:
+            if not self._owned(job_id, user_id):
+                return False
+
+            return bool(self._connection.execute(
+                'UPDATE jobs SET status = ?, updated = ? WHERE id = ? AND status IN (?, ?)',
+                (CANCELLED, time.time(), job_id, QUEUED, RUNNING)).rowcount)
+
+    def status(self, job_id: int, user_id: int = None) -> typing.Optional[dict]:
+        """Get job status.
+
+        Args:
+            job_id (int): Job Id,
+            user_id (int): Id of user, who put job. Optional. If set, jobs of other users are not found.
+
+        Returns:
+            Dict with job Id, status, priority, attempts, error, created and updated timestamps or None if job is not
+            found or belongs to other user. Running job also has keys:
+                copied (int): quantity of processed bytes,
+                total (int): total quantity of bytes or None if unknown,
+                rate (float): processing rate in bytes per second,
+                eta (float): estimated time to finish in seconds or None if unknown.
+
+        """
+
+        with self._condition:
+            row = self._owned(job_id, user_id)
+
+        if not row:
+            return None
+
+        job = dict(row)
+        del job['payload']
+        copied, total, started = job.pop('copied'), job.pop('total'), job.pop('started')
+
+        if job['status'] == RUNNING:
+            rate = (copied or 0) / max(time.time() - started, 1e-6)
+            job.update(copied=copied or 0, total=total, rate=rate,
+                       eta=(total - copied) / rate if total is not None and rate else None)
+
+        return job
+
+    def close(self):
+        """Close queue database connection.
+
+        """
+
+        with self._condition:
+            self._connection.close()
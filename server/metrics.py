@@ -0,0 +1,426 @@
+# Copyright 2019 by Kirill Kanin.
+# All rights reserved.
+
+import math
+import time
+import typing
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock, local
+from aiohttp import web
+from sqlalchemy import event
+from sqlalchemy.engine.base import Engine
+
+# latency buckets in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    """Format labels of series in Prometheus text format.
+
+    Args:
+        names (tuple): Label names,
+        values (tuple): Label values,
+        extra (str): Additional formatted label, e.g. le="0.5". Optional.
+
+    Returns:
+        Str with labels in braces or empty string if there are no labels.
+
+    """
+
+    labels = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+              for name, value in zip(names, values)]
+
+    if extra:
+        labels.append(extra)
+
+    return '{{{}}}'.format(','.join(labels)) if labels else ''
+
+
+def format_value(value: float) -> str:
+    """Format sample value in Prometheus text format.
+
+    Args:
+        value (float): Sample value.
+
+    Returns:
+        Str with value.
+
+    """
+
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Shards:
+    """Per-thread dicts with metric values. Each thread updates own dict without locking, dicts are merged on
+    collection.
+
+    """
+
+    def __init__(self):
+        # thread-local storage, local.values is dict of current thread
+        self.local = local()
+        self._shards = []
+        self._lock = Lock()
+
+    def get(self) -> dict:
+        """Get dict of current thread.
+
+        Returns:
+            Dict with values by label values.
+
+        """
+
+        try:
+            return self.local.values
+        except AttributeError:
+            values = self.local.values = {}
+
+            with self._lock:
+                self._shards.append(values)
+
+            return values
+
+    def items(self) -> typing.Iterator[tuple]:
+        """Iterate over values of all threads.
+
+        Returns:
+            Iterator with tuples of label values and value.
+
+        """
+
+        with self._lock:
+            shards = list(self._shards)
+
+        for values in shards:
+            yield from list(values.items())
+
+
+class Counter:
+    """Monotonic counter with labels.
+
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._shards = Shards()
+
+    def inc(self, value: float = 1, labels: tuple = ()):
+        """Increment counter.
+
+        Args:
+            value (float): Increment,
+            labels (tuple): Label values in order of label names.
+
+        """
+
+        try:
+            values = self._shards.local.values
+        except AttributeError:
+            values = self._shards.get()
+
+        values[labels] = values.get(labels, 0) + value
+
+    def value(self, labels: tuple = ()) -> float:
+        return sum(value for key, value in self._shards.items() if key == labels)
+
+    def samples(self) -> typing.Iterator[str]:
+        values = {}
+
+        for labels, value in self._shards.items():
+            values[labels] = values.get(labels, 0) + value
+
+        for labels, value in values.items():
+            yield '{}{} {}'.format(self.name, format_labels(self.labels, labels), format_value(value))
+
+
+class Gauge:
+    """Metric, which value is got from callback on collection. Used for gauges and for counters kept by other
+    components, e.g. content cache hits. Callback of gauge with labels returns dict with values by label values.
+
+    """
+
+    def __init__(self, name: str, documentation: str, callback: typing.Callable[[], typing.Any], kind: str = 'gauge',
+                 labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.kind = kind
+        self.labels = labels
+
+    def samples(self) -> typing.Iterator[str]:
+        if not self.labels:
+            yield '{} {}'.format(self.name, format_value(self.callback()))
+            return
+
+        for labels, value in self.callback().items():
+            yield '{}{} {}'.format(self.name, format_labels(self.labels, labels), format_value(value))
+
+
+class Histogram:
+    """Histogram with labels. Observation is one binary search and update of thread's own series.
+
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._shards = Shards()
+
+    def observe(self, value: float, labels: tuple = ()):
+        """Observe value.
+
+        Args:
+            value (float): Observed value,
+            labels (tuple): Label values in order of label names.
+
+        """
+
+        try:
+            series = self._shards.local.values[labels]
+        except (AttributeError, KeyError):
+            # counts per bucket, count of values over last bucket, sum
+            series = self._shards.get()[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def merged(self) -> typing.Dict[tuple, list]:
+        """Merge series of all threads.
+
+        Returns:
+            Dict with series by label values.
+
+        """
+
+        merged = {}
+
+        for labels, series in self._shards.items():
+            total = merged.setdefault(labels, [0] * len(series))
+
+            for index, value in enumerate(list(series)):
+                total[index] += value
+
+        return merged
+
+    def count(self, labels: tuple = ()) -> int:
+        series = self.merged().get(labels)
+        return sum(series[:-1]) if series else 0
+
+    def samples(self) -> typing.Iterator[str]:
+        for labels, series in self.merged().items():
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(self.name, format_labels(
+                    self.labels, labels, 'le="{}"'.format(format_value(bound))), cumulative)
+
+            yield '{}_sum{} {}'.format(self.name, format_labels(self.labels, labels), format_value(series[-1]))
+            yield '{}_count{} {}'.format(self.name, format_labels(self.labels, labels), cumulative)
+
+
+class Registry:
+    """Registry of metrics rendered in Prometheus text format.
+
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        """Register metric. Metric with the same name is replaced.
+
+        Args:
+            metric: Counter, Gauge or Histogram.
+
+        Returns:
+            Registered metric.
+
+        """
+
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, callback: typing.Callable[[], typing.Any],
+              kind: str = 'gauge', labels: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, callback, kind, labels))
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        """Render all metrics. Metrics, which callbacks fail, are skipped.
+
+        Returns:
+            Str with metrics in Prometheus text format.
+
+        """
+
+        lines = []
+
+        for metric in list(self.metrics.values()):
+            try:
+                samples = list(metric.samples())
+            except Exception:
+                continue
+
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(samples)
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+REQUEST_SECONDS = REGISTRY.histogram('http_request_duration_seconds', 'HTTP request latency.',
+                                     ('method', 'route', 'status'))
+RESPONSE_BYTES = REGISTRY.counter('http_response_bytes_total', 'HTTP response body bytes.', ('method', 'route'))
+REQUEST_BYTES = REGISTRY.counter('http_request_bytes_total', 'HTTP request body bytes.', ('method', 'route'))
+FILE_SERVICE_SECONDS = REGISTRY.histogram('file_service_duration_seconds', 'FileService operation latency.',
+                                          ('operation',))
+FILE_READ_BYTES = REGISTRY.counter('file_read_bytes_total', 'Bytes of file content read by FileService.')
+FILE_WRITTEN_BYTES = REGISTRY.counter('file_written_bytes_total', 'Bytes of file content written by FileService.')
+CRYPTO_SECONDS = REGISTRY.histogram('crypto_duration_seconds', 'Hashing and encryption latency.', ('operation',))
+DB_QUERY_SECONDS = REGISTRY.histogram('db_query_duration_seconds', 'SQL statement latency.')
+_in_flight = 0
+REGISTRY.gauge('http_requests_in_flight', 'HTTP requests in progress.', lambda: _in_flight)
+
+
+def timed(histogram: Histogram) -> typing.Callable:
+    """Decorator for observing duration of function calls. Qualified name of function is used as label value.
+
+    Args:
+        histogram (Histogram): Histogram with one label.
+
+    Returns:
+        Function, which wrap function for decoration.
+
+    """
+
+    def decorator(func):
+        labels = (func.__qualname__,)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, labels)
+
+        return wrapper
+
+    return decorator
+
+
+def route_name(request: web.Request) -> str:
+    """Get canonical path of matched route, so label cardinality is bounded.
+
+    Args:
+        request (Request): aiohttp request.
+
+    Returns:
+        Str with canonical path or "unmatched".
+
+    """
+
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else 'unmatched'
+
+
+@web.middleware
+async def middleware(request: web.Request, handler) -> web.StreamResponse:
+    """Observe request latency, status and body sizes.
+
+    Args:
+        request (Request): aiohttp request,
+        handler (function): Request handler.
+
+    Returns:
+        StreamResponse: response of handler.
+
+    """
+
+    global _in_flight
+    started = time.perf_counter()
+    labels = (request.method, route_name(request))
+    status = 500
+    _in_flight += 1
+
+    try:
+        response = await handler(request)
+        status = response.status
+        RESPONSE_BYTES.inc(response.body_length if response.prepared else response.content_length or 0, labels)
+        return response
+    except web.HTTPException as err:
+        status = err.status
+        raise
+    finally:
+        _in_flight -= 1
+
+        if request.content_length:
+            REQUEST_BYTES.inc(request.content_length, labels)
+
+        REQUEST_SECONDS.observe(time.perf_counter() - started, labels + (status,))
+
+
+def instrument_database(engine: Engine = None):
+    """Observe duration of SQL statements.
+
+    Args:
+        engine (Engine): Database engine. Optional. Default: all engines.
+
+    """
+
+    target = engine if engine is not None else Engine
+
+    if event.contains(target, 'before_cursor_execute', _before_cursor_execute):
+        return
+
+    event.listen(target, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(target, 'after_cursor_execute', _after_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # start is kept on execution context, so statement, which raised, leaves nothing behind
+    if context is not None:
+        context._metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_metrics_started', None)
+
+    if started is not None:
+        DB_QUERY_SECONDS.observe(time.perf_counter() - started)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """Coroutine for getting metrics in Prometheus text format.
+
+    Args:
+        request (Request): aiohttp request.
+
+    Returns:
+        Response: text response with metrics.
+
+    """
+
+    return web.Response(body=REGISTRY.render().encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
@@ -0,0 +1,300 @@
+# Copyright 2019 by Kirill Kanin.
+# All rights reserved.
+
+import os
+import math
+import time
+import asyncio
+import typing
+from queue import Full
+from threading import Lock
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+import server.tracing as tracing
+
+# category: pool, thread pool is used for C code, which releases GIL (hashlib, zlib)
+CATEGORIES = {
+    'hash': 'thread',
+    'compress': 'thread',
+    'password': 'process',
+}
+
+
+class OffloadFull(Full):
+    """Exception raised if category has too many queued and running jobs.
+
+    """
+
+    pass
+
+
+def run_chunk(func: typing.Callable, chunk: list) -> list:
+    """Call function for each arguments tuple of chunk. Used by CategoryExecutor.map in worker.
+
+    Args:
+        func (function): Function,
+        chunk (list): List of arguments tuples.
+
+    Returns:
+        List with results.
+
+    """
+
+    return [func(*args) for args in chunk]
+
+
+class CategoryExecutor(Executor):
+    """Executor of one category of jobs with limit of queued and running jobs, timeout and metrics.
+
+    """
+
+    def __init__(self, name: str, pool: Executor, limit: int, timeout: float):
+        self.name = name
+        self.pool = pool
+        self.limit = limit
+        self.timeout = timeout
+        self.in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self._lock = Lock()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """Submit job to pool.
+
+        Args:
+            fn (function): Function,
+            *args (tuple): Function arguments,
+            **kwargs (dict): Function named arguments.
+
+        Returns:
+            Future with result.
+
+        Raises:
+            OffloadFull: if category has limit of queued and running jobs.
+
+        """
+
+        with self._lock:
+            if self.in_flight >= self.limit:
+                self.rejected += 1
+                raise OffloadFull('Too many {} jobs'.format(self.name))
+
+            self.in_flight += 1
+            self.submitted += 1
+
+        started = time.perf_counter()
+
+        def done(future: Future):
+            duration = time.perf_counter() - started
+
+            with self._lock:
+                self.in_flight -= 1
+
+                if future.cancelled() or future.exception() is not None:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+                    self.total_time += duration
+                    self.max_time = max(self.max_time, duration)
+
+        # spans of job are children of current span, context is not passed to processes
+        if isinstance(self.pool, ThreadPoolExecutor):
+            fn = tracing.bind(fn)
+
+        try:
+            future = self.pool.submit(fn, *args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.in_flight -= 1
+                self.failed += 1
+            raise
+
+        future.add_done_callback(done)
+        return future
+
+    def map(self, fn, *iterables, timeout: float = None, chunksize: int = 1) -> typing.Iterator:
+        """Map function over iterables in chunks. Each chunk is one job and is admitted by category limit, so
+        chunks are enlarged to make at most limit jobs. Map is rejected only if jobs of other calls occupy category.
+
+        Args:
+            fn (function): Function,
+            *iterables: Iterables with function arguments,
+            timeout (float): Max time to wait for all results in seconds. Default: category timeout,
+            chunksize (int): Min quantity of arguments tuples in one job.
+
+        Returns:
+            Iterator with results.
+
+        Raises:
+            OffloadFull: if category has limit of queued and running jobs,
+            TimeoutError: if results are not ready in time.
+
+        """
+
+        items = list(zip(*iterables))
+        chunksize = max(1, chunksize, math.ceil(len(items) / max(1, self.limit)))
+        futures = []
+
+        try:
+            for start in range(0, len(items), chunksize):
+                futures.append(self.submit(run_chunk, fn, items[start:start + chunksize]))
+        except OffloadFull:
+            for future in futures:
+                future.cancel()
+            raise
+
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+
+        def results():
+            try:
+                for future in futures:
+                    yield from future.result(max(0.0, deadline - time.monotonic()))
+            except TimeoutError:
+                with self._lock:
+                    self.timeouts += 1
+                raise
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        return results()
+
+    async def run(self, fn, *args, **kwargs):
+        """Run job in pool and wait for result within category timeout. Waiting is traced as offload.<category> span.
+
+        Args:
+            fn (function): Function,
+            *args (tuple): Function arguments,
+            **kwargs (dict): Function named arguments.
+
+        Returns:
+            Result of function.
+
+        Raises:
+            OffloadFull: if category has limit of queued and running jobs,
+            asyncio.TimeoutError: if job is not completed in time.
+
+        """
+
+        with tracing.span('offload.' + self.name):
+            future = self.submit(fn, *args, **kwargs)
+
+            try:
+                return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+            except asyncio.TimeoutError:
+                with self._lock:
+                    self.timeouts += 1
+                raise
+
+    def stats(self) -> typing.Dict:
+        """Get category metrics.
+
+        Returns:
+            Dict with metrics. Keys:
+                limit (int): max quantity of queued and running jobs,
+                in_flight (int): quantity of queued and running jobs,
+                submitted (int): quantity of submitted jobs,
+                completed (int): quantity of successfully completed jobs,
+                failed (int): quantity of failed and cancelled jobs,
+                rejected (int): quantity of jobs rejected by limit,
+                timeouts (int): quantity of jobs, which were not completed in time,
+                avg_seconds (float): average time from submit to completion of successful jobs,
+                max_seconds (float): max time from submit to completion of successful jobs.
+
+        """
+
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'in_flight': self.in_flight,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'avg_seconds': self.total_time / self.completed if self.completed else 0.0,
+                'max_seconds': self.max_time,
+            }
+
+
+class OffloadService:
+    """Service for running CPU-bound jobs out of event loop.
+
+    Process pool is used for pure Python jobs, thread pool is used for C code, which releases GIL. Each category of
+    jobs has own limit of queued and running jobs and timeout, configured with OFFLOAD_<CATEGORY>_LIMIT and
+    OFFLOAD_<CATEGORY>_TIMEOUT_SECONDS environment variables.
+
+    """
+
+    def __init__(self, process_workers: int = None, thread_workers: int = None, categories: dict = None):
+        self.process_pool = ProcessPoolExecutor(process_workers or int(os.environ['OFFLOAD_PROCESS_WORKERS']) or None)
+        self.thread_pool = ThreadPoolExecutor(thread_workers or int(os.environ['OFFLOAD_THREAD_WORKERS']) or None,
+                                              thread_name_prefix='offload')
+        pools = {'process': self.process_pool, 'thread': self.thread_pool}
+        self.categories = {}
+
+        for name, pool in (categories or CATEGORIES).items():
+            assert pool in pools, 'Pool {} is unknown'.format(pool)
+            self.categories[name] = CategoryExecutor(
+                name, pools[pool], int(os.environ['OFFLOAD_{}_LIMIT'.format(name.upper())]),
+                float(os.environ['OFFLOAD_{}_TIMEOUT_SECONDS'.format(name.upper())]))
+
+    def __getitem__(self, category: str) -> CategoryExecutor:
+        return self.categories[category]
+
+    async def run(self, category: str, fn, *args, **kwargs):
+        """Run job of category and wait for result.
+
+        Args:
+            category (str): Category of job,
+            fn (function): Function,
+            *args (tuple): Function arguments,
+            **kwargs (dict): Function named arguments.
+
+        Returns:
+            Result of function.
+
+        Raises:
+            OffloadFull: if category has limit of queued and running jobs,
+            asyncio.TimeoutError: if job is not completed in time.
+
+        """
+
+        return await self.categories[category].run(fn, *args, **kwargs)
+
+    def stats(self) -> typing.Dict:
+        """Get metrics of all categories.
+
+        Returns:
+            Dict with metrics dicts by categories.
+
+        """
+
+        return {name: executor.stats() for name, executor in self.categories.items()}
+
+    def shutdown(self, wait: bool = True):
+        """Shutdown pools.
+
+        Args:
+            wait (bool): Wait for running jobs.
+
+        """
+
+        self.thread_pool.shutdown(wait)
+        self.process_pool.shutdown(wait)
+
+    async def context(self, app):
+        """Attach service to aiohttp application and shutdown pools on cleanup. Used as cleanup context.
+
+        Args:
+            app (Application): aiohttp application.
+
+        """
+
+        app['offload'] = self
+        yield
+        await asyncio.get_event_loop().run_in_executor(None, self.shutdown)
@@ -0,0 +1,283 @@
+# Copyright 2019 by Kirill Kanin.
+# All rights reserved.
+
+import os
+import time
+import select
+import signal
+import socket
+import asyncio
+import logging
+import typing
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+def reuse_port_socket(host: str, port: int, backlog: int = 1024) -> socket.socket:
+    """Create listening socket, which shares port with sockets of other processes.
+
+    Kernel balances incoming connections between all sockets bound to the port with SO_REUSEPORT.
+
+    Args:
+        host (str): Host to bind,
+        port (int): Port to bind,
+        backlog (int): Size of queue of pending connections.
+
+    Returns:
+        Listening socket.
+
+    """
+
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+class Worker:
+    """Worker process handle in master process.
+
+    """
+
+    def __init__(self, pid: int, heartbeat_fd: int):
+        self.pid = pid
+        self.heartbeat_fd = heartbeat_fd
+        self.started = time.monotonic()
+        self.last_beat = self.started
+        self.retired = False
+
+
+class PreforkServer:
+    """Master process, which forks workers serving the same port and supervises them.
+
+    Each worker binds own SO_REUSEPORT socket, creates application with app_factory and writes heartbeats to pipe
+    from its event loop. Worker, which exits or stops sending heartbeats, is replaced. SIGHUP starts new workers and
+    gracefully stops old ones, SIGTERM and SIGINT gracefully stop all workers.
+
+    """
+
+    def __init__(self, app_factory: typing.Callable[[], web.Application], host: str = '0.0.0.0', port: int = 8080,
+                 workers: int = None, initializer: typing.Callable[[], None] = None):
+        self.app_factory = app_factory
+        self.host = host
+        self.port = port
+        self.workers_count = workers or os.cpu_count()
+        self.initializer = initializer
+        self.heartbeat = float(os.environ['PREFORK_HEARTBEAT_SECONDS'])
+        self.timeout = float(os.environ['PREFORK_WORKER_TIMEOUT_SECONDS'])
+        self.shutdown_timeout = float(os.environ['PREFORK_SHUTDOWN_TIMEOUT_SECONDS'])
+        self.workers = {}
+        self._reload = False
+        self._stop = False
+        self._failures = 0
+        self._respawn_at = 0.0
+
+    def spawn(self) -> Worker:
+        """Fork worker process.
+
+        Returns:
+            Worker handle.
+
+        """
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            os.close(read_fd)
+
+            for worker in self.workers.values():
+                os.close(worker.heartbeat_fd)
+
+            code = 1
+
+            try:
+                self.run_worker(write_fd)
+                code = 0
+            except Exception:
+                logger.exception('Worker {} failed'.format(os.getpid()))
+            finally:
+                os._exit(code)
+
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        worker = Worker(pid, read_fd)
+        self.workers[pid] = worker
+        logger.info('Worker {} started'.format(pid))
+        return worker
+
+    def run_worker(self, heartbeat_fd: int):
+        """Serve application in worker process.
+
+        Args:
+            heartbeat_fd (int): Write end of heartbeat pipe.
+
+        """
+
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+
+        os.set_blocking(heartbeat_fd, False)
+
+        if self.initializer:
+            self.initializer()
+
+        sock = reuse_port_socket(self.host, self.port)
+        app = self.app_factory()
+        interval = self.heartbeat
+
+        async def heartbeat(app):
+            async def beat():
+                while True:
+                    try:
+                        os.write(heartbeat_fd, b'.')
+                    except BlockingIOError:
+                        pass
+
+                    await asyncio.sleep(interval)
+
+            task = asyncio.ensure_future(beat())
+            yield
+            task.cancel()
+
+        app.cleanup_ctx.append(heartbeat)
+        web.run_app(app, sock=sock, shutdown_timeout=self.shutdown_timeout, print=None)
+
+    def retire(self, worker: Worker, signum: int = signal.SIGTERM):
+        """Stop worker process, which is not replaced after exit.
+
+        Args:
+            worker (Worker): Worker handle,
+            signum (int): Signal for worker process.
+
+        """
+
+        worker.retired = True
+
+        try:
+            os.kill(worker.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        """Collect exited workers and schedule replacement of failed ones.
+
+        """
+
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+
+            if pid == 0:
+                break
+
+            worker = self.workers.pop(pid, None)
+
+            if worker is None:
+                continue
+
+            os.close(worker.heartbeat_fd)
+
+            if worker.retired:
+                logger.info('Worker {} stopped'.format(pid))
+                continue
+
+            logger.warning('Worker {} exited unexpectedly with status {}'.format(pid, status))
+
+            # back off if workers die right after start
+            if time.monotonic() - worker.started < self.timeout:
+                self._failures += 1
+            else:
+                self._failures = 0
+
+            self._respawn_at = time.monotonic() + min(0.1 * 2 ** self._failures, 10.0) if self._failures else 0.0
+
+    def check_heartbeats(self, timeout: float):
+        """Read heartbeats and kill workers, which did not send them in time.
+
+        Args:
+            timeout (float): Max time to wait for heartbeats in seconds.
+
+        """
+
+        fds = {worker.heartbeat_fd: worker for worker in self.workers.values()}
+
+        if fds:
+            ready, _, _ = select.select(list(fds), [], [], timeout)
+        else:
+            ready = []
+            time.sleep(timeout)
+
+        now = time.monotonic()
+
+        for fd in ready:
+            try:
+                if os.read(fd, 4096):
+                    fds[fd].last_beat = now
+            except BlockingIOError:
+                pass
+
+        for worker in self.workers.values():
+            if not worker.retired and now - worker.last_beat > self.timeout:
+                logger.error('Worker {} is not responding, killing'.format(worker.pid))
+                worker.last_beat = now
+
+                try:
+                    os.kill(worker.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def run(self):
+        """Run master process until SIGTERM or SIGINT.
+
+        """
+
+        def request_reload(signum, frame):
+            self._reload = True
+
+        def request_stop(signum, frame):
+            self._stop = True
+
+        signal.signal(signal.SIGHUP, request_reload)
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+        logger.info('Serving on {}:{} with {} workers'.format(self.host, self.port, self.workers_count))
+
+        for _ in range(self.workers_count):
+            self.spawn()
+
+        deadline = None
+
+        while self.workers:
+            if self._stop and deadline is None:
+                deadline = time.monotonic() + self.shutdown_timeout + self.heartbeat
+
+                for worker in list(self.workers.values()):
+                    self.retire(worker)
+
+            if self._reload and deadline is None:
+                self._reload = False
+                old_workers = list(self.workers.values())
+                logger.info('Reloading workers')
+
+                for _ in range(self.workers_count):
+                    self.spawn()
+
+                for worker in old_workers:
+                    self.retire(worker)
+
+            self.reap()
+
+            if deadline is None and time.monotonic() >= self._respawn_at:
+                for _ in range(self.workers_count - sum(not worker.retired for worker in self.workers.values())):
+                    self.spawn()
+
+            if deadline is not None and time.monotonic() > deadline:
+                for worker in self.workers.values():
+                    self.retire(worker, signal.SIGKILL)
+
+            self.check_heartbeats(min(self.heartbeat, 1.0))
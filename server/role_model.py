@@ -1,8 +1,18 @@
 # Copyright 2019 by Kirill Kanin.
 # All rights reserved.
 
+import os
+import time
+import asyncio
+import typing
+import inspect
+import logging
+from functools import wraps
 from aiohttp import web
-#from server.database import DataBase
+from server.database import DataBase
+import server.tracing as tracing
+
+logger = logging.getLogger(__name__)
 
 
 class RoleModel:
@@ -10,6 +20,13 @@ class RoleModel:
 
     """
 
+    # derived permissions cache: role name -> names of methods available for role (including shared ones)
+    permissions = {}
+    # monotonic time of last permissions cache rebuild, None if cache is not built
+    permissions_updated = None
+    # names of methods decorated with role_model
+    methods = set()
+
     @staticmethod
     def role_model(func):
         """Decorator for checking access permissions in role model.
@@ -22,8 +39,12 @@ class RoleModel:
 
         """
 
-        def wrapper(*args, **kwargs) -> web.Response:
-            """Wrap decorated method.
+        RoleModel.methods.add(func.__name__)
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs) -> web.Response:
+            """Wrap decorated method. Method is available for role if role has method with name of decorated method
+            or method is shared. Role is passed by authorization decorator in role named argument.
 
             Args:
                 *args (tuple): Tuple with nameless arguments,
@@ -38,9 +59,20 @@ class RoleModel:
 
             """
 
-            pass
+            if 'role' not in kwargs:
+                raise web.HTTPUnauthorized(text='Session is expired or not found')
 
-        pass
+            with tracing.span('RoleModel.role_model'):
+                if RoleModel.permissions_expired():
+                    await asyncio.get_event_loop().run_in_executor(
+                        None, tracing.bind(RoleModel.rebuild_permissions))
+
+                if not RoleModel.has_access(kwargs['role'], func.__name__):
+                    raise web.HTTPForbidden(text='Access denied')
+
+            return await func(*args, **kwargs)
+
+        return wrapper
 
     @staticmethod
     def add_method(method_name: str):
@@ -165,3 +197,197 @@ class RoleModel:
         """
 
         pass
+
+    @staticmethod
+    def rebuild_permissions(db_session=None):
+        """Rebuild derived permissions cache from role model.
+
+        Args:
+            db_session (DBSession): Database connection session. Optional.
+
+        """
+
+        session = db_session or DataBase().create_session()
+
+        try:
+            shared = frozenset(method.name for method in session.query(DataBase.Method).filter_by(shared=True))
+            RoleModel.permissions = {
+                role.name: frozenset(method.name for method in role.methods) | shared
+                for role in session.query(DataBase.Role).options(*DataBase.load_options('role'))}
+            RoleModel.permissions_updated = time.monotonic()
+        finally:
+            if not db_session:
+                session.close()
+
+    @staticmethod
+    def permissions_expired() -> bool:
+        """Check if derived permissions cache must be rebuilt. Role model can be changed by other worker process, so
+        cache is rebuilt, if it is older than ROLE_MODEL_CACHE_SECONDS.
+
+        Returns:
+            Bool, which is True if cache is not built or expired.
+
+        """
+
+        return RoleModel.permissions_updated is None or \
+            time.monotonic() - RoleModel.permissions_updated > float(os.environ['ROLE_MODEL_CACHE_SECONDS'])
+
+    @staticmethod
+    def has_access(role_name: str, method_name: str) -> bool:
+        """Check access to method for role via derived permissions cache.
+
+        Args:
+            role_name (str): Role name,
+            method_name (str): Method name.
+
+        Returns:
+            Bool, which is True if method is available for role.
+
+        """
+
+        return method_name in RoleModel.permissions.get(role_name, ())
+
+    @staticmethod
+    def apply_batch(operations: typing.List[dict], db_session=None) -> int:
+        """Apply batch of role model operations in a single transaction.
+
+        Roles, methods and users referenced by operations are loaded with one query per model, operations are applied
+        in order and committed together. If any operation fails, whole batch is rolled back. Derived permissions cache
+        is rebuilt once after commit. If rebuild fails, batch is still applied and cache is rebuilt on next access
+        check.
+
+        Args:
+            operations (list): List of dicts with operation name in "operation" key and named arguments of
+            corresponding RoleModel method in other keys. Operations: add_method, delete_method, add_role, delete_role,
+            add_method_to_role, delete_method_from_role, change_shared_prop, change_user_role,
+            db_session (DBSession): Database connection session. Optional.
+
+        Returns:
+            Int with quantity of applied operations.
+
+        Raises:
+            AssertionError: if operations is not a list, operation is unknown, has missing or unexpected keys or at
+            least one operation is invalid.
+
+        """
+
+        assert isinstance(operations, list), 'Operations must be a list'
+        assert all(isinstance(operation, dict) for operation in operations), 'Operation must be a dict'
+
+        for index, operation in enumerate(operations):
+            for key in ('operation', 'method_name', 'role_name', 'email'):
+                assert isinstance(operation.get(key, ''), str), 'Operation {}: {} must be a string'.format(index, key)
+
+            kwargs = dict(operation)
+            name = kwargs.pop('operation', None)
+            assert name in BATCH_OPERATIONS, 'Operation {}: {} is unknown'.format(index, name)
+
+            try:
+                # missing and unexpected keys of operation are client errors, not server ones
+                inspect.signature(BATCH_OPERATIONS[name]).bind(None, None, **kwargs)
+            except TypeError as err:
+                raise AssertionError('Operation {}: {}'.format(index, err))
+
+        session = db_session or DataBase().create_session()
+
+        try:
+            def names(key: str) -> list:
+                return list({operation[key] for operation in operations if operation.get(key)})
+
+            state = {
+                'roles': {role.name: role for role in session.query(DataBase.Role).options(
+                    *DataBase.load_options('role')).filter(DataBase.Role.name.in_(names('role_name')))},
+                'methods': {method.name: method for method in session.query(DataBase.Method).options(
+                    *DataBase.load_options('method')).filter(DataBase.Method.name.in_(names('method_name')))},
+                'users': {user.email: user for user in session.query(DataBase.User).options(
+                    *DataBase.load_options('user')).filter(DataBase.User.email.in_(names('email')))},
+            }
+
+            for index, operation in enumerate(operations):
+                kwargs = dict(operation)
+                name = kwargs.pop('operation')
+
+                try:
+                    BATCH_OPERATIONS[name](session, state, **kwargs)
+                except (AssertionError, KeyError) as err:
+                    raise AssertionError('Operation {}: {}'.format(index, err))
+
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            if not db_session:
+                session.close()
+
+        try:
+            RoleModel.rebuild_permissions(db_session)
+        except Exception:
+            logger.exception('Permissions cache is not rebuilt after batch')
+            RoleModel.permissions_updated = None
+
+        return len(operations)
+
+
+def _add_method(session, state: dict, method_name: str):
+    assert method_name not in state['methods'], 'Method {} exists'.format(method_name)
+    method = DataBase.Method(method_name)
+    session.add(method)
+    state['methods'][method_name] = method
+
+
+def _delete_method(session, state: dict, method_name: str):
+    assert method_name in state['methods'], 'Method {} is not found'.format(method_name)
+    session.delete(state['methods'].pop(method_name))
+
+
+def _add_role(session, state: dict, role_name: str):
+    assert role_name not in state['roles'], 'Role {} exists'.format(role_name)
+    role = DataBase.Role(role_name)
+    session.add(role)
+    state['roles'][role_name] = role
+
+
+def _delete_role(session, state: dict, role_name: str):
+    assert role_name in state['roles'], 'Role {} is not found'.format(role_name)
+    session.delete(state['roles'].pop(role_name))
+
+
+def _add_method_to_role(session, state: dict, method_name: str, role_name: str):
+    assert method_name in state['methods'], 'Method {} is not found'.format(method_name)
+    assert role_name in state['roles'], 'Role {} is not found'.format(role_name)
+    role, method = state['roles'][role_name], state['methods'][method_name]
+    assert method not in role.methods, 'Method {} is already added to role {}'.format(method_name, role_name)
+    role.methods.append(method)
+
+
+def _delete_method_from_role(session, state: dict, method_name: str, role_name: str):
+    assert method_name in state['methods'], 'Method {} is not found'.format(method_name)
+    assert role_name in state['roles'], 'Role {} is not found'.format(role_name)
+    role, method = state['roles'][role_name], state['methods'][method_name]
+    assert method in role.methods, 'Method {} is not found in role {}'.format(method_name, role_name)
+    role.methods.remove(method)
+
+
+def _change_shared_prop(session, state: dict, method_name: str, value: bool):
+    assert method_name in state['methods'], 'Method {} is not found'.format(method_name)
+    assert isinstance(value, bool), 'Value is not boolean'
+    state['methods'][method_name].shared = value
+
+
+def _change_user_role(session, state: dict, email: str, role_name: str):
+    assert email in state['users'], 'User {} is not found'.format(email)
+    assert role_name in state['roles'], 'Role {} is not found'.format(role_name)
+    state['users'][email].role = state['roles'][role_name]
+
+
+BATCH_OPERATIONS = {
+    'add_method': _add_method,
+    'delete_method': _delete_method,
+    'add_role': _add_role,
+    'delete_role': _delete_role,
+    'add_method_to_role': _add_method_to_role,
+    'delete_method_from_role': _delete_method_from_role,
+    'change_shared_prop': _change_shared_prop,
+    'change_user_role': _change_user_role,
+}
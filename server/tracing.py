@@ -0,0 +1,333 @@
+# Copyright 2019 by Kirill Kanin.
+# All rights reserved.
+
+import os
+import time
+import random
+import typing
+import asyncio
+import threading
+from collections import deque
+from contextvars import ContextVar, copy_context
+from functools import partial, wraps
+from aiohttp import web
+
+# span of current request, None if request is not sampled
+_current = ContextVar('tracing_span', default=None)
+
+
+class Trace:
+    """Spans of one sampled request.
+
+    """
+
+    def __init__(self, name: str, max_spans: int):
+        self.trace_id = os.urandom(8).hex()
+        self.name = name
+        self.max_spans = max_spans
+        self.timestamp = time.time()
+        self.status = None
+        self.dropped = 0
+        self.spans = []
+        self.root = Span(name, self, None)
+
+    @property
+    def duration(self) -> float:
+        return self.root.duration
+
+    def breakdown(self) -> typing.List[typing.Dict]:
+        """Get time of each stage. Self time of span is its duration without durations of its children.
+
+        Returns:
+            List of dicts sorted by total time. Keys:
+                name (str): name of stage,
+                count (int): quantity of spans of stage,
+                total_ms (float): total duration of spans in milliseconds,
+                self_ms (float): total self time of spans in milliseconds.
+
+        """
+
+        children = {}
+
+        for span in self.spans:
+            if span.parent is not None:
+                children[id(span.parent)] = children.get(id(span.parent), 0.0) + span.duration
+
+        stages = {}
+
+        for span in self.spans:
+            stage = stages.setdefault(span.name, {'name': span.name, 'count': 0, 'total_ms': 0.0, 'self_ms': 0.0})
+            stage['count'] += 1
+            stage['total_ms'] += span.duration * 1000
+            stage['self_ms'] += max(0.0, span.duration - children.get(id(span), 0.0)) * 1000
+
+        return sorted(stages.values(), key=lambda stage: stage['total_ms'], reverse=True)
+
+    def to_dict(self) -> typing.Dict:
+        """Get trace with per stage breakdown and spans in start order.
+
+        Returns:
+            Dict with trace. Keys:
+                trace_id (str): trace Id,
+                name (str): method and canonical path of request route,
+                timestamp (float): request start time,
+                status (int): response status,
+                duration_ms (float): request duration in milliseconds,
+                dropped (int): quantity of spans over limit, which were not recorded,
+                stages (list): per stage breakdown,
+                spans (list): spans with name, depth, thread, offset_ms, duration_ms and error keys.
+
+        """
+
+        start = self.root.start
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'timestamp': self.timestamp,
+            'status': self.status,
+            'duration_ms': self.duration * 1000,
+            'dropped': self.dropped,
+            'stages': self.breakdown(),
+            'spans': [{'name': span.name, 'depth': span.depth, 'thread': span.thread,
+                       'offset_ms': (span.start - start) * 1000, 'duration_ms': span.duration * 1000,
+                       'error': span.error} for span in self.spans],
+        }
+
+
+class Span:
+    """Timed stage of trace. Used as context manager, which makes span current in context.
+
+    """
+
+    __slots__ = ('name', 'trace', 'parent', 'depth', 'thread', 'start', 'end', 'error', '_token')
+
+    def __init__(self, name: str, trace: Trace, parent: typing.Optional['Span']):
+        self.name = name
+        self.trace = trace
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent is not None else 0
+        self.thread = threading.current_thread().name
+        self.start = time.perf_counter()
+        self.end = None
+        self.error = None
+        trace.spans.append(self)
+
+    @property
+    def duration(self) -> float:
+        # span of job, which outlived request, is cut at request end
+        end = self.end if self.end is not None else self.trace.root.end
+
+        return (end if end is not None else time.perf_counter()) - self.start
+
+    def __enter__(self) -> 'Span':
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time.perf_counter()
+
+        if exc_type is not None:
+            self.error = exc_type.__name__
+
+        _current.reset(self._token)
+
+
+class NoSpan:
+    """Context manager used instead of span, if request is not sampled.
+
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def span(name: str) -> typing.Union[Span, NoSpan]:
+    """Start child span of current span.
+
+    Args:
+        name (str): Name of stage.
+
+    Returns:
+        Span context manager or no-op context manager, if request is not sampled or trace has max quantity of spans.
+
+    """
+
+    parent = _current.get()
+
+    if parent is None:
+        return NO_SPAN
+
+    trace = parent.trace
+
+    if len(trace.spans) >= trace.max_spans:
+        trace.dropped += 1
+        return NO_SPAN
+
+    return Span(name, trace, parent)
+
+
+def traced(name: typing.Union[str, typing.Callable] = None) -> typing.Callable:
+    """Decorator for tracing function calls as spans. Qualified name of function is used as span name by default.
+    Coroutine functions are supported.
+
+    Args:
+        name (str): Name of span. Optional.
+
+    Returns:
+        Function, which wrap function for decoration, or wrapped function, if decorator is used without arguments.
+
+    """
+
+    if callable(name):
+        return traced()(name)
+
+    def decorator(func):
+        label = name or func.__qualname__
+
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                if _current.get() is None:
+                    return await func(*args, **kwargs)
+
+                with span(label):
+                    return await func(*args, **kwargs)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if _current.get() is None:
+                    return func(*args, **kwargs)
+
+                with span(label):
+                    return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def bind(func: typing.Callable) -> typing.Callable:
+    """Bind function to current context, so spans of function running in other thread are children of current span.
+
+    Args:
+        func (function): Function.
+
+    Returns:
+        Function running in copy of current context, or function itself, if request is not sampled.
+
+    """
+
+    if _current.get() is None:
+        return func
+
+    return partial(copy_context().run, func)
+
+
+class Tracer:
+    """Sampling tracer of requests with ring buffer of recent traces.
+
+    Sampled request gets root span named by method and canonical path of route, spans of layers are its
+    descendants. Finished traces are kept in memory, so no external collector is required. Sample rate, buffer size
+    and max quantity of spans in trace are configured with TRACE_SAMPLE_RATE, TRACE_BUFFER_SIZE and TRACE_MAX_SPANS
+    environment variables. Traces can reveal routes and timings of other users' requests, and forced sampling costs
+    server time, so recent traces are served and request with X-Trace: 1 header is always sampled only if debug mode
+    is enabled with TRACE_DEBUG_ENABLED environment variable. It is off by default.
+
+    """
+
+    def __init__(self, sample_rate: float = None, buffer_size: int = None, max_spans: int = None,
+                 exempt: typing.Iterable[str] = (), debug: bool = None):
+        self.sample_rate = float(os.environ['TRACE_SAMPLE_RATE']) if sample_rate is None else sample_rate
+        self.debug = bool(int(os.environ['TRACE_DEBUG_ENABLED'])) if debug is None else debug
+        self.max_spans = int(os.environ['TRACE_MAX_SPANS']) if max_spans is None else max_spans
+        self.traces = deque(maxlen=int(os.environ['TRACE_BUFFER_SIZE']) if buffer_size is None else buffer_size)
+        self.exempt = set(exempt)
+
+    def sampled(self, request: web.Request) -> bool:
+        return self.debug and request.headers.get('X-Trace') == '1' or random.random() < self.sample_rate
+
+    def slowest(self, limit: int = 10) -> typing.List[Trace]:
+        """Get slowest of recent traces.
+
+        Args:
+            limit (int): Max quantity of traces.
+
+        Returns:
+            List of traces sorted by duration.
+
+        """
+
+        return sorted(list(self.traces), key=lambda trace: trace.duration, reverse=True)[:limit]
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        """Trace sampled request. Id of trace is sent in X-Trace-Id header.
+
+        Args:
+            request (Request): aiohttp request,
+            handler (function): Request handler.
+
+        Returns:
+            StreamResponse: response of handler.
+
+        """
+
+        resource = request.match_info.route.resource
+        name = '{} {}'.format(request.method, resource.canonical if resource is not None else 'unmatched')
+
+        if name in self.exempt or not self.sampled(request):
+            return await handler(request)
+
+        trace = Trace(name, self.max_spans)
+        trace.status = 500
+
+        try:
+            with trace.root:
+                response = await handler(request)
+
+            trace.status = response.status
+
+            if not response.prepared:
+                response.headers['X-Trace-Id'] = trace.trace_id
+
+            return response
+        except web.HTTPException as err:
+            trace.status = err.status
+            raise
+        finally:
+            self.traces.append(trace)
+
+    async def handle_traces(self, request: web.Request) -> web.Response:
+        """Coroutine for getting slowest recent traces with per stage breakdown.
+
+        Args:
+            request (Request): aiohttp request, contains limit parameter.
+
+        Returns:
+            Response: JSON response with traces.
+
+        Raises:
+            HTTPNotFound: 404 HTTP error, if debug mode is disabled,
+            HTTPBadRequest: 400 HTTP error, if limit is invalid.
+
+        """
+
+        if not self.debug:
+            raise web.HTTPNotFound()
+
+        try:
+            limit = int(request.rel_url.query.get('limit', '10'))
+            assert limit > 0, 'Limit must be positive'
+        except (AssertionError, ValueError) as err:
+            raise web.HTTPBadRequest(text='{}'.format(err))
+
+        return web.json_response({'status': 'success', 'sample_rate': self.sample_rate,
+                                  'data': [trace.to_dict() for trace in self.slowest(limit)]})
@@ -1,15 +1,27 @@
 # Copyright 2019 by Kirill Kanin.
 # All rights reserved.
 
+import os
 import re
+import math
+import asyncio
+import typing
+from functools import wraps
+from concurrent.futures import Executor, ProcessPoolExecutor
 from datetime import datetime
 from aiohttp import web
-#from server.database import DataBase
+import server.metrics as metrics
+import server.tracing as tracing
+from sqlalchemy.exc import IntegrityError
+from server.database import DataBase
 from server.crypto import HashAPI
 
 
 EMAIL_REGEX = re.compile(r'[\w._%+-]+@[\w.-]+\.[A-Za-z]{2,}$')
 PASSWORD_REGEX = re.compile(r'^\w{8,50}$')
+BULK_PARALLEL_THRESHOLD = 1000
+# users in one insert statement, 6 bound variables per user are within SQLite limit of 999
+BULK_INSERT_SIZE = 150
 
 
 class UsersAPI:
@@ -29,8 +41,9 @@ class UsersAPI:
 
         """
 
-        def wrapper(*args, **kwargs) -> web.Response:
-            """Wrap decorated method.
+        @wraps(func)
+        async def wrapper(*args, **kwargs) -> web.Response:
+            """Wrap decorated method. User Id and role name are passed to method in user_id and role named arguments.
 
             Args:
                 *args (tuple): Tuple with nameless arguments,
@@ -44,9 +57,50 @@ class UsersAPI:
 
             """
 
-            pass
+            request = next(arg for arg in args if isinstance(arg, web.BaseRequest))
+            session_id = request.headers.get('Authorization')
 
-        pass
+            with tracing.span('UsersAPI.authorized'):
+                user = await asyncio.get_event_loop().run_in_executor(
+                    None, tracing.bind(UsersAPI.get_session_user), session_id) if session_id else None
+
+            if not user:
+                raise web.HTTPUnauthorized(text='Session is expired or not found')
+
+            # verified user is used by admission control as client identity
+            request['user_id'], request['role'] = user
+            kwargs.update(user_id=user[0], role=user[1])
+            return await func(*args, **kwargs)
+
+        return wrapper
+
+    @staticmethod
+    def get_session_user(session_id: str, db_session=None) -> typing.Optional[typing.Tuple[int, str]]:
+        """Get user of active session. Session, user and user's role are loaded with one statement.
+
+        Args:
+            session_id (str): Session UUID,
+            db_session (DBSession): Database connection session. Optional.
+
+        Returns:
+            Tuple with user Id and role name or None if session is expired or not found.
+
+        """
+
+        session = db_session or DataBase().create_session()
+
+        try:
+            user_session = session.query(DataBase.Session).options(*DataBase.load_options('session')).filter(
+                DataBase.Session.uuid == session_id, DataBase.Session.expires_at > datetime.now()).first()
+
+            if not user_session:
+                return None
+
+            role = user_session.user.role
+            return user_session.user_id, role.name if role else None
+        finally:
+            if not db_session:
+                session.close()
 
     @staticmethod
     def signup(**kwargs):
@@ -67,7 +121,174 @@ class UsersAPI:
 
         """
 
-        pass
+        error = UsersAPI.validate_user(**kwargs)
+        assert not error, error
+        session = DataBase().create_session()
+
+        try:
+            assert not session.query(DataBase.User.id).filter_by(email=kwargs['email']).first(), \
+                'User with email {} exists'.format(kwargs['email'])
+            role = session.query(DataBase.Role).filter_by(name='visitor').first()
+            session.add(DataBase.User(kwargs['email'], HashAPI.hash_sha512(kwargs['password']), kwargs['name'],
+                                      kwargs.get('surname'), role))
+            session.commit()
+        finally:
+            session.close()
+
+    @staticmethod
+    def validate_user(**kwargs) -> str:
+        """Validate user's sign up data without database checks.
+
+        Args:
+            **kwargs (dict): Dict with named arguments. Keys are the same as in signup.
+
+        Returns:
+            Str with error message or None if data is valid.
+
+        """
+
+        for key in ('email', 'password', 'confirm_password', 'name'):
+            if not kwargs.get(key):
+                return '{} is not set'.format(key)
+
+            if not isinstance(kwargs[key], str):
+                return '{} must be a string'.format(key)
+
+        if kwargs.get('surname') is not None and not isinstance(kwargs['surname'], str):
+            return 'surname must be a string'
+
+        if not EMAIL_REGEX.match(kwargs['email']):
+            return 'Invalid email format'
+
+        if not PASSWORD_REGEX.match(kwargs['password']):
+            return 'Invalid password format'
+
+        if kwargs['password'] != kwargs['confirm_password']:
+            return 'Passwords are not match'
+
+        return None
+
+    @staticmethod
+    @metrics.timed(metrics.CRYPTO_SECONDS)
+    def hash_passwords(passwords: typing.List[str], executor: Executor = None) -> typing.List[str]:
+        """Hash passwords with SHA-512. Large batches are hashed in process pool. Duration is observed in this process,
+        because metrics of pool processes are not exported.
+
+        Args:
+            passwords (list): List of passwords,
+            executor (Executor): Executor for hashing of large batches. Optional. Default: new process pool.
+
+        Returns:
+            List with hashes in order of passwords.
+
+        """
+
+        if len(passwords) < BULK_PARALLEL_THRESHOLD:
+            return [HashAPI.hash_sha512(password) for password in passwords]
+
+        # few chunks per CPU, but not more than executor with limit of jobs admits
+        chunks = min(4 * (os.cpu_count() or 1), getattr(executor, 'limit', None) or float('inf'))
+        chunksize = math.ceil(len(passwords) / chunks)
+
+        if executor:
+            return list(executor.map(HashAPI.hash_sha512, passwords, chunksize=chunksize))
+
+        with ProcessPoolExecutor() as pool:
+            return list(pool.map(HashAPI.hash_sha512, passwords, chunksize=chunksize))
+
+    @staticmethod
+    def signup_bulk(users: typing.List[dict], db_session=None, executor: Executor = None) -> typing.Dict:
+        """Sign up batch of users.
+
+        Users are validated all at once, existing emails are checked with a single query, passwords are hashed
+        in process pool for large batches and valid users are inserted with multi-row statements of
+        BULK_INSERT_SIZE users, each committed separately, so number of bound variables is limited and database is not
+        locked for the whole batch. If users with the same emails are inserted concurrently, insert of their chunk is
+        rolled back, these users are reported as existing and the rest of chunk is inserted again.
+
+        Args:
+            users (list): List of dicts with the same keys as in signup,
+            db_session (DBSession): Database connection session. Optional,
+            executor (Executor): Executor for hashing of large batches, e.g. password category of offload service.
+                Optional. Default: new process pool.
+
+        Returns:
+            Dict with quantity of created users and per-row errors. Keys:
+                created (int): quantity of created users,
+                errors (list): list of dicts with index, email and error message of rejected users.
+
+        Raises:
+            AssertionError: if users is not a list.
+
+        """
+
+        assert isinstance(users, list), 'Users must be a list'
+        session = db_session or DataBase().create_session()
+        errors = []
+        valid = {}
+
+        for index, user in enumerate(users):
+            error = UsersAPI.validate_user(**user) if isinstance(user, dict) else 'Invalid user data'
+
+            if not error and user['email'] in valid:
+                error = 'Email is duplicated in batch'
+
+            if error:
+                errors.append({'index': index, 'email': user.get('email') if isinstance(user, dict) else None,
+                               'error': error})
+            else:
+                valid[user['email']] = index
+
+        try:
+            if valid:
+                existing = session.query(DataBase.User.email).filter(DataBase.User.email.in_(list(valid))).all()
+
+                for row in existing:
+                    errors.append({'index': valid.pop(row.email), 'email': row.email,
+                                   'error': 'User with email {} exists'.format(row.email)})
+
+            if valid:
+                hashes = UsersAPI.hash_passwords([users[index]['password'] for index in valid.values()], executor)
+                role = session.query(DataBase.Role.id).filter_by(name='visitor').first()
+                now = datetime.now()
+                rows = {users[index]['email']: {
+                    'email': users[index]['email'],
+                    'password': password_hash,
+                    'name': users[index]['name'],
+                    'surname': users[index].get('surname'),
+                    'role_id': role.id if role else None,
+                    'create_date': now,
+                } for index, password_hash in zip(valid.values(), hashes)}
+
+                emails = list(valid)
+
+                for start in range(0, len(emails), BULK_INSERT_SIZE):
+                    batch = emails[start:start + BULK_INSERT_SIZE]
+
+                    while batch:
+                        try:
+                            session.execute(DataBase.User.__table__.insert().values([rows[email] for email in batch]))
+                            session.commit()
+                            break
+                        except IntegrityError:
+                            session.rollback()
+                            existing = session.query(DataBase.User.email).filter(
+                                DataBase.User.email.in_(batch)).all()
+
+                            if not existing:
+                                raise
+
+                            for row in existing:
+                                errors.append({'index': valid.pop(row.email), 'email': row.email,
+                                               'error': 'User with email {} exists'.format(row.email)})
+
+                            batch = [email for email in batch if email in valid]
+        finally:
+            if not db_session:
+                session.close()
+
+        errors.sort(key=lambda error: error['index'])
+        return {'created': len(valid), 'errors': errors}
 
     @staticmethod
     def signin(**kwargs) -> str:
@@ -87,7 +308,23 @@ class UsersAPI:
 
         """
 
-        pass
+        email, password = kwargs.get('email'), kwargs.get('password')
+        assert isinstance(email, str) and email, 'Email is not set'
+        assert isinstance(password, str) and password, 'Password is not set'
+        assert EMAIL_REGEX.match(email), 'Invalid email format'
+        session = DataBase().create_session()
+
+        try:
+            user = session.query(DataBase.User).filter_by(email=email).first()
+            assert user, 'User with email {} does not exist'.format(email)
+            assert user.password == HashAPI.hash_sha512(password), 'Incorrect password'
+            user_session = DataBase.Session(user)
+            user.last_login_date = datetime.now()
+            session.add(user_session)
+            session.commit()
+            return user_session.uuid
+        finally:
+            session.close()
 
     @staticmethod
     def logout(session_id: str):
@@ -96,6 +333,16 @@ class UsersAPI:
         Args:
             session_id (str): session UUID.
 
+        Raises:
+            AssertionError: if session is not found.
+
         """
 
-        pass
+        session = DataBase().create_session()
+
+        try:
+            deleted = session.query(DataBase.Session).filter_by(uuid=session_id).delete(synchronize_session=False)
+            session.commit()
+            assert deleted, 'Session is not found'
+        finally:
+            session.close()
@@ -3,18 +3,46 @@ __author__ = 'idementyev@luxoft.com'
 __date__ = '2020-09-24'
 
 
+import json
+import math
+import time
 import random
 import string
+import secrets
+from threading import Lock
+from functools import lru_cache
 from datetime import datetime, timezone
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 filename_len = 8
+id_len = 26
+# Crockford's base32: digits and upper case latin letters without I, L, O, U
+id_alphabet = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_id_lock = Lock()
+_id_last = (0, 0)
 
 
 class SingletonMeta(type):
     """Meta class for singletons."""
-    def __call__(cls):
-        pass
+    _instances = {}
+
+    def __call__(cls, *args, **kwargs):
+        if cls not in SingletonMeta._instances:
+            SingletonMeta._instances[cls] = super().__call__(*args, **kwargs)
+        return SingletonMeta._instances[cls]
+
+    def reset(cls):
+        """Forget instance, so next call creates new one.
+
+        Used in forked worker processes, which must not share
+        connections and threads of parent process.
+        """
+        SingletonMeta._instances.pop(cls, None)
 
 
 def generate_string() -> str:
@@ -32,16 +60,114 @@ def generate_string() -> str:
     return _str
 
 
+def generate_id() -> str:
+    """Generate unique time-ordered string.
+
+    String is 48 bits of milliseconds timestamp and 80 random bits in
+    base32 (ULID). Random part is incremented for strings generated in
+    the same millisecond, so strings are unique within process and
+    sorted by generation time, collisions between processes are
+    negligible.
+
+    Returns:
+        str: unique string of id_len digits and upper case latin letters.
+    """
+    global _id_last
+    with _id_lock:
+        _ms, _rand = time.time_ns() // 1000000, secrets.randbits(80)
+        _last_ms, _last_rand = _id_last
+        if _ms <= _last_ms:
+            _ms, _rand = _last_ms, _last_rand + 1
+            if _rand >> 80:
+                _ms, _rand = _ms + 1, 0
+        _id_last = (_ms, _rand)
+    _value = _ms << 80 | _rand
+    return ''.join(id_alphabet[_value >> _shift & 31]
+                   for _shift in range(5 * (id_len - 1), -1, -5))
+
+
+@lru_cache(maxsize=4096)
+def _minute_prefix(minute: int) -> str:
+    """Format date up to minutes for minutes since epoch.
+
+    Args:
+        minute (int): minutes since epoch.
+    Returns:
+        str: formatted date prefix, e.g. 2019-09-05 11:22:
+    """
+    _format = '%Y-%m-%d %H:%M:'
+    return datetime.fromtimestamp(minute * 60, timezone.utc).strftime(_format)
+
+
 def convert_date(timestamp: float) -> str:
     """Convert date from timestamp to string.
 
     Example of date format: 2019-09-05 11:22:33.
     Date is considered to be in UTC as atime, mtime, ctime are stored in UTC.
+    Formatted prefix up to minutes is cached, so only seconds are
+    formatted for timestamps of recently seen minutes.
 
     Args:
         timestamp (float): date timestamp.
     Returns:
         str: converted date.
     """
-    _format = '%Y-%m-%d %H:%M:%S'
-    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(_format)
+    _seconds = math.floor(timestamp)
+    return f'{_minute_prefix(_seconds // 60)}{_seconds % 60:02d}'
+
+
+class Timestamp(float):
+    """Date timestamp, which is formatted only when converted to string.
+
+    Serialized to JSON as raw epoch number, str() returns date in
+    convert_date format, so signatures of file data are not changed.
+    """
+    __slots__ = ()
+
+    def __str__(self) -> str:
+        return convert_date(self)
+
+
+def json_default(obj):
+    """Convert objects, which are not supported by JSON encoder.
+
+    Used as default argument of json.dumps for records with to_dict()
+    method, e.g. file_service.FileMeta, and contents with decode()
+    method, e.g. file_service.FileContent. Float subclasses, e.g.
+    Timestamp, are converted to float for encoders, which do not
+    support subclasses.
+
+    Args:
+        obj: object to convert.
+    Returns:
+        JSON serializable representation of object.
+    Raises:
+        TypeError: if object is not supported.
+    """
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    if hasattr(obj, 'decode'):
+        return obj.decode()
+    if isinstance(obj, float):
+        return float(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} '
+                    f'is not JSON serializable')
+
+
+def json_dumps(obj) -> str:
+    """Serialize object to JSON string.
+
+    orjson is used if it is installed, stdlib json otherwise. Both
+    use json_default for unsupported objects.
+
+    Args:
+        obj: object to serialize.
+    Returns:
+        str: JSON string.
+    Raises:
+        TypeError: if object is not supported.
+    """
+    if orjson is None:
+        return json.dumps(obj, default=json_default)
+    return orjson.dumps(obj, default=json_default,
+                        option=orjson.OPT_NON_STR_KEYS).decode()
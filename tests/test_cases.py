@@ -1,16 +1,54 @@
 # Copyright 2019 by Kirill Kanin.
 # All rights reserved.
 
+import io
 import os
+import gzip
+import zlib
+import asyncio
 import pytest
+import tarfile
+import zipfile
 import json
 import logging
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
 import server.utils as utils
 from collections import OrderedDict
+from pathlib import Path
+from datetime import datetime, timedelta
 from aiohttp import web
-from server.handler import Handler
-#from server.database import DataBase
+from aiohttp.test_utils import make_mocked_request
+from email.utils import formatdate
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from server.app import create_app
+from server.handler import Handler, VISITOR_METHODS
+from server.file_service import FileService, FileServiceSigned, FileMeta, FileContent
+from server.database import DataBase
+from server.users import UsersAPI
+from server.role_model import RoleModel
+from server.content_cache import ContentCache
+from server.job_queue import JobQueue, JobCancelled, INTERACTIVE, BULK
+from queue import Full, Empty
+from threading import Event, Thread
+from server.file_loader import LoaderPool, BaseLoader, PooledLoader, QueuedLoader, AsyncLoader, StreamWriter, copy_file, \
+    write_archive
 from server.crypto import HashAPI, AESCipher, RSACipher
+from server.prefork import reuse_port_socket
+from server.offload import OffloadService, OffloadFull
+from server.admission import AdmissionControl, RateLimiter
+import server.metrics as metrics
+import server.tracing as tracing
+import server.users
+import server.file_loader
+import server.file_service
+import server.compression as compression
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -54,6 +92,78 @@ def teardown():
     pass
 
 
+@pytest.fixture
+def file_service(tmp_path):
+    service = FileServiceSigned()
+    path, shard_depth = service.path, service.shard_depth
+    service.path = str(tmp_path)
+    service.content_cache.clear()
+    mmap_threshold, precompress = service.mmap_threshold, service.precompress
+    compress_storage = service.compress_storage
+    yield service
+    service.path, service.shard_depth, service.mmap_threshold = path, shard_depth, mmap_threshold
+    service.precompress, service.compress_storage = precompress, compress_storage
+
+
+@pytest.fixture
+async def app_client(aiohttp_client, database, file_service, tmp_path, monkeypatch):
+    monkeypatch.setenv('LOADER_QUEUE_PATH', str(tmp_path / 'queue.db'))
+    monkeypatch.setenv('LOADER_HOME_DIR', str(tmp_path / 'home'))
+    monkeypatch.setenv('LOADER_WORKERS', '1')
+    monkeypatch.setenv('LOADER_INTERACTIVE_WORKERS', '0')
+    monkeypatch.setattr(RoleModel, 'permissions_updated', None)
+    monkeypatch.setattr(FileService(), 'path', file_service.path)
+    database.init_system(RoleModel.methods, VISITOR_METHODS)
+    client = await aiohttp_client(create_app(file_service.path))
+    user = {'email': 'user@test.su', 'password': 'password1234', 'confirm_password': 'password1234', 'name': 'User'}
+    assert (await client.post('/signup', json=user)).status == 200
+    response = await client.post('/signin', json={'email': user['email'], 'password': user['password']})
+    client.session.headers['Authorization'] = (await response.json())['session_id']
+    return client
+
+
+def user_home(database: DataBase, tmp_path) -> Path:
+    session = database.create_session()
+
+    try:
+        return tmp_path / 'home' / str(session.query(DataBase.User.id).filter_by(email='user@test.su').scalar())
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def query_counter():
+    with DataBase.count_queries() as counter:
+        yield counter
+
+
+@pytest.fixture
+def database(tmp_path):
+    DataBase.reset()
+    database = DataBase('sqlite:///{}'.format(tmp_path / 'test.db'))
+    DataBase.Base.metadata.create_all(database.engine)
+    yield database
+    database.engine.dispose()
+    DataBase.reset()
+
+
+@pytest.fixture
+def orm_session():
+    engine = create_engine('sqlite://')
+    DataBase.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    role = DataBase.Role('visitor', methods=[DataBase.Method(name) for name in (
+        'get_files', 'get_file_info', 'create_file', 'delete_file')])
+    user = DataBase.User('user@test.su', 'password1234', 'User', role=role)
+    user_session = DataBase.Session(user)
+    user_session.uuid = 'session-uuid'
+    session.add(user_session)
+    session.commit()
+    session.expunge_all()
+    yield session
+    session.close()
+
+
 class TestSuite:
 
     async def test_connection(self, client):
@@ -112,3 +222,1207 @@ class TestSuite:
 
     async def test_change_file_dir(self, client, prepare_data):
         pass
+
+
+class TestQueries:
+
+    def test_count_queries(self, query_counter):
+        engine = create_engine('sqlite://')
+        engine.execute('SELECT 1')
+        engine.execute('SELECT 2')
+        assert query_counter.count == 2
+
+    async def test_count_queries_per_context(self):
+        engine = create_engine('sqlite://')
+
+        async def count(statements: int) -> int:
+            with DataBase.count_queries(engine) as counter:
+                for _ in range(statements):
+                    engine.execute('SELECT 1')
+                    await asyncio.sleep(0)
+
+            return counter.count
+
+        with DataBase.count_queries() as total:
+            assert await asyncio.gather(count(2), count(3)) == [2, 3]
+
+        assert total.count == 5
+
+    def test_authorization_queries(self, orm_session, query_counter):
+        user_session = orm_session.query(DataBase.Session).options(
+            *DataBase.load_options('authorization')).filter_by(uuid='session-uuid').first()
+        methods = [method.name for method in user_session.user.role.methods]
+        assert len(methods) == 4
+        assert query_counter.count == 2
+
+    def test_purge_expired_sessions(self, orm_session):
+        user = orm_session.query(DataBase.User).first()
+
+        for i in range(5):
+            expired = DataBase.Session(user)
+            expired.uuid, expired.expires_at = 'expired-{}'.format(i), datetime.now() - timedelta(hours=1)
+            orm_session.add(expired)
+
+        orm_session.commit()
+        purged, duration = DataBase.purge_expired_sessions(orm_session, batch_size=2)
+        assert purged == 5 and duration >= 0
+        assert [s.uuid for s in orm_session.query(DataBase.Session)] == ['session-uuid']
+
+    async def test_session_reaper(self, database, monkeypatch):
+        monkeypatch.setenv('SESSION_REAPER_INTERVAL_SECONDS', '0')
+        reap_sessions, calls = database.reap_sessions, []
+
+        def flaky_reap_sessions():
+            calls.append(1)
+
+            if len(calls) == 1:
+                raise OSError('Database is unavailable')
+
+            return reap_sessions()
+
+        monkeypatch.setattr(database, 'reap_sessions', flaky_reap_sessions)
+        context = database.session_reaper(web.Application())
+        await context.__anext__()
+
+        for _ in range(100):
+            if database.reaper_stats:
+                break
+            await asyncio.sleep(0.01)
+
+        assert len(calls) >= 2 and database.reaper_stats['purged'] == 0
+
+        with pytest.raises(StopAsyncIteration):
+            await context.__anext__()
+
+    def test_signup_bulk(self, orm_session, query_counter, monkeypatch):
+        monkeypatch.setattr(server.users, 'BULK_INSERT_SIZE', 4)
+        users = [
+            {'email': 'bulk{}@test.su'.format(i), 'password': 'password{}'.format(i),
+             'confirm_password': 'password{}'.format(i), 'name': 'Bulk'} for i in range(10)]
+        users.append({'email': 'user@test.su', 'password': 'password1234', 'confirm_password': 'password1234',
+                      'name': 'User'})
+        users.append({'email': 'wrong', 'password': 'password1234', 'confirm_password': 'password1234',
+                      'name': 'User'})
+        users.append(dict(users[0]))
+        users.append({'email': 'number@test.su', 'password': 12345678, 'confirm_password': 12345678,
+                      'name': 'User'})
+        result = UsersAPI.signup_bulk(users, orm_session)
+        assert result['created'] == 10
+        assert [error['index'] for error in result['errors']] == [10, 11, 12, 13]
+        assert result['errors'][3]['error'] == 'password must be a string'
+        assert sum(statement.startswith('INSERT') for statement in query_counter.statements) == 3
+        assert orm_session.query(DataBase.User).count() == 11
+
+    def test_signup_bulk_concurrent_insert(self, orm_session, monkeypatch):
+        users = [{'email': 'bulk{}@test.su'.format(i), 'password': 'password{}'.format(i),
+                  'confirm_password': 'password{}'.format(i), 'name': 'Bulk'} for i in range(3)]
+        query = orm_session.query
+
+        def racing_query(*args, **kwargs):
+            # other process inserts user after emails are checked
+            if args and args[0] is DataBase.Role.id:
+                orm_session.add(DataBase.User(email='bulk1@test.su', password='hash', name='Other'))
+                orm_session.commit()
+
+            return query(*args, **kwargs)
+
+        monkeypatch.setattr(orm_session, 'query', racing_query)
+        monkeypatch.setattr(server.users, 'BULK_INSERT_SIZE', 2)
+        result = UsersAPI.signup_bulk(users, orm_session)
+        assert result['created'] == 2
+        assert result['errors'] == [
+            {'index': 1, 'email': 'bulk1@test.su', 'error': 'User with email bulk1@test.su exists'}]
+        assert query(DataBase.User).filter_by(name='Bulk').count() == 2
+
+    def test_signup_bulk_offload(self, orm_session, monkeypatch):
+        monkeypatch.setattr(server.users, 'BULK_PARALLEL_THRESHOLD', 2)
+        users = [{'email': 'bulk{}@test.su'.format(i), 'password': 'password{}'.format(i),
+                  'confirm_password': 'password{}'.format(i), 'name': 'Bulk'} for i in range(5)]
+        offload = OffloadService(process_workers=2, thread_workers=2)
+        hashes = metrics.CRYPTO_SECONDS.count(('UsersAPI.hash_passwords',))
+
+        try:
+            assert UsersAPI.signup_bulk(users, orm_session, offload['password'])['created'] == 5
+            assert metrics.CRYPTO_SECONDS.count(('UsersAPI.hash_passwords',)) == hashes + 1
+            assert offload.stats()['password']['completed'] >= 1
+        finally:
+            offload.shutdown()
+
+        user = orm_session.query(DataBase.User).filter_by(email='bulk3@test.su').one()
+        assert user.password == HashAPI.hash_sha512('password3')
+
+    def test_hash_passwords_chunks(self, monkeypatch):
+        class Executor:
+            limit = 64
+            chunksizes = []
+
+            def map(self, fn, *iterables, chunksize=1):
+                self.chunksizes.append(chunksize)
+                return map(fn, *iterables)
+
+        monkeypatch.setattr(os, 'cpu_count', lambda: 32)
+        passwords = ['password{}'.format(i) for i in range(server.users.BULK_PARALLEL_THRESHOLD)]
+        assert UsersAPI.hash_passwords(passwords, Executor()) == [HashAPI.hash_sha512(p) for p in passwords]
+        monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+        UsersAPI.hash_passwords(passwords, Executor())
+        assert Executor.chunksizes == [16, 63]
+
+    def test_role_model_batch(self, orm_session):
+        applied = RoleModel.apply_batch([
+            {'operation': 'add_role', 'role_name': 'admin'},
+            {'operation': 'add_method', 'method_name': 'change_file_dir'},
+            {'operation': 'add_method_to_role', 'method_name': 'change_file_dir', 'role_name': 'admin'},
+            {'operation': 'delete_method_from_role', 'method_name': 'delete_file', 'role_name': 'visitor'},
+            {'operation': 'change_shared_prop', 'method_name': 'get_files', 'value': True},
+            {'operation': 'change_user_role', 'email': 'user@test.su', 'role_name': 'admin'},
+        ], orm_session)
+        assert applied == 6
+        assert RoleModel.has_access('admin', 'change_file_dir') and RoleModel.has_access('admin', 'get_files')
+        assert not RoleModel.has_access('visitor', 'delete_file')
+        assert orm_session.query(DataBase.User).first().role.name == 'admin'
+
+    def test_role_model_batch_rollback(self, orm_session):
+        with pytest.raises(AssertionError):
+            RoleModel.apply_batch([
+                {'operation': 'add_role', 'role_name': 'admin'},
+                {'operation': 'delete_method_from_role', 'method_name': 'unknown', 'role_name': 'visitor'},
+            ], orm_session)
+        assert orm_session.query(DataBase.Role).count() == 1
+
+        with pytest.raises(AssertionError):
+            RoleModel.apply_batch([{'operation': 'add_role', 'role_name': ['admin']}], orm_session)
+
+        for operation in ({'operation': 'add_role', 'role_name': 'admin', 'shared': True},
+                          {'operation': 'add_method_to_role', 'method_name': 'get_files'}):
+            with pytest.raises(AssertionError):
+                RoleModel.apply_batch([{'operation': 'add_method', 'method_name': 'test'}, operation], orm_session)
+
+        assert orm_session.query(DataBase.Method).filter_by(name='test').count() == 0
+
+    def test_role_model_batch_rebuild_failure(self, orm_session, monkeypatch):
+        def rebuild_permissions(db_session=None):
+            raise RuntimeError('database is unavailable')
+
+        monkeypatch.setattr(RoleModel, 'rebuild_permissions', rebuild_permissions)
+        monkeypatch.setattr(RoleModel, 'permissions_updated', time.monotonic())
+        assert RoleModel.apply_batch([{'operation': 'add_role', 'role_name': 'admin'}], orm_session) == 1
+        assert orm_session.query(DataBase.Role).filter_by(name='admin').count() == 1
+        assert RoleModel.permissions_expired()
+
+    def test_permissions_expired(self, monkeypatch):
+        monkeypatch.setenv('ROLE_MODEL_CACHE_SECONDS', '5')
+        monkeypatch.setattr(RoleModel, 'permissions_updated', time.monotonic())
+        assert not RoleModel.permissions_expired()
+        monkeypatch.setattr(RoleModel, 'permissions_updated', time.monotonic() - 10)
+        assert RoleModel.permissions_expired()
+
+    def test_unknown_load_profile(self):
+        with pytest.raises(AssertionError):
+            DataBase.load_options('unknown')
+
+
+class TestJobQueue:
+
+    def test_bounded(self, tmp_path):
+        queue = JobQueue(str(tmp_path / 'queue.db'), maxsize=2)
+        queue.put({'filename': 'a'})
+        queue.put({'filename': 'b'})
+
+        with pytest.raises(Full):
+            queue.put({'filename': 'c'})
+
+    def test_bounded_shared(self, tmp_path):
+        queues = [JobQueue(str(tmp_path / 'queue.db'), maxsize=3) for _ in range(4)]
+        results = []
+
+        def put(queue):
+            for _ in range(5):
+                try:
+                    results.append(queue.put({'filename': 'a'}))
+                except Full:
+                    pass
+
+        threads = [Thread(target=put, args=(queue,)) for queue in queues]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        assert len(results) == 3 and queues[0].qsize() == 3
+
+    def test_at_least_once(self, tmp_path):
+        path = str(tmp_path / 'queue.db')
+        queue = JobQueue(path, lease=0.2)
+        job_id = queue.put({'filename': 'a'})
+        assert queue.get(timeout=0) == (job_id, {'filename': 'a'})
+        queue.close()
+
+        queue = JobQueue(path)
+
+        with pytest.raises(Empty):
+            queue.get(timeout=0)
+
+        time.sleep(0.3)
+        assert queue.get(timeout=0) == (job_id, {'filename': 'a'})
+        queue.done(job_id)
+        assert queue.status(job_id)['status'] == 'done'
+
+        with pytest.raises(Empty):
+            queue.get(timeout=0)
+
+    def test_user_jobs(self, tmp_path):
+        queue = JobQueue(str(tmp_path / 'queue.db'))
+        job_id = queue.put({'filename': 'a', 'user_id': 1})
+        assert queue.status(job_id, 2) is None
+        assert not queue.cancel(job_id, 2)
+        assert queue.status(job_id, 1)['status'] == 'queued'
+        assert queue.cancel(job_id, 1)
+        assert queue.status(job_id)['status'] == 'cancelled'
+
+    def test_retry(self, tmp_path):
+        queue = JobQueue(str(tmp_path / 'queue.db'), max_attempts=2)
+        job_id = queue.put({'filename': 'a'})
+
+        for _ in range(2):
+            queue.get(timeout=0)
+            queue.failed(job_id, 'error')
+
+        assert queue.status(job_id)['status'] == 'failed'
+        assert queue.status(job_id)['attempts'] == 2
+
+    def test_priority(self, tmp_path):
+        queue = JobQueue(str(tmp_path / 'queue.db'))
+        bulk_id = queue.put({'filename': 'bulk'}, BULK)
+        interactive_id = queue.put({'filename': 'interactive'}, INTERACTIVE)
+        assert queue.get(timeout=0)[0] == interactive_id
+
+        with pytest.raises(Empty):
+            queue.get(timeout=0, max_priority=INTERACTIVE)
+
+        assert queue.get(timeout=0)[0] == bulk_id
+
+    def test_progress_and_cancel(self, tmp_path):
+        queue = JobQueue(str(tmp_path / 'queue.db'))
+        job_id = queue.put({'filename': 'a'})
+        queue.get(timeout=0)
+        queue.progress(job_id, 50, 100)
+        status = queue.status(job_id)
+        assert status['copied'] == 50 and status['total'] == 100 and status['eta'] is not None
+        assert queue.cancel(job_id)
+
+        with pytest.raises(JobCancelled):
+            queue.progress(job_id, 60)
+
+        queue.done(job_id)
+        assert queue.status(job_id)['status'] == 'cancelled'
+        assert not queue.cancel(job_id)
+
+    def test_shared_between_instances(self, tmp_path):
+        path = str(tmp_path / 'queue.db')
+        first, second = JobQueue(path, lease=0.2), JobQueue(path, poll_interval=0.05)
+        job_id = first.put({'filename': 'a'})
+        started = time.monotonic()
+        assert second.get(timeout=1) == (job_id, {'filename': 'a'})
+        assert time.monotonic() - started < 1
+
+        with pytest.raises(Empty):
+            first.get(timeout=0)
+
+        second.progress(job_id, 10, 40)
+        status = first.status(job_id)
+        assert status['status'] == 'running' and status['copied'] == 10 and status['total'] == 40
+
+        first.done(job_id)
+        assert first.status(job_id)['status'] == 'running'
+        second.done(job_id)
+        assert first.status(job_id)['status'] == 'done'
+
+    def test_expired_lease(self, tmp_path):
+        path = str(tmp_path / 'queue.db')
+        dead = JobQueue(path, max_attempts=1, lease=0.1)
+        job_id = dead.put({'filename': 'a'})
+        dead.get(timeout=0)
+        time.sleep(0.2)
+        queue = JobQueue(path, max_attempts=1)
+
+        with pytest.raises(Empty):
+            queue.get(timeout=0)
+
+        assert queue.status(job_id)['status'] == 'failed'
+
+        with pytest.raises(JobCancelled):
+            dead.progress(job_id, 10)
+
+    def test_loader_survives_error(self, tmp_path, monkeypatch):
+        def download_file(self, filename, is_signed, user_id, progress=None):
+            if filename == 'bad':
+                raise KeyError(filename)
+
+        monkeypatch.setattr(QueuedLoader, 'download_file', download_file)
+        queue = JobQueue(str(tmp_path / 'queue.db'), max_attempts=1, poll_interval=0.05)
+        bad_id, good_id = queue.put({'filename': 'bad'}), queue.put({'filename': 'good'})
+        QueuedLoader(queue).start()
+        deadline = time.monotonic() + 5
+
+        while queue.status(good_id)['status'] != 'done' and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        assert queue.status(bad_id)['status'] == 'failed' and 'KeyError' in queue.status(bad_id)['error']
+        assert queue.status(good_id)['status'] == 'done'
+
+
+class TestLoaderPool:
+
+    def test_limits(self, monkeypatch):
+        started, release = Event(), Event()
+
+        def download_file(self, filename, is_signed, user_id):
+            started.set()
+            release.wait()
+            return filename
+
+        monkeypatch.setattr(PooledLoader, 'download_file', download_file)
+        pool = LoaderPool(workers=1, queue_size=1, user_limit=2)
+        futures = [pool.submit('a', False, 1)]
+        assert started.wait(timeout=5)
+        futures.append(pool.submit('b', False, 1))
+
+        with pytest.raises(Full):
+            pool.submit('c', False, 1)
+
+        with pytest.raises(Full):
+            pool.submit('c', False, 2)
+
+        release.set()
+        assert [future.result(timeout=5) for future in futures] == ['a', 'b']
+        assert pool.submit('c', False, 1).result(timeout=5) == 'c'
+
+
+class TestBaseLoader:
+
+    def test_get_paths(self, database, tmp_path, monkeypatch):
+        src = tmp_path / 'test.txt'
+        src.write_text('test')
+        monkeypatch.setattr(BaseLoader, 'get_source_path', staticmethod(lambda *args: str(src)))
+        monkeypatch.setenv('LOADER_HOME_DIR', str(tmp_path / 'home'))
+        session = database.create_session()
+        session.add(DataBase.User('user@test.su', 'password1234', '../../etc'))
+        session.commit()
+        user_id = session.query(DataBase.User.id).scalar()
+        session.close()
+        assert BaseLoader.get_paths('test.txt', False, user_id) == (
+            str(src), str((tmp_path / 'home' / str(user_id) / 'test.txt').resolve()))
+
+        with pytest.raises(AssertionError):
+            BaseLoader.get_paths('test.txt', False, user_id + 1)
+
+
+class TestAsyncLoader:
+
+    def test_copy_file(self, tmp_path):
+        src, dst = tmp_path / 'src.txt', tmp_path / 'dst.txt'
+        src.write_bytes(os.urandom(100000))
+        assert copy_file(str(src), str(dst), chunk_size=4096) == 100000
+        assert dst.read_bytes() == src.read_bytes()
+
+    async def test_copy(self, tmp_path):
+        src, dst = tmp_path / 'src.txt', tmp_path / 'dst.txt'
+        src.write_bytes(os.urandom(100000))
+        handle = AsyncLoader(workers=2, chunk_size=4096).copy(str(src), str(dst))
+        assert await handle == str(dst)
+        assert handle.progress == 1.0 and dst.read_bytes() == src.read_bytes()
+
+    async def test_cancel(self, tmp_path):
+        src, dst = tmp_path / 'src.txt', tmp_path / 'dst.txt'
+        src.write_bytes(os.urandom(1000000))
+        handle = AsyncLoader(workers=1, chunk_size=1024).copy(str(src), str(dst))
+
+        while not handle.copied:
+            await asyncio.sleep(0)
+
+        handle.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await handle
+
+        assert not dst.exists()
+
+    async def test_copy_error(self, tmp_path, monkeypatch):
+        src, dst = tmp_path / 'src.txt', tmp_path / 'dst.txt'
+        src.write_bytes(os.urandom(100000))
+
+        def copy_chunk(src_fd, dst_fd, offset, size):
+            if offset:
+                raise OSError('No space left on device')
+            return os.pwrite(dst_fd, os.pread(src_fd, size, offset), offset)
+
+        monkeypatch.setattr(server.file_loader, 'reflink', lambda src_fd, dst_fd: False)
+        monkeypatch.setattr(server.file_loader, 'copy_chunk', copy_chunk)
+
+        with pytest.raises(OSError):
+            await AsyncLoader(workers=1, chunk_size=4096).copy(str(src), str(dst))
+
+        assert not dst.exists()
+
+
+class TestArchive:
+
+    async def test_stream_archive(self, tmp_path):
+        paths = []
+
+        for i in range(3):
+            path = tmp_path / 'test{}.txt'.format(i)
+            path.write_text(test_content * (i + 1))
+            paths.append(str(path))
+
+        for archive_format, reader in (('zip', lambda data: zipfile.ZipFile(data).read('test2.txt')),
+                                       ('tar', lambda data: tarfile.open(fileobj=data).extractfile('test2.txt').read())):
+            chunks = []
+
+            async def write(data):
+                chunks.append(data)
+
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, write_archive, paths, StreamWriter(write, loop), archive_format)
+            assert reader(io.BytesIO(b''.join(chunks))).decode() == test_content * 3
+
+
+class TestFileService:
+
+    def test_sharded_layout(self, file_service, tmp_path):
+        flat = os.path.splitext(file_service.create_file(test_content)['name'])[0]
+        file_service.shard_depth = 2
+        sharded = os.path.splitext(file_service.create_file(test_content)['name'])[0]
+        assert len(file_service.get_files()) == 2
+        assert file_service.get_file_data(flat)['content'] == test_content
+        assert file_service.migrate_layout() == 1
+        assert not [path for path in tmp_path.iterdir() if path.is_file()]
+        assert len(file_service.get_files()) == 2
+
+        for filename in (flat, sharded):
+            assert file_service.get_file_data(filename)['content'] == test_content
+            assert file_service.delete_file(filename)
+
+        assert not file_service.get_files()
+
+    def test_file_meta_record(self, file_service):
+        created = file_service.create_file(test_content)
+        meta = file_service.get_files()[0]
+        assert isinstance(meta, FileMeta) and not hasattr(meta, '__dict__')
+        assert meta['name'] == created['name'] and meta['size'] == created['size']
+        assert dict(meta) == {key: created[key] for key in ('name', 'size', 'create_date', 'edit_date')}
+        assert json.loads(json.dumps([meta], default=utils.json_default)) == [dict(meta)]
+
+    def test_content_cache(self, file_service):
+        filename = os.path.splitext(file_service.create_file(test_content)['name'])[0]
+        hits = file_service.content_cache.hits
+
+        for _ in range(3):
+            assert file_service.get_file_data(filename)['content'] == test_content
+
+        assert file_service.content_cache.hits - hits == 3
+
+        with open(file_service.get_file_path(filename), 'a') as file:
+            file.write('changed')
+
+        assert not file_service.get_file_data(filename)
+        assert FileService.get_file_data(file_service, filename)['content'] == test_content + 'changed'
+        file_service.delete_file(filename)
+        assert file_service.content_cache.stats()['entries'] == 0
+
+    def test_mapped_content(self, file_service):
+        content = 'line\r\n' * 1000
+        file_service.mmap_threshold = 1024
+        filename = os.path.splitext(file_service.create_file(content)['name'])[0]
+        file_data = file_service.get_file_data(filename)
+        assert isinstance(file_data['content'], FileContent)
+        assert str(file_data['content']) == FileService.get_file_data(file_service, filename)['content']
+        assert bytes(file_data['content'][6:12]) == b'line\r\n'
+        assert b''.join(file_data['content'].iter_chunks(100)) == content.encode()
+        file_service.mmap_threshold = 1 << 30
+        assert file_service.get_file_data(filename)['content'] == str(file_data['content'])
+
+    def test_mapped_content_changed(self, file_service):
+        file_service.mmap_threshold = 1024
+        filename = os.path.splitext(file_service.create_file('line\n' * 1000)['name'])[0]
+        content = file_service.get_file_data(filename)['content']
+
+        with open(file_service.get_file_path(filename), 'r+') as file:
+            file.truncate(100)
+
+        with pytest.raises(AssertionError):
+            content.decode()
+
+    def test_etag(self, file_service):
+        filename = os.path.splitext(file_service.create_file(test_content)['name'])[0]
+        etag, last_modified = file_service.get_file_etag(filename)
+        plain_etag, _ = FileService.get_file_etag(file_service, filename)
+        assert etag.startswith('"') and etag.endswith(plain_etag[1:]) and etag != plain_etag
+        requests = (
+            ({'If-None-Match': etag}, True),
+            ({'If-None-Match': 'W/"other", {}'.format(etag)}, True),
+            ({'If-None-Match': '"other"', 'If-Modified-Since': formatdate(last_modified, usegmt=True)}, False),
+            ({'If-Modified-Since': formatdate(last_modified, usegmt=True)}, True),
+            ({'If-Modified-Since': formatdate(last_modified - 60, usegmt=True)}, False),
+            ({}, False),
+        )
+
+        for headers, expected in requests:
+            request = make_mocked_request('GET', '/files/{}'.format(filename), headers=headers)
+            assert Handler.not_modified(request, etag, last_modified) is expected
+
+        request = make_mocked_request('GET', '/', headers={'If-None-Match': compression.encoded_etag(etag, 'gzip')})
+        assert Handler.not_modified(request, etag, last_modified)
+
+    def test_precompressed_file(self, file_service):
+        file_service.shard_depth = 1
+        file_service.precompress = True
+        filename = os.path.splitext(file_service.create_file(test_content)['name'])[0]
+        gz_path = file_service.get_compressed_file(filename)
+        assert os.path.dirname(gz_path) == os.path.dirname(file_service.get_file_path(filename))
+
+        with gzip.open(gz_path, 'rt') as gz_file:
+            assert gz_file.read() == test_content
+
+        assert file_service.get_files()[0]['name'] == '{}.txt'.format(filename)
+        os.utime(file_service.get_file_path(filename), ns=(0, os.stat(gz_path).st_mtime_ns + 1))
+        assert file_service.get_compressed_file(filename) is None
+        file_service.delete_file(filename)
+        assert not os.path.exists(gz_path)
+
+    def test_plain_storage_not_sniffed(self, file_service, monkeypatch):
+        filename = os.path.splitext(file_service.create_file(test_content)['name'])[0]
+        sniffed = []
+        monkeypatch.setattr(server.file_service, 'is_compressed', lambda path: sniffed.append(path))
+        assert not file_service.sniff_compressed
+        assert file_service.get_files()[0]['size'] == len(test_content)
+        assert file_service.get_compressed_file(filename) is None
+        assert file_service.get_file_data(filename)['content'] == test_content
+        assert not sniffed
+
+    def test_compressed_storage(self, file_service):
+        plain_name = os.path.splitext(file_service.create_file(test_content)['name'])[0]
+        file_service.compress_storage = True
+        file_service.mmap_threshold = 1
+        content = 'Compressed line\r\n' * 1000
+        created = file_service.create_file(content)
+        filename = os.path.splitext(created['name'])[0]
+        path = file_service.get_file_path(filename)
+        expected = content.replace('\r\n', '\n')
+        assert os.path.getsize(path) < len(content) // 10 and created['size'] == len(content)
+        assert created['content'] == expected
+
+        file_service.content_cache.clear()
+        file_data = file_service.get_file_data(filename)
+        assert file_data['content'] == expected and file_data['size'] == len(content)
+        assert file_service.get_compressed_file(filename) == path
+        assert file_service.get_file_data(plain_name)['content'] == test_content
+        assert sorted(meta['size'] for meta in file_service.get_files()) == [len(test_content), len(content)]
+
+        file_service.compress_storage = False
+        file_service.content_cache.clear()
+        # compressed files stored earlier are sniffed after restart too
+        file_service.path = file_service.path
+        assert file_service.sniff_compressed
+        assert FileService.get_file_data(file_service, filename)['content'] == expected
+        assert file_service.get_file_data(filename)['size'] == len(content)
+        assert file_service.content_cache.stats()['bytes'] == len(content)
+
+    async def test_compressed_copies(self, file_service, tmp_path):
+        file_service.compress_storage = True
+        content = 'Compressed line\r\n' * 1000
+        path = file_service.get_file_path(os.path.splitext(file_service.create_file(content)['name'])[0])
+        assert copy_file(path, str(tmp_path / 'copy.txt'), chunk_size=4096) == len(content)
+        assert (tmp_path / 'copy.txt').read_bytes() == content.encode()
+        handle = AsyncLoader(workers=1, chunk_size=4096).copy(path, str(tmp_path / 'async.txt'))
+        await handle
+        assert handle.progress == 1.0 and (tmp_path / 'async.txt').read_bytes() == content.encode()
+        name = os.path.basename(path)
+
+        for archive_format, reader in (('zip', lambda data: zipfile.ZipFile(data).read(name)),
+                                       ('tar', lambda data: tarfile.open(fileobj=data).extractfile(name).read())):
+            data = io.BytesIO()
+            write_archive([path], data, archive_format)
+            data.seek(0)
+            assert reader(data) == content.encode()
+
+
+class TestCompression:
+
+    def test_negotiate(self):
+        assert compression.negotiate('gzip, deflate') == 'gzip'
+        assert compression.negotiate('deflate;q=1, gzip;q=0.5') == 'deflate'
+        assert compression.negotiate('gzip;q=0, deflate;q=0') is None
+        assert compression.negotiate('*;q=0.1') == compression.ENCODINGS[0]
+        assert compression.negotiate('br') is None
+        assert compression.negotiate(None) is None
+        assert compression.accepts('*', 'gzip') and not compression.accepts('deflate', 'gzip')
+
+    async def test_json_response(self, monkeypatch):
+        monkeypatch.setitem(os.environ, 'COMPRESSION_EXECUTOR_BYTES', '0')
+        data = {'status': 'success', 'data': [test_content] * 100}
+        request = make_mocked_request('GET', '/files', headers={'Accept-Encoding': 'deflate'})
+        response = await Handler.json_response(request, data, {'ETag': '"tag"'})
+        assert response.headers['Content-Encoding'] == 'deflate' and response.headers['ETag'] == '"tag-deflate"'
+        assert json.loads(zlib.decompress(response.body)) == data
+
+        request = make_mocked_request('GET', '/files', headers={'Accept-Encoding': 'gzip'})
+        response = await Handler.json_response(request, {'status': 'success'}, {'ETag': '"tag"'})
+        assert 'Content-Encoding' not in response.headers and response.headers['ETag'] == '"tag"'
+        assert response.headers['Vary'] == 'Accept-Encoding'
+
+
+class TestContentCache:
+
+    def test_eviction(self, tmp_path):
+        cache = ContentCache(max_bytes=250, max_item_bytes=100)
+        stats = {}
+
+        for name, size in (('a', 100), ('b', 100), ('c', 100), ('d', 101)):
+            path = tmp_path / name
+            path.write_bytes(b'x' * size)
+            stats[name] = os.stat(str(path))
+            cache.put(str(path), stats[name], name)
+
+        assert cache.get(str(tmp_path / 'a'), stats['a']) is None
+        assert cache.get(str(tmp_path / 'b'), stats['b']) == 'b'
+        assert cache.get(str(tmp_path / 'd'), stats['d']) is None
+        assert cache.stats()['evictions'] == 1 and cache.bytes == 200
+
+
+class TestOffload:
+
+    async def test_limit_and_timeout(self, monkeypatch):
+        monkeypatch.setitem(os.environ, 'OFFLOAD_HASH_LIMIT', '1')
+        monkeypatch.setitem(os.environ, 'OFFLOAD_HASH_TIMEOUT_SECONDS', '0.1')
+        offload = OffloadService(process_workers=1, thread_workers=2, categories={'hash': 'thread'})
+        started, release = Event(), Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+            return 'released'
+
+        try:
+            assert await offload.run('hash', HashAPI.hash_md5, 'data') == HashAPI.hash_md5('data')
+            future = offload['hash'].submit(block)
+            started.wait(5)
+
+            with pytest.raises(OffloadFull):
+                await offload.run('hash', HashAPI.hash_md5, 'data')
+
+            release.set()
+            assert future.result(5) == 'released'
+
+            with pytest.raises(asyncio.TimeoutError):
+                await offload.run('hash', time.sleep, 1)
+
+            stats = offload.stats()['hash']
+            assert stats['rejected'] == 1 and stats['timeouts'] == 1 and stats['completed'] == 2
+        finally:
+            offload.shutdown()
+
+    def test_map(self):
+        offload = OffloadService(process_workers=2, thread_workers=1)
+
+        try:
+            passwords = ['password{}'.format(i) for i in range(10)]
+            hashes = list(offload['password'].map(HashAPI.hash_sha512, passwords, chunksize=3))
+            assert hashes == [HashAPI.hash_sha512(password) for password in passwords]
+            assert offload.stats()['password']['submitted'] == 4
+        finally:
+            offload.shutdown()
+
+    def test_map_limit(self, monkeypatch):
+        monkeypatch.setitem(os.environ, 'OFFLOAD_PASSWORD_LIMIT', '2')
+        offload = OffloadService(process_workers=2, thread_workers=1)
+
+        try:
+            passwords = ['password{}'.format(i) for i in range(10)]
+            hashes = list(offload['password'].map(HashAPI.hash_sha512, passwords))
+            assert hashes == [HashAPI.hash_sha512(password) for password in passwords]
+            assert offload.stats()['password']['submitted'] == 2
+            assert offload.stats()['password']['rejected'] == 0
+        finally:
+            offload.shutdown()
+
+
+class TestAdmission:
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=2, burst=2, max_keys=2)
+        assert limiter.acquire('a', now=0) == 0 and limiter.acquire('a', now=0) == 0
+        assert limiter.acquire('a', now=0) == 0.5
+        assert limiter.acquire('a', now=0.5) == 0
+        assert limiter.acquire('b', now=0.5, rate=1, burst=1) == 0 and limiter.acquire('b', now=0.5) == 0.5
+        limiter.acquire('c', now=1)
+        assert list(limiter.buckets) == ['b', 'c']
+
+    async def test_middleware(self, aiohttp_client):
+        admission = AdmissionControl(rate=100, burst=100, concurrency=1, max_queue=1, queue_timeout=0.2,
+                                     endpoint_limits={'GET /files/{filename}': (1, 2)}, exempt=['GET /metrics'])
+        release = asyncio.Event()
+
+        async def slow(request):
+            await release.wait()
+            return web.Response(text='slow')
+
+        async def fast(request):
+            if request.headers.get('Authorization') == 'session-1':
+                request['user_id'] = 1
+            return web.Response(text='fast')
+
+        app = web.Application(middlewares=[admission.middleware])
+        app.add_routes([web.get('/slow', slow), web.get('/files/{filename}', fast), web.get('/other/{name}', fast),
+                        web.get('/metrics', fast)])
+        client = await aiohttp_client(app)
+        statuses = [(await client.get('/files/a', headers={'Authorization': session})).status
+                    for session in ('session-1', 'forged-1', 'forged-2')]
+        assert statuses == [200, 200, 429]
+        assert admission.sessions == {'session-1': 1}
+        assert (await client.get('/files/a', headers={'Authorization': 'session-1'})).status == 200
+
+        slow_request = asyncio.ensure_future(client.get('/slow'))
+
+        while not admission.in_flight:
+            await asyncio.sleep(0.01)
+
+        queued = asyncio.ensure_future(client.get('/other/b'))
+        await asyncio.sleep(0.05)
+        assert (await client.get('/other/c')).status == 503
+        assert (await queued).status == 503
+        assert (await client.get('/metrics')).status == 200
+        release.set()
+        assert (await slow_request).status == 200
+        assert admission.stats()['shed'] == 2 and admission.stats()['rate_limited'] == 1
+
+
+class TestMetrics:
+
+    def test_histogram(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram('test_seconds', 'Test.', ('op',), buckets=(0.1, 1))
+
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, ('a"b',))
+
+        registry.gauge('test_ratio', 'Test ratio.', lambda: 0.5)
+        registry.gauge('test_total', 'Test total.', lambda: {('a',): 1, ('b',): 2}, 'counter', ('service',))
+        registry.gauge('test_broken', 'Broken.', lambda: 1 / 0)
+        lines = registry.render().splitlines()
+        assert 'test_seconds_bucket{op="a\\"b",le="0.1"} 2' in lines
+        assert 'test_seconds_bucket{op="a\\"b",le="+Inf"} 4' in lines
+        assert 'test_seconds_count{op="a\\"b"} 4' in lines and 'test_ratio 0.5' in lines
+        assert 'test_total{service="a"} 1' in lines and 'test_total{service="b"} 2' in lines
+        assert not any('test_broken' in line for line in lines)
+
+    def test_instrumentation(self, file_service, orm_session):
+        operation = ('FileServiceSigned.get_file_data',)
+        reads = metrics.FILE_SERVICE_SECONDS.count(operation)
+        hashes = metrics.CRYPTO_SECONDS.count(('HashAPI.hash_md5_parts',))
+        read_bytes = metrics.FILE_READ_BYTES.value()
+        filename = os.path.splitext(file_service.create_file(test_content)['name'])[0]
+        file_service.content_cache.clear()
+        file_service.get_file_data(filename)
+        assert metrics.FILE_SERVICE_SECONDS.count(operation) == reads + 1
+        assert metrics.CRYPTO_SECONDS.count(('HashAPI.hash_md5_parts',)) >= hashes + 2
+        assert metrics.FILE_READ_BYTES.value() >= read_bytes + len(test_content)
+
+        metrics.instrument_database()
+        queries = metrics.DB_QUERY_SECONDS.count()
+
+        with DataBase.count_queries() as counter:
+            orm_session.query(DataBase.User).all()
+
+        assert metrics.DB_QUERY_SECONDS.count() == queries + counter.count > queries
+
+        with pytest.raises(OperationalError):
+            orm_session.execute('SELECT * FROM missing')
+
+        orm_session.rollback()
+        queries = metrics.DB_QUERY_SECONDS.count()
+
+        with DataBase.count_queries() as counter:
+            orm_session.query(DataBase.User).all()
+
+        assert metrics.DB_QUERY_SECONDS.count() == queries + counter.count
+        assert 'metrics_started' not in orm_session.connection().info
+
+    async def test_middleware(self, aiohttp_client):
+        async def get_file(request):
+            return web.Response(text=test_content)
+
+        app = web.Application(middlewares=[metrics.middleware])
+        app.add_routes([web.get('/files/{filename}', get_file), web.get('/metrics', metrics.handle_metrics)])
+        client = await aiohttp_client(app)
+        labels = ('GET', '/files/{filename}')
+        sent = metrics.RESPONSE_BYTES.value(labels)
+        assert (await client.get('/files/a')).status == 200
+        assert (await client.get('/files/b')).status == 200
+        assert (await client.get('/unknown')).status == 404
+        response = await client.get('/metrics')
+        assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+        text = await response.text()
+        assert metrics.REQUEST_SECONDS.count(labels + (200,)) >= 2
+        assert metrics.RESPONSE_BYTES.value(labels) == sent + 2 * len(test_content)
+        assert 'http_request_duration_seconds_count{method="GET",route="unmatched",status="404"}' in text
+
+
+class TestTracing:
+
+    def test_spans(self, file_service):
+        filename = os.path.splitext(file_service.create_file(test_content)['name'])[0]
+        file_service.content_cache.clear()
+        trace = tracing.Trace('GET /files/{filename}', 256)
+        offload = OffloadService(1, 1)
+
+        try:
+            with trace.root:
+                future = offload['hash'].submit(file_service.get_file_data, filename)
+                assert future.result()['content'] == test_content
+        finally:
+            offload.shutdown()
+
+        file_service.get_file_data(filename)
+        stages = {stage['name']: stage for stage in trace.breakdown()}
+        assert set(stages) == {'GET /files/{filename}', 'FileServiceSigned.get_file_data', 'FileService.get_file_data',
+                               'FileService.read_content', 'HashAPI.hash_md5_parts'}
+        assert all(stage['count'] == 1 and 0 <= stage['self_ms'] <= stage['total_ms'] for stage in stages.values())
+        spans = trace.to_dict()['spans']
+        assert [span['depth'] for span in spans] == [0, 1, 2, 3, 2]
+        assert spans[1]['thread'] != spans[0]['thread']
+
+        trace = tracing.Trace('test', 2)
+
+        with trace.root:
+            with tracing.span('stage'):
+                with pytest.raises(ValueError):
+                    with tracing.span('failed'):
+                        raise ValueError()
+
+        assert [span.name for span in trace.spans] == ['test', 'stage'] and trace.dropped == 1
+        assert tracing.span('stage') is tracing.NO_SPAN
+
+    async def test_middleware(self, aiohttp_client):
+        @tracing.traced
+        async def stage():
+            await asyncio.sleep(0.01)
+
+        async def get_file(request):
+            await stage()
+            return web.Response(text=test_content)
+
+        tracer = tracing.Tracer(sample_rate=0, buffer_size=2, exempt=['GET /debug/traces'])
+        app = web.Application(middlewares=[tracer.middleware])
+        app.add_routes([web.get('/files/{filename}', get_file), web.get('/debug/traces', tracer.handle_traces)])
+        client = await aiohttp_client(app)
+        assert not tracer.debug
+        assert 'X-Trace-Id' not in (await client.get('/files/a', headers={'X-Trace': '1'})).headers
+        assert (await client.get('/debug/traces')).status == 404
+        assert not tracer.traces
+
+        tracer.debug = True
+        assert 'X-Trace-Id' not in (await client.get('/files/a')).headers
+
+        for _ in range(3):
+            response = await client.get('/files/a', headers={'X-Trace': '1'})
+            assert response.status == 200 and response.headers['X-Trace-Id']
+
+        assert (await client.get('/unknown', headers={'X-Trace': '1'})).status == 404
+        assert [trace.status for trace in tracer.traces] == [200, 404]
+        assert (await client.get('/debug/traces?limit=0')).status == 400
+        data = (await (await client.get('/debug/traces?limit=1', headers={'X-Trace': '1'})).json())['data']
+        assert len(data) == 1 and data[0]['trace_id'] == response.headers['X-Trace-Id']
+        assert data[0]['duration_ms'] >= 10 and data[0]['stages'][1]['name'].endswith('stage')
+        assert len(tracer.traces) == 2
+
+
+class TestApp:
+
+    async def test_create_app(self, aiohttp_client, database, tmp_path, monkeypatch):
+        monkeypatch.setenv('LOADER_QUEUE_PATH', str(tmp_path / 'queue.db'))
+        monkeypatch.setattr(RoleModel, 'permissions_updated', None)
+        database.init_system(RoleModel.methods, VISITOR_METHODS)
+        client = await aiohttp_client(create_app(str(tmp_path)))
+        user = {'email': 'user@test.su', 'password': 'password1234', 'confirm_password': 'password1234',
+                'name': 'User'}
+        assert (await client.get('/')).status == 200
+        assert (await client.get('/files/list')).status == 401
+        assert (await client.get('/files/list', headers={'Authorization': 'unknown'})).status == 401
+        assert (await client.post('/signup', json=user)).status == 200
+        assert (await client.post('/signup', json=user)).status == 400
+        assert (await client.post('/signin', json={'email': user['email'], 'password': 'wrong'})).status == 400
+        response = await client.post('/signin', json={'email': user['email'], 'password': user['password']})
+        headers = {'Authorization': (await response.json())['session_id']}
+        response = await client.get('/files/list', headers=headers)
+        assert response.status == 200 and (await response.json())['status'] == 'success'
+        assert (await client.put('/role/test', headers=headers)).status == 403
+        text = await (await client.get('/metrics')).text()
+        assert 'content_cache_evictions_total{service="plain"}' in text
+        assert ('content_cache_hits_total{service="signed"}' in text) == \
+            (FileService().content_cache is not FileServiceSigned().content_cache)
+        assert (await client.get('/logout', headers=headers)).status == 200
+        assert (await client.get('/files/list', headers=headers)).status == 401
+
+    @pytest.mark.parametrize('mmap_threshold', [1 << 30, 1024])
+    async def test_get_file_content(self, app_client, monkeypatch, mmap_threshold):
+        content = 'line\r\n' * 1000
+        monkeypatch.setattr(FileService(), 'mmap_threshold', mmap_threshold)
+        filename = os.path.splitext(FileService().create_file(content)['name'])[0]
+        response = await app_client.get('/files/{}/content'.format(filename), headers={'Accept-Encoding': 'identity'})
+        assert response.status == 200 and response.content_length == len(content)
+        assert await response.read() == content.encode()
+        response = await app_client.get('/files/{}/content'.format(filename), headers={'Range': 'bytes=4-11'})
+        assert response.status == 206 and await response.read() == b'\r\nline\r\n'
+
+    async def test_download_file(self, app_client, database, tmp_path):
+        filename = os.path.splitext(FileService().create_file(test_content)['name'])[0]
+        response = await app_client.get('/files/download', params={'filename': filename})
+        assert response.status == 200 and (await response.json())['status'] == 'success'
+        assert (user_home(database, tmp_path) / '{}.txt'.format(filename)).read_text() == test_content
+        assert (await app_client.get('/files/download')).status == 400
+        assert (await app_client.get('/files/download', params={'filename': 'unknown'})).status == 400
+
+    async def test_download_file_async(self, app_client, database, tmp_path):
+        filename = os.path.splitext(FileService().create_file(test_content)['name'])[0]
+        response = await app_client.get('/files/download/async', params={'filename': filename})
+        assert response.status == 200 and (await response.json())['status'] == 'success'
+        assert (user_home(database, tmp_path) / '{}.txt'.format(filename)).read_text() == test_content
+        assert (await app_client.get('/files/download/async')).status == 400
+        assert (await app_client.get('/files/download/async', params={'filename': 'unknown'})).status == 400
+
+    async def test_download_file_queued(self, app_client, database, tmp_path):
+        filename = os.path.splitext(FileService().create_file(test_content)['name'])[0]
+        response = await app_client.get('/files/download/queued', params={'filename': filename, 'priority': 'bulk'})
+        assert response.status == 200
+        job_id = (await response.json())['data']['job_id']
+
+        for _ in range(100):
+            job = (await (await app_client.get('/files/download/jobs/{}'.format(job_id))).json())['data']
+
+            if job['status'] not in ('queued', 'running'):
+                break
+
+            await asyncio.sleep(0.05)
+
+        assert job['status'] == 'done'
+        assert (user_home(database, tmp_path) / '{}.txt'.format(filename)).read_text() == test_content
+        response = await app_client.get('/files/download/queued', params={'filename': filename, 'priority': 'urgent'})
+        assert response.status == 400
+        assert (await app_client.get('/files/download/queued')).status == 400
+
+    async def test_download_job_cancel(self, app_client, monkeypatch):
+        started, release = Event(), Event()
+
+        def download_file(self, filename, is_signed, user_id, progress):
+            progress(3, 10)
+            started.set()
+            release.wait(5)
+            progress(5, 10)
+
+        monkeypatch.setattr(QueuedLoader, 'download_file', download_file)
+        response = await app_client.get('/files/download/queued', params={'filename': 'test'})
+        job_id = (await response.json())['data']['job_id']
+        assert await asyncio.get_event_loop().run_in_executor(None, started.wait, 5)
+        job = (await (await app_client.get('/files/download/jobs/{}'.format(job_id))).json())['data']
+        assert job['status'] == 'running' and job['copied'] == 3 and job['total'] == 10
+        assert (await app_client.delete('/files/download/jobs/{}'.format(job_id))).status == 200
+        release.set()
+        job = (await (await app_client.get('/files/download/jobs/{}'.format(job_id))).json())['data']
+        assert job['status'] == 'cancelled'
+        assert (await app_client.delete('/files/download/jobs/{}'.format(job_id))).status == 404
+        assert (await app_client.get('/files/download/jobs/{}'.format(job_id + 1))).status == 404
+        assert (await app_client.get('/files/download/jobs/first')).status == 400
+        assert (await app_client.delete('/files/download/jobs/first')).status == 400
+
+    async def test_download_job_other_user(self, app_client, monkeypatch):
+        monkeypatch.setattr(QueuedLoader, 'download_file', lambda *args: Event().wait(5))
+        response = await app_client.get('/files/download/queued', params={'filename': 'test'})
+        job_id = (await response.json())['data']['job_id']
+        user = {'email': 'other@test.su', 'password': 'password1234', 'confirm_password': 'password1234',
+                'name': 'Other'}
+        assert (await app_client.post('/signup', json=user)).status == 200
+        response = await app_client.post('/signin', json={'email': user['email'], 'password': user['password']})
+        headers = {'Authorization': (await response.json())['session_id']}
+        url = '/files/download/jobs/{}'.format(job_id)
+        assert (await app_client.get(url, headers=headers)).status == 404
+        assert (await app_client.delete(url, headers=headers)).status == 404
+        assert (await (await app_client.get(url)).json())['data']['status'] in ('queued', 'running')
+        assert (await app_client.delete(url)).status == 200
+
+    async def test_download_files(self, app_client, database, tmp_path):
+        filenames = [os.path.splitext(FileService().create_file('{} {}'.format(test_content, i))['name'])[0]
+                     for i in range(3)]
+        contents = {'{}.txt'.format(filename): '{} {}'.format(test_content, i).encode()
+                    for i, filename in enumerate(filenames)}
+
+        response = await app_client.post('/files/download/batch', json={'filenames': filenames, 'archive': 'zip'})
+        assert response.status == 200 and response.headers['Content-Type'] == 'application/zip'
+
+        with zipfile.ZipFile(io.BytesIO(await response.read())) as archive:
+            assert {name: archive.read(name) for name in archive.namelist()} == contents
+
+        response = await app_client.post('/files/download/batch', json={'filenames': filenames, 'archive': 'tar'})
+        assert response.status == 200
+
+        with tarfile.open(fileobj=io.BytesIO(await response.read())) as archive:
+            assert {member.name: archive.extractfile(member).read() for member in archive.getmembers()} == contents
+
+        response = await app_client.post('/files/download/batch', json={'filenames': filenames})
+        assert response.status == 200 and (await response.json())['message'] == '3 files are downloaded'
+        assert {path.name: path.read_bytes() for path in user_home(database, tmp_path).iterdir()} == contents
+
+        response = await app_client.post('/files/download/batch', json={'filenames': filenames, 'archive': 'rar'})
+        assert response.status == 400
+        assert (await app_client.post('/files/download/batch', json={'filenames': []})).status == 400
+        assert (await app_client.post('/files/download/batch', json={'filenames': ['unknown']})).status == 400
+        assert (await app_client.post('/files/download/batch', json=filenames)).status == 400
+
+    async def test_download_files_partial(self, app_client, database, tmp_path, monkeypatch):
+        filenames = [os.path.splitext(FileService().create_file(test_content)['name'])[0] for _ in range(3)]
+        home = user_home(database, tmp_path)
+        response = await app_client.post('/files/download/batch', json={'filenames': filenames + ['unknown']})
+        assert response.status == 400 and not list(home.iterdir())
+
+        copy = AsyncLoader.copy
+
+        def failing_copy(self, src, dst):
+            if dst.endswith('{}.txt'.format(filenames[1])):
+                raise OSError(28, 'No space left on device')
+
+            return copy(self, src, dst)
+
+        monkeypatch.setattr(AsyncLoader, 'copy', failing_copy)
+        response = await app_client.post('/files/download/batch', json={'filenames': filenames})
+        assert response.status == 500 and 'No space left on device' in await response.text()
+        assert not list(home.iterdir())
+
+    async def test_signup_bulk(self, app_client):
+        response = await app_client.post('/signin', json={'email': os.environ['ADMIN_EMAIL'],
+                                                          'password': os.environ['ADMIN_PASSWORD']})
+        headers = {'Authorization': (await response.json())['session_id']}
+        user = {'email': 'bulk@test.su', 'password': 'password1234', 'confirm_password': 'password1234',
+                'name': 'Bulk'}
+        assert (await app_client.post('/signup/bulk', json=[user], headers=headers)).status == 400
+        assert (await app_client.post('/signup/bulk', json='users', headers=headers)).status == 400
+        response = await app_client.post('/signup/bulk', json={'users': [user]}, headers=headers)
+        assert response.status == 200 and (await response.json())['data']['created'] == 1
+
+    async def test_trace_access_checks(self, app_client, monkeypatch):
+        monkeypatch.setattr(RoleModel, 'permissions_updated', None)
+        tracer = app_client.server.app['tracer']
+        tracer.debug = True
+        response = await app_client.get('/files/list', headers={'X-Trace': '1'})
+        assert response.status == 200
+        spans = {span.name: span for span in tracer.traces[-1].spans}
+        assert spans['UsersAPI.authorized'].parent is tracer.traces[-1].root
+        assert spans['RoleModel.role_model'].parent is tracer.traces[-1].root
+        assert spans['UsersAPI.authorized'].end <= spans['RoleModel.role_model'].start
+
+    async def test_get_files(self, app_client):
+        name = FileService().create_file(test_content)['name']
+        response = await app_client.get('/files/list')
+        assert response.status == 200
+        assert [file['name'] for file in (await response.json())['data']] == [name]
+
+    @pytest.mark.parametrize('url', ['/files/{}', '/files?filename={}', '/files/{}/content'])
+    async def test_conditional_get(self, app_client, url):
+        filename = os.path.splitext(FileService().create_file(test_content)['name'])[0]
+        url = url.format(filename)
+        response = await app_client.get(url)
+        assert response.status == 200
+        etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+
+        response = await app_client.get(url, headers={'If-None-Match': etag})
+        assert response.status == 304 and response.headers['ETag'] == etag
+        assert (await app_client.get(url, headers={'If-None-Match': 'W/"other", {}'.format(etag)})).status == 304
+        assert (await app_client.get(url, headers={'If-Modified-Since': last_modified})).status == 304
+        # If-None-Match has precedence over If-Modified-Since
+        response = await app_client.get(url, headers={'If-None-Match': '"other"', 'If-Modified-Since': last_modified})
+        assert response.status == 200
+
+        path = FileService().get_file_path(filename)
+
+        with open(path, 'a') as file:
+            file.write(' changed')
+
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        response = await app_client.get(url, headers={'If-None-Match': etag})
+        assert response.status == 200 and response.headers['ETag'] != etag
+        assert (await app_client.get(url, headers={'If-Modified-Since': last_modified})).status == 200
+        assert (await app_client.get(url.replace(filename, 'unknown'), headers={'If-None-Match': etag})).status == 400
+
+
+PREFORK_SCRIPT = """
+import os
+import server
+from aiohttp import web
+from server.prefork import PreforkServer
+
+
+def create_app():
+    app = web.Application()
+    app.add_routes([web.get('/', lambda request: web.Response(text=str(os.getpid())))])
+    return app
+
+
+os.environ['PREFORK_HEARTBEAT_SECONDS'] = '0.2'
+os.environ['PREFORK_SHUTDOWN_TIMEOUT_SECONDS'] = '1'
+PreforkServer(create_app, '127.0.0.1', int(os.environ['TEST_PORT']), 2).run()
+"""
+
+
+class TestPrefork:
+
+    def test_reuse_port(self):
+        first = reuse_port_socket('127.0.0.1', 0)
+        second = reuse_port_socket('127.0.0.1', first.getsockname()[1])
+        assert first.getsockname() == second.getsockname()
+        first.close()
+        second.close()
+
+    def test_singleton_reset(self):
+        database = DataBase()
+        assert DataBase() is database
+        DataBase.reset()
+        assert DataBase() is not database
+
+    def test_workers(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+
+        env = dict(os.environ, TEST_PORT=str(port))
+        master = subprocess.Popen([sys.executable, '-c', PREFORK_SCRIPT], env=env,
+                                  cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+        def get_pids(expected_count):
+            pids = set()
+            deadline = time.monotonic() + 10
+
+            while len(pids) < expected_count and time.monotonic() < deadline:
+                try:
+                    with urllib.request.urlopen('http://127.0.0.1:{}/'.format(port), timeout=1) as response:
+                        pids.add(int(response.read()))
+                except OSError:
+                    time.sleep(0.05)
+
+            return pids
+
+        try:
+            pids = get_pids(2)
+            assert len(pids) == 2
+            os.kill(pids.pop(), signal.SIGKILL)
+            time.sleep(0.5)
+            assert len(get_pids(2) - pids) == 1
+            master.send_signal(signal.SIGHUP)
+            time.sleep(1)
+            new_pids = get_pids(2)
+            assert len(new_pids) == 2 and not new_pids & pids
+            master.send_signal(signal.SIGTERM)
+            assert master.wait(10) == 0
+        finally:
+            if master.poll() is None:
+                master.kill()
@@ -3,6 +3,7 @@ __author__ = 'idementyev@luxoft.com'
 __date__ = '2020-09-24'
 
 
+import json
 import pytest
 import server.utils as utils
 from datetime import datetime, timezone
@@ -21,6 +22,12 @@ def filename_alphanum():
     yield name
 
 
+@pytest.fixture()
+def generated_ids():
+    ids = [utils.generate_id() for _ in range(10000)]
+    yield ids
+
+
 @pytest.fixture()
 def date_format_zero():
     in_date = 0.0
@@ -43,10 +50,45 @@ class TestUtils:
         """Should consist only of alpha and numeric"""
         assert re.match(r'^[\w\d]+$', filename_alphanum)
 
+    def test_id_format(self, generated_ids):
+        """Should be 26 digits and upper case letters"""
+        assert all(re.match(r'^[0-9A-Z]{26}$', _id) for _id in generated_ids)
+
+    def test_id_unique_ordered(self, generated_ids):
+        """Should be unique and sorted by generation time"""
+        assert len(set(generated_ids)) == len(generated_ids)
+        assert sorted(generated_ids) == generated_ids
+
     def test_date_format_zero(self, date_format_zero):
         """Should return properly formatted string for 0-time"""
         assert date_format_zero == '1970-01-01 00:00:00'
 
+    def test_date_format_cached(self):
+        """Should match strftime for any timestamp"""
+        _format = '%Y-%m-%d %H:%M:%S'
+        for _ts in (-61.5, -0.5, 59.999, 1600000000.25, 1600000060.0):
+            _expected = datetime.fromtimestamp(_ts // 1, timezone.utc).strftime(_format)
+            assert utils.convert_date(_ts) == _expected
+
+    def test_timestamp_lazy(self):
+        """Should be raw number formatted only by str()"""
+        _ts = utils.Timestamp(1600000000.25)
+        assert _ts == 1600000000.25
+        assert str(_ts) == utils.convert_date(1600000000.25)
+
+    @pytest.mark.parametrize('_orjson', [utils.orjson, None])
+    def test_json_dumps(self, monkeypatch, _orjson):
+        """Should serialize timestamps and records with any encoder"""
+        class _Record:
+            def to_dict(self):
+                return {'size': 1}
+        monkeypatch.setattr(utils, 'orjson', _orjson)
+        _data = {'date': utils.Timestamp(1.5), 'meta': [_Record()], 1: 'x'}
+        assert json.loads(utils.json_dumps(_data)) == {
+            'date': 1.5, 'meta': [{'size': 1}], '1': 'x'}
+        with pytest.raises(TypeError):
+            utils.json_dumps({'obj': object()})
+
     def test_date_format_now(self, date_format_now):
         """Should return properly formatted string for now in UTC"""
         _format = '%Y-%m-%d %H:%M:%S'